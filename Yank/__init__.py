@@ -5,18 +5,40 @@ YANK
 
 """
 
+import sys
+import types
+import importlib
+import warnings
+
 # Define global version.
 import version
 __version__ = version.version
 
-# Import modules.
+# Modules are not imported here, so that importing the package (e.g. by the
+# command line interface) does not import OpenMM and the analysis libraries.
+# Use 'from yank.yank import Yank'.
 #import alchemy
 #import repex
 #import sampling
 #import analyze
 #import restraints
 
-from yank import Yank
-
-
 
+class _YankPackage(types.ModuleType):
+    """Package module importing the deprecated yank.Yank attribute on first access."""
+
+    def __getattr__(self, name):
+        # Called only for the attributes that are not found in the module.
+        if name == 'Yank':
+            warnings.warn("yank.Yank is deprecated, use 'from yank.yank import Yank'",
+                          DeprecationWarning, stacklevel=2)
+            return importlib.import_module(__name__ + '.yank').Yank
+        raise AttributeError("'module' object has no attribute '{}'".format(name))
+
+# Python 2 modules have no __getattr__, so the package is replaced by an
+# instance of _YankPackage. The original module is kept alive because
+# Python 2 clears the globals of garbage-collected modules.
+_package = _YankPackage(__name__, __doc__)
+_package.__dict__.update(sys.modules[__name__].__dict__)
+_package._original_module = sys.modules[__name__]
+sys.modules[__name__] = _package
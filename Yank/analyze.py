@@ -15,19 +15,23 @@
 
 import os
 import os.path
+import csv
+import json
+import collections
+import time
+import multiprocessing
 
 import yaml
 import numpy as np
 
 import netCDF4 as netcdf # netcdf4-python
 
-from pymbar import MBAR # multistate Bennett acceptance ratio
-from pymbar import timeseries # for statistical inefficiency analysis
-
-import mdtraj
 import simtk.unit as units
 
 import utils
+import storage
+import catalog
+from status import find_status_files, read_status_file, print_status
 
 import logging
 logger = logging.getLogger(__name__)
@@ -38,12 +42,152 @@ logger = logging.getLogger(__name__)
 
 kB = units.BOLTZMANN_CONSTANT_kB * units.AVOGADRO_CONSTANT_NA
 
+# Maximum size in bytes of the blocks of energies read at once when the whole
+# file is not needed in memory.
+ENERGIES_BLOCK_BYTES = 64 * 1024**2
+
 #=============================================================================================
 # SUBROUTINES
 #=============================================================================================
 
+def open_analysis_ncfile(store_path):
+    """
+    Open the lightest NetCDF file containing the states and energies of a phase.
+
+    If the simulation was run with the 'energy_store' option, the small companion
+    file '<phase>.energies.nc' is opened instead of the main store file, which
+    contains also the positions.
+
+    Parameters
+    ----------
+    store_path : str
+       The path to the main NetCDF store file of the phase.
+
+    Returns
+    -------
+    ncfile : netCDF4.Dataset
+       The NetCDF file opened in read mode.
+
+    """
+    energy_store_path = utils.get_companion_store_path(store_path, 'energies.nc')
+    if os.path.isfile(energy_store_path) and os.path.getsize(energy_store_path) > 0:
+        logger.debug("Reading states and energies from energy store %s" % energy_store_path)
+        return netcdf.Dataset(energy_store_path, 'r')
+    return netcdf.Dataset(store_path, 'r')
+
+
 
-def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
+def statistical_inefficiency(A_n, mintime=3):
+    """
+    Compute the statistical inefficiency of a timeseries with an FFT autocorrelation.
+
+    This gives the same estimate of pymbar.timeseries.statisticalInefficiency()
+    (without the 'fast' option), but the autocorrelation function is computed
+    for all lag times at once in O(N log N).
+
+    Parameters
+    ----------
+    A_n : numpy array
+       A_n[n] is the n-th sample of the timeseries.
+    mintime : int, optional, default=3
+       The autocorrelation function is integrated at least up to this lag
+       time, and then until it crosses zero.
+
+    Returns
+    -------
+    g : float
+       The statistical inefficiency (g >= 1).
+
+    """
+    A_n = np.asarray(A_n, np.float64)
+    N = A_n.size
+    dA_n = A_n - A_n.mean()
+    sigma2 = np.dot(dA_n, dA_n) / N
+    if sigma2 == 0.0:
+        raise ValueError('Sample covariance sigma_AB^2 = 0 -- cannot compute statistical inefficiency')
+    if N < 3:
+        return 1.0
+
+    # Unnormalized autocovariance S_t = sum_n dA_n[n] dA_n[n+t] with zero padding.
+    nfft = 2**int(np.ceil(np.log2(2*N)))
+    dA_k = np.fft.rfft(dA_n, nfft)
+    S_t = np.fft.irfft(dA_k * np.conjugate(dA_k), nfft)[:N]
+
+    # Normalized autocorrelation function C_t, integrated until it crosses zero after mintime.
+    t = np.arange(1, N-1)
+    C_t = S_t[1:N-1] / ((N - t) * sigma2)
+    stop = np.where((C_t <= 0.0) & (t > mintime))[0]
+    nt = stop[0] if len(stop) > 0 else len(t)
+    g = 1.0 + 2.0 * np.sum(C_t[:nt] * (1.0 - t[:nt] / float(N)))
+
+    return max(g, 1.0)
+
+
+def detect_equilibration(A_t, ngrid=100, t0_guess=None):
+    """
+    Detect the equilibrated region of a timeseries maximizing the number of uncorrelated samples.
+
+    This has the same semantics of pymbar.timeseries.detectEquilibration(),
+    but instead of computing the statistical inefficiency for every possible
+    start point, it searches a coarse grid of candidate start points and
+    refines the grid around the best candidate until it reaches single
+    iterations. Each statistical inefficiency is computed with an FFT.
+
+    Parameters
+    ----------
+    A_t : numpy array
+       A_t[t] is the t-th sample of the timeseries.
+    ngrid : int, optional, default=100
+       Number of candidate start points evaluated at each refinement level.
+       Timeseries shorter than this are searched exhaustively.
+    t0_guess : int, optional, default=None
+       A previous estimate of the equilibration time (e.g. computed before
+       the timeseries grew). It is included among the candidates.
+
+    Returns
+    -------
+    t : int
+       Start of the equilibrated region.
+    g : float
+       Statistical inefficiency of the equilibrated region.
+    Neff_max : float
+       Number of effectively uncorrelated samples in the equilibrated region.
+
+    """
+    A_t = np.asarray(A_t, np.float64)
+    T = A_t.size
+    if T < 2 or A_t.std() == 0.0:
+        return 0, 1.0, 1.0
+
+    g_t = dict()  # g_t[t] is the statistical inefficiency of A_t[t:]
+
+    def evaluate(t):
+        if t not in g_t:
+            try:
+                g_t[t] = statistical_inefficiency(A_t[t:T])
+            except ValueError:
+                g_t[t] = float(T - t + 1)
+        return (T - t + 1) / g_t[t]
+
+    # Search the window [start, stop) with progressively finer grids.
+    start, stop = 0, T - 1
+    candidates = set()
+    if t0_guess is not None and 0 <= t0_guess < T - 1:
+        candidates.add(int(t0_guess))
+    while True:
+        step = max(1, (stop - start) // ngrid)
+        candidates.update(range(start, stop, step))
+        best_t = max(sorted(candidates), key=evaluate)
+        if step == 1:
+            break
+        start, stop = max(0, best_t - step), min(T - 1, best_t + step + 1)
+        candidates = {best_t}
+
+    g = g_t[best_t]
+    return best_t, g, (T - best_t + 1) / g
+
+
+def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0, analysis_cache=None):
     """
     Print summary of mixing statistics.
 
@@ -56,6 +200,10 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
        Only transition probabilities above 'cutoff' will be printed
     nequil : int, optional, default=0
        If specified, only samples nequil:end will be used in analysis
+    analysis_cache : dict, optional, default=None
+       Persisted analysis state (see read_analysis_cache). If it contains the
+       transition counts computed with the same nequil, only the iterations
+       added since then are read. The counts are updated in the cache.
 
     """
 
@@ -63,13 +211,20 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
     niterations = ncfile.variables['states'].shape[0]
     nstates = ncfile.variables['states'].shape[1]
 
-    # Compute empirical transition count matrix.
+    # Resume the count of transitions from the cache if possible.
     Nij = np.zeros([nstates,nstates], np.float64)
-    for iteration in range(nequil, niterations-1):
-        for ireplica in range(nstates):
-            istate = ncfile.variables['states'][iteration,ireplica]
-            jstate = ncfile.variables['states'][iteration+1,ireplica]
-            Nij[istate,jstate] += 1
+    first_iteration = nequil
+    if (analysis_cache is not None and 'Nij' in analysis_cache and
+            analysis_cache['Nij_nequil'] == nequil and nequil < analysis_cache['Nij_niterations'] <= niterations):
+        Nij += analysis_cache['Nij']
+        first_iteration = analysis_cache['Nij_niterations'] - 1
+
+    # Compute empirical transition count matrix.
+    if first_iteration < niterations - 1:
+        states = np.array(ncfile.variables['states'][first_iteration:niterations], np.int64)
+        np.add.at(Nij, (states[:-1].ravel(), states[1:].ravel()), 1)
+    if analysis_cache is not None:
+        analysis_cache.update(Nij=Nij, Nij_nequil=nequil, Nij_niterations=niterations)
 
     # Compute transition matrix estimate.
     # TODO: Replace with maximum likelihood reversible count estimator from msmbuilder or pyemma.
@@ -111,100 +266,230 @@ def show_mixing_statistics(ncfile, cutoff=0.05, nequil=0):
     return
 
 
-def estimate_free_energies(ncfile, ndiscard=0, nuse=None, g=None):
+# Deconvoluted energies of the last file read entirely by read_energies(), keyed by
+# the (path, modification time, size) of the file. At most one file is cached.
+_energies_cache = {}
+
+
+def _deconvolute_energies(energies, states):
+    """Deconvolute replica energies into u_kln and compute u_n with fancy indexing."""
+    niterations, nreplicas, nstates = energies.shape
+    u_nkl = np.zeros([niterations, nstates, nstates], np.float64)
+    u_nkl[np.arange(niterations)[:,np.newaxis], states, :] = energies
+    u_kln = u_nkl.transpose(1, 2, 0)
+    u_n = np.trace(u_nkl, axis1=1, axis2=2)
+    return u_kln, u_n
+
+
+def _get_energies_cache_key(ncfile):
+    """Return the key identifying the content of ncfile in _energies_cache, or None if it cannot be cached."""
+    try:
+        file_path = ncfile.filepath()
+        return (os.path.abspath(file_path), os.path.getmtime(file_path), os.path.getsize(file_path))
+    except (AttributeError, ValueError, OSError):
+        # Datasets without a file on disk are never cached.
+        return None
+
+
+def _get_block_niterations(ncfile):
+    """Return the number of iterations in a block of ENERGIES_BLOCK_BYTES energies."""
+    niterations, nreplicas, nstates = ncfile.variables['energies'].shape
+    return max(1, ENERGIES_BLOCK_BYTES // (8 * nreplicas * nstates))
+
+
+def _stream_u_n(ncfile, start, stop):
+    """Compute u_n of the iterations [start, stop) reading energies in blocks."""
+    cache_key = _get_energies_cache_key(ncfile)
+    if cache_key is not None and cache_key in _energies_cache:
+        return _energies_cache[cache_key][1][start:stop].copy()
+
+    block_niterations = _get_block_niterations(ncfile)
+    u_n = np.zeros([max(0, stop - start)], np.float64)
+    for block_start in range(start, stop, block_niterations):
+        block_stop = min(stop, block_start + block_niterations)
+        energies = np.array(ncfile.variables['energies'][block_start:block_stop], np.float64)
+        states = np.array(ncfile.variables['states'][block_start:block_stop], np.int64)
+
+        # u_n is the sum of the energies of each replica in its current state.
+        block_iterations = np.arange(block_stop - block_start)[:,np.newaxis]
+        replicas = np.arange(states.shape[1])[np.newaxis,:]
+        u_n[block_start-start:block_stop-start] = energies[block_iterations, replicas, states].sum(axis=1)
+    return u_n
+
+
+def read_energies(ncfile, iterations=None):
     """
-    Estimate free energies of all alchemical states.
+    Read and deconvolute the reduced potentials of all iterations.
+
+    The states and energies are read in bulk and deconvoluted with a single
+    fancy-indexing operation. The result of the last file read entirely is
+    cached, so that the analysis functions called on the same file share it.
+    The returned arrays must not be modified in place.
 
     Parameters
     ----------
-    ncfile : NetCDF
+    ncfile : netCDF4.Dataset
        Input YANK netcdf file
-    ndiscard : int, optional, default=0
-       Number of iterations to discard to equilibration
-    nuse : int, optional, default=None
-       Maximum number of iterations to use (after discarding)
-    g : int, optional, default=None
-       Statistical inefficiency to use if desired; if None, will be computed.
+    iterations : numpy array of int, optional, default=None
+       If specified, only these (increasing) iterations are read from the
+       file in blocks of ENERGIES_BLOCK_BYTES, unless the whole file is already
+       cached, so that memory scales with the number of iterations requested.
 
-    TODO
-    ----
-    * Automatically determine 'ndiscard'.
+    Returns
+    -------
+    u_kln : numpy array of numpy.float64
+       u_kln[k,l,n] is the reduced potential in state l of the replica that
+       was in state k at iteration n.
+    u_n : numpy array of numpy.float64
+       u_n[n] is the total reduced potential of iteration n (see extract_u_n).
 
     """
-
-    # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
-
-    # Extract energies.
+    niterations, nreplicas, nstates = ncfile.variables['energies'].shape
+    cache_key = _get_energies_cache_key(ncfile)
+    if cache_key is not None and cache_key in _energies_cache:
+        u_kln, u_n = _energies_cache[cache_key]
+        if iterations is None:
+            return u_kln, u_n
+        return u_kln[:,:,iterations], u_n[iterations]
+
+    # Read only the requested iterations.
+    if iterations is not None:
+        iterations = np.asarray(iterations, np.int64)
+        u_kln = np.zeros([nstates, nstates, len(iterations)], np.float64)
+        u_n = np.zeros([len(iterations)], np.float64)
+        block_niterations = _get_block_niterations(ncfile)
+        for block_start in range(0, len(iterations), block_niterations):
+            block_iterations = iterations[block_start:block_start+block_niterations]
+            block_stop = block_start + len(block_iterations)
+            energies = np.array(ncfile.variables['energies'][block_iterations], np.float64)
+            states = np.array(ncfile.variables['states'][block_iterations], np.int64)
+            u_kln[:,:,block_start:block_stop], u_n[block_start:block_stop] = _deconvolute_energies(energies, states)
+        return u_kln, u_n
+
+    # Read states and energies in bulk.
     logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
+    energies = np.array(ncfile.variables['energies'][:niterations], np.float64)
+    states = np.array(ncfile.variables['states'][:niterations], np.int64)
     logger.info("Done.")
 
-    # Deconvolute replicas
     logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
+    u_kln, u_n = _deconvolute_energies(energies, states)
     logger.info("Done.")
 
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
-    #logger.info(u_n
-
-    # DEBUG
-    outfile = open('u_n.out', 'w')
-    for iteration in range(niterations):
-        outfile.write("%8d %24.3f\n" % (iteration, u_n[iteration]))
-    outfile.close()
-
-    # Discard initial data to equilibration.
-    u_kln_replica = u_kln_replica[:,:,ndiscard:]
-    u_kln = u_kln[:,:,ndiscard:]
-    u_n = u_n[ndiscard:]
+    # Keep only the last file read, so that at most one dense u_kln is kept alive.
+    _energies_cache.clear()
+    if cache_key is not None:
+        _energies_cache[cache_key] = (u_kln, u_n)
+    return u_kln, u_n
+
+
+def _subsample_energies(ncfile, ndiscard, nuse, g, analysis_cache):
+    """
+    Return the deconvoluted energies of the uncorrelated iterations used for estimates.
 
-    # Truncate to number of specified conforamtions to use
+    Only the energies of the selected iterations are deconvoluted. The u_n
+    timeseries is taken from analysis_cache when it contains all iterations,
+    and it is otherwise computed streaming the energies in blocks.
+
+    """
+    niterations, nreplicas, nstates = ncfile.variables['energies'].shape
+
+    # Extract the total reduced potential timeseries.
+    if analysis_cache is not None and len(analysis_cache.get('u_n', [])) == niterations:
+        u_n = analysis_cache['u_n']
+    else:
+        u_n = extract_u_n(ncfile)
+
+    # Discard initial data to equilibration and truncate to number of specified conformations to use.
+    u_n = u_n[ndiscard:]
     if (nuse):
-        u_kln_replica = u_kln_replica[:,:,0:nuse]
-        u_kln = u_kln[:,:,0:nuse]
         u_n = u_n[0:nuse]
 
     # Subsample data to obtain uncorrelated samples
+    from pymbar import timeseries # for statistical inefficiency analysis
     N_k = np.zeros(nstates, np.int32)
     indices = timeseries.subsampleCorrelatedData(u_n, g=g) # indices of uncorrelated samples
-    #print u_n # DEBUG
-    #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
     N = len(indices) # number of uncorrelated samples
     N_k[:] = N
-    u_kln[:,:,0:N] = u_kln[:,:,indices]
+    u_kln, _ = read_energies(ncfile, iterations=ndiscard + np.array(indices, np.int64))
     logger.info("number of uncorrelated samples:")
     logger.info(N_k)
     logger.info("")
 
+    return u_kln, N_k, N
+
+
+def estimate_free_energies(ncfile, ndiscard=0, nuse=None, g=None, analysis_cache=None,
+                           nbootstraps=0, bootstrap_block_size=1, bootstrap_time_limit=None,
+                           nprocesses=1):
+    """
+    Estimate free energies of all alchemical states.
+
+    Parameters
+    ----------
+    ncfile : NetCDF
+       Input YANK netcdf file
+    ndiscard : int, optional, default=0
+       Number of iterations to discard to equilibration
+    nuse : int, optional, default=None
+       Maximum number of iterations to use (after discarding)
+    g : int, optional, default=None
+       Statistical inefficiency to use if desired; if None, will be computed.
+    analysis_cache : dict, optional, default=None
+       Persisted analysis state (see read_analysis_cache). If it contains the
+       u_n timeseries of all iterations, only the energies of the uncorrelated
+       samples are read; its 'f_k' entry is used to initialize MBAR and is
+       updated with the new estimate.
+    nbootstraps : int, optional, default=0
+       If positive, dDeltaf_ij is estimated by bootstrapping the uncorrelated
+       samples with this many replicates instead of using the MBAR asymptotic
+       covariance (see bootstrap_free_energies).
+    bootstrap_block_size : int, optional, default=1
+       Number of contiguous uncorrelated samples resampled together.
+    bootstrap_time_limit : float, optional, default=None
+       Maximum wall time in seconds spent computing bootstrap replicates.
+    nprocesses : int, optional, default=1
+       Number of processes solving bootstrap replicates in parallel.
+
+    TODO
+    ----
+    * Automatically determine 'ndiscard'.
+
+    """
+
+    # Get current dimensions.
+    nstates = ncfile.variables['energies'].shape[1]
+
+    # Extract deconvoluted energies of uncorrelated samples after equilibration.
+    u_kln, N_k, N = _subsample_energies(ncfile, ndiscard, nuse, g, analysis_cache)
+
     #===================================================================================================
     # Estimate free energy difference with MBAR.
     #===================================================================================================
 
     # Initialize MBAR (computing free energy estimates, which may take a while)
+    from pymbar import MBAR # multistate Bennett acceptance ratio
     logger.info("Computing free energy differences...")
-    mbar = MBAR(u_kln, N_k)
+    if analysis_cache is not None and len(analysis_cache.get('f_k', [])) == nstates:
+        mbar = MBAR(u_kln, N_k, initial_f_k=analysis_cache['f_k'])
+    else:
+        mbar = MBAR(u_kln, N_k)
+    if analysis_cache is not None:
+        analysis_cache['f_k'] = mbar.f_k
 
     # Get matrix of dimensionless free energy differences and uncertainty estimate.
     logger.info("Computing covariance matrix...")
 
-    try:
-        # pymbar 2
-        (Deltaf_ij, dDeltaf_ij) = mbar.getFreeEnergyDifferences()
-    except ValueError:
-        # pymbar 3
-        (Deltaf_ij, dDeltaf_ij, theta_ij) = mbar.getFreeEnergyDifferences()
+    (Deltaf_ij, dDeltaf_ij) = _free_energy_differences(mbar)
+
+    # Replace the asymptotic uncertainties with bootstrap estimates.
+    if nbootstraps > 0:
+        logger.info("Bootstrapping free energy differences...")
+        dDeltaf_ij, nreplicates = bootstrap_free_energies(u_kln, N_k, mbar.f_k, nbootstraps=nbootstraps,
+                                                          block_size=bootstrap_block_size,
+                                                          time_limit=bootstrap_time_limit,
+                                                          nprocesses=nprocesses)
+        logger.info("Uncertainties estimated from %d bootstrap replicates." % nreplicates)
 
 #    # Matrix of free energy differences
     logger.info("Deltaf_ij:")
@@ -226,7 +511,8 @@ def estimate_free_energies(ncfile, ndiscard=0, nuse=None, g=None):
     # Return free energy differences and an estimate of the covariance.
     return (Deltaf_ij, dDeltaf_ij)
 
-def estimate_enthalpies(ncfile, ndiscard=0, nuse=None, g=None):
+def estimate_enthalpies(ncfile, ndiscard=0, nuse=None, g=None, analysis_cache=None,
+                        nbootstraps=0, bootstrap_block_size=1):
     """
     Estimate enthalpies of all alchemical states.
 
@@ -240,6 +526,15 @@ def estimate_enthalpies(ncfile, ndiscard=0, nuse=None, g=None):
        Number of iterations to use (after discarding)
     g : int, optional, default=None
        Statistical inefficiency to use if desired; if None, will be computed.
+    analysis_cache : dict, optional, default=None
+       Persisted analysis state (see read_analysis_cache). If it contains the
+       u_n timeseries of all iterations, only the energies of the uncorrelated
+       samples are read.
+    nbootstraps : int, optional, default=0
+       If positive, dH_k is estimated by bootstrapping the uncorrelated samples
+       with this many replicates (at least 2).
+    bootstrap_block_size : int, optional, default=1
+       Number of contiguous uncorrelated samples resampled together.
 
     TODO
     ----
@@ -248,61 +543,14 @@ def estimate_enthalpies(ncfile, ndiscard=0, nuse=None, g=None):
 
     """
 
+    if nbootstraps == 1:
+        raise ValueError('At least 2 bootstrap replicates are needed to estimate uncertainties, got 1')
+
     # Get current dimensions.
-    niterations = ncfile.variables['energies'].shape[0]
     nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
 
-    # Extract energies.
-    logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
-
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
-    logger.info("Done.")
-
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
-    #print u_n
-
-    # DEBUG
-    outfile = open('u_n.out', 'w')
-    for iteration in range(niterations):
-        outfile.write("%8d %24.3f\n" % (iteration, u_n[iteration]))
-    outfile.close()
-
-    # Discard initial data to equilibration.
-    u_kln_replica = u_kln_replica[:,:,ndiscard:]
-    u_kln = u_kln[:,:,ndiscard:]
-    u_n = u_n[ndiscard:]
-
-    # Truncate to number of specified conformations to use
-    if (nuse):
-        u_kln_replica = u_kln_replica[:,:,0:nuse]
-        u_kln = u_kln[:,:,0:nuse]
-        u_n = u_n[0:nuse]
-
-    # Subsample data to obtain uncorrelated samples
-    N_k = np.zeros(nstates, np.int32)
-    indices = timeseries.subsampleCorrelatedData(u_n, g=g) # indices of uncorrelated samples
-    #print u_n # DEBUG
-    #indices = range(0,u_n.size) # DEBUG - assume samples are uncorrelated
-    N = len(indices) # number of uncorrelated samples
-    N_k[:] = N
-    u_kln[:,:,0:N] = u_kln[:,:,indices]
-    logger.info("number of uncorrelated samples:")
-    logger.info(N_k)
-    logger.info("")
+    # Extract deconvoluted energies of uncorrelated samples after equilibration.
+    u_kln, N_k, N = _subsample_energies(ncfile, ndiscard, nuse, g, analysis_cache)
 
     # Compute average enthalpies.
     H_k = np.zeros([nstates], np.float64) # H_i[i] is estimated enthalpy of state i
@@ -311,6 +559,16 @@ def estimate_enthalpies(ncfile, ndiscard=0, nuse=None, g=None):
         H_k[k] = u_kln[k,k,:].mean()
         dH_k[k] = u_kln[k,k,:].std() / np.sqrt(N)
 
+    # Replace the standard errors with bootstrap estimates.
+    if nbootstraps > 0:
+        u_kn = np.array([u_kln[k,k,:] for k in range(nstates)])
+        random_state = np.random.RandomState()
+        H_k_replicates = np.zeros([nbootstraps, nstates], np.float64)
+        for replicate in range(nbootstraps):
+            indices = _bootstrap_sample_indices(N, bootstrap_block_size, random_state)
+            H_k_replicates[replicate] = u_kn[:,indices].mean(axis=1)
+        dH_k = H_k_replicates.std(axis=0, ddof=1)
+
     return (H_k, dH_k)
 
 def extract_u_n(ncfile):
@@ -339,177 +597,680 @@ def extract_u_n(ncfile):
 
     """
 
-    # Get current dimensions.
     niterations = ncfile.variables['energies'].shape[0]
-    nstates = ncfile.variables['energies'].shape[1]
-    natoms = ncfile.variables['energies'].shape[2]
+    return _stream_u_n(ncfile, 0, niterations)
 
-    # Extract energies.
-    logger.info("Reading energies...")
-    energies = ncfile.variables['energies']
-    u_kln_replica = np.zeros([nstates, nstates, niterations], np.float64)
-    for n in range(niterations):
-        u_kln_replica[:,:,n] = energies[n,:,:]
-    logger.info("Done.")
+def update_u_n(ncfile, u_n=None):
+    """
+    Extend a u_n timeseries with the iterations stored after it was computed.
 
-    # Deconvolute replicas
-    logger.info("Deconvoluting replicas...")
-    u_kln = np.zeros([nstates, nstates, niterations], np.float64)
-    for iteration in range(niterations):
-        state_indices = ncfile.variables['states'][iteration,:]
-        u_kln[state_indices,:,iteration] = energies[iteration,:,:]
-    logger.info("Done.")
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       Input YANK netcdf file
+    u_n : numpy array of numpy.float64, optional, default=None
+       u_n[n] is -log q(X_n) for the first len(u_n) iterations, as returned
+       by extract_u_n(). If None, the whole timeseries is extracted.
 
-    # Compute total negative log probability over all iterations.
-    u_n = np.zeros([niterations], np.float64)
-    for iteration in range(niterations):
-        u_n[iteration] = np.sum(np.diagonal(u_kln[:,:,iteration]))
+    Returns
+    -------
+    u_n : numpy array of numpy.float64
+       u_n[n] is -log q(X_n) for all the iterations in the file.
 
-    return u_n
+    """
+    niterations = ncfile.variables['states'].shape[0]
+    if u_n is None or len(u_n) > niterations:
+        return extract_u_n(ncfile)
+    if len(u_n) == niterations:
+        return u_n
+    return np.concatenate([u_n, _stream_u_n(ncfile, len(u_n), niterations)])
 
 #=============================================================================================
-# SHOW STATUS OF STORE FILES
+# BOOTSTRAP UNCERTAINTIES
 #=============================================================================================
 
-def print_status(store_directory):
+# Data shared by the bootstrap replicates of a worker process.
+_bootstrap_data = {}
+
+
+def _bootstrap_sample_indices(nsamples, block_size, random_state):
+    """Resample nsamples indices with replacement in contiguous blocks of block_size samples."""
+    block_size = max(1, min(block_size, nsamples))
+    nblocks = int(np.ceil(float(nsamples) / block_size))
+    starts = random_state.randint(0, nsamples - block_size + 1, nblocks)
+    indices = (starts[:,np.newaxis] + np.arange(block_size)).ravel()
+    return indices[:nsamples]
+
+
+def _initialize_bootstrap_worker(u_kln, N_k, f_k, block_size):
+    """Store the data shared by all the bootstrap replicates of this process."""
+    _bootstrap_data.update(u_kln=u_kln, N_k=N_k, f_k=f_k, block_size=block_size)
+
+
+def _bootstrap_replicate(seed):
+    """Solve MBAR on a bootstrap resample of the samples and return the free energies."""
+    from pymbar import MBAR
+    u_kln = _bootstrap_data['u_kln']
+    indices = _bootstrap_sample_indices(u_kln.shape[2], _bootstrap_data['block_size'],
+                                        np.random.RandomState(seed))
+    mbar = MBAR(u_kln[:,:,indices], _bootstrap_data['N_k'], initial_f_k=_bootstrap_data['f_k'])
+    return np.array(mbar.f_k)
+
+
+def bootstrap_free_energies(u_kln, N_k, f_k, nbootstraps=200, block_size=1, time_limit=None,
+                            nprocesses=1, seed=None):
     """
-    Print a quick summary of simulation progress.
+    Estimate the uncertainty of free energy differences by bootstrapping.
+
+    The uncorrelated samples are resampled with replacement (in blocks of
+    contiguous samples if block_size > 1), and MBAR is solved for each
+    replicate starting from the free energies estimated on the full data.
 
     Parameters
     ----------
-    store_directory : string
-       The location of the NetCDF simulation output files.
+    u_kln : numpy array of numpy.float64
+       u_kln[k,l,n] is the reduced potential in state l of the n-th uncorrelated
+       sample drawn from state k.
+    N_k : numpy array of int
+       N_k[k] is the number of samples drawn from state k.
+    f_k : numpy array of numpy.float64
+       The free energies estimated by MBAR on the full data.
+    nbootstraps : int, optional, default=200
+       Number of bootstrap replicates (at least 2).
+    block_size : int, optional, default=1
+       Number of contiguous samples resampled together.
+    time_limit : float, optional, default=None
+       If specified, no more replicates are collected after this many seconds
+       (at least two replicates are always computed).
+    nprocesses : int, optional, default=1
+       Number of processes solving replicates in parallel.
+    seed : int, optional, default=None
+       Seed of the random number generator used to resample.
 
     Returns
     -------
-    success : bool
-       True is returned on success; False if some files could not be read.
+    dDeltaf_ij : numpy array of numpy.float64
+       dDeltaf_ij[i,j] is the bootstrap standard error of f_j - f_i.
+    nreplicates : int
+       The number of replicates actually used.
 
     """
-    # Get NetCDF files
-    phases = utils.find_phases_in_store_directory(store_directory)
+    if nbootstraps < 2:
+        raise ValueError('At least 2 bootstrap replicates are needed to estimate uncertainties, '
+                         'got {}'.format(nbootstraps))
+    seeds = np.random.RandomState(seed).randint(0, 2**31 - 1, nbootstraps)
+    start_time = time.time()
+
+    def time_is_up():
+        return (time_limit is not None and len(f_k_replicates) >= 2 and
+                time.time() - start_time > time_limit)
+
+    f_k_replicates = []
+    if nprocesses > 1:
+        pool = multiprocessing.Pool(nprocesses, initializer=_initialize_bootstrap_worker,
+                                    initargs=(u_kln, N_k, f_k, block_size))
+        try:
+            for replicate_f_k in pool.imap_unordered(_bootstrap_replicate, seeds):
+                f_k_replicates.append(replicate_f_k)
+                if time_is_up():
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        _initialize_bootstrap_worker(u_kln, N_k, f_k, block_size)
+        try:
+            for replicate_seed in seeds:
+                f_k_replicates.append(_bootstrap_replicate(replicate_seed))
+                if time_is_up():
+                    break
+        finally:
+            _bootstrap_data.clear()
 
-    # Process each netcdf file.
-    for phase, fullpath in phases.items():
+    if len(f_k_replicates) < nbootstraps:
+        logger.info("Bootstrap time limit reached after %d/%d replicates." % (len(f_k_replicates), nbootstraps))
 
-        # Check that the file exists.
-        if not os.path.exists(fullpath):
-            # Report failure.
-            logger.info("File %s not found." % fullpath)
-            logger.info("Check to make sure the right directory was specified, and 'yank setup' has been run.")
-            return False
+    f_k_replicates = np.array(f_k_replicates)
+    Deltaf_ij_replicates = f_k_replicates[:,np.newaxis,:] - f_k_replicates[:,:,np.newaxis]
+    dDeltaf_ij = Deltaf_ij_replicates.std(axis=0, ddof=1)
+    return dDeltaf_ij, len(f_k_replicates)
 
-        # Open NetCDF file for reading.
-        logger.debug("Opening NetCDF trajectory file '%(fullpath)s' for reading..." % vars())
-        ncfile = netcdf.Dataset(fullpath, 'r')
 
-        # Read dimensions.
-        niterations = ncfile.variables['positions'].shape[0]
-        nstates = ncfile.variables['positions'].shape[1]
-        natoms = ncfile.variables['positions'].shape[2]
+#=============================================================================================
+# CONVERGENCE ANALYSIS
+#=============================================================================================
 
-        # Print summary.
-        logger.info("%s" % phase)
-        logger.info("  %8d iterations completed" % niterations)
-        logger.info("  %8d alchemical states" % nstates)
-        logger.info("  %8d atoms" % natoms)
+# Data shared by the convergence slices of a worker process.
+_convergence_data = {}
 
-        # TODO: Print average ns/day and estimated completion time.
 
-        # Close file.
-        ncfile.close()
+def _free_energy_differences(mbar):
+    """Return Deltaf_ij and dDeltaf_ij from an MBAR object for both pymbar 2 and 3."""
+    try:
+        # pymbar 2
+        (Deltaf_ij, dDeltaf_ij) = mbar.getFreeEnergyDifferences()
+    except ValueError:
+        # pymbar 3
+        (Deltaf_ij, dDeltaf_ij, theta_ij) = mbar.getFreeEnergyDifferences()
+    return Deltaf_ij, dDeltaf_ij
+
+
+def _initialize_convergence_worker(u_kln, f_k):
+    """Store the data shared by all the convergence slices of this process."""
+    _convergence_data.update(u_kln=u_kln, f_k=f_k)
+
+
+def _solve_slice(u_kln, columns, f_k):
+    """Solve MBAR on the uncorrelated samples u_kln[:,:,columns] starting from f_k."""
+    from pymbar import MBAR
+    N_k = len(columns) * np.ones([u_kln.shape[0]], np.int32)
+    mbar = MBAR(u_kln[:,:,columns], N_k, initial_f_k=f_k)
+    Deltaf_ij, dDeltaf_ij = _free_energy_differences(mbar)
+    return mbar.f_k, Deltaf_ij[0,-1], dDeltaf_ij[0,-1]
+
+
+def _convergence_slices(slices):
+    """Solve a sequence of neighbouring slices, warm-starting each from the previous one."""
+    f_k = _convergence_data['f_k']
+    results = []
+    for direction, fraction_index, columns in slices:
+        f_k, DeltaF, dDeltaF = _solve_slice(_convergence_data['u_kln'], columns, f_k)
+        results.append((direction, fraction_index, DeltaF, dDeltaF))
+    return results
+
+
+def _get_convergence_slices(u_n, nequil, nslices):
+    """
+    Return the uncorrelated iterations of all the production data and of each slice.
+
+    Returns
+    -------
+    production_indices : numpy array of int
+       The uncorrelated iterations of all the production data.
+    slices : list of tuple
+       (direction, fraction_index, indices) for the other forward and reverse
+       slices, from the largest to the smallest, where indices are the
+       uncorrelated iterations of the slice.
+
+    """
+    from pymbar import timeseries
+
+    def subsample(start, stop):
+        g = statistical_inefficiency(u_n[start:stop])
+        return start + np.array(timeseries.subsampleCorrelatedData(u_n[start:stop], g=g), np.int64)
+
+    nproduction = u_n.size - nequil
+    stops = [int(np.ceil(nproduction * (fraction_index + 1) / float(nslices))) for fraction_index in range(nslices)]
+    slices = []
+    for direction in ['forward', 'reverse']:
+        for fraction_index in reversed(range(nslices - 1)):
+            if direction == 'forward':
+                start, stop = nequil, nequil + stops[fraction_index]
+            else:
+                start, stop = u_n.size - stops[fraction_index], u_n.size
+            slices.append((direction, fraction_index, subsample(start, stop)))
+    return subsample(nequil, u_n.size), slices
+
+
+def get_convergence_iterations(u_n, nequil, nslices=10):
+    """
+    Return the iterations whose energies are needed by estimate_convergence().
+
+    Only the energies of these iterations need to be read and deconvoluted,
+    so that memory scales with the number of uncorrelated samples.
+
+    Parameters
+    ----------
+    u_n : numpy array of numpy.float64
+       u_n[n] is the total reduced potential of iteration n.
+    nequil : int
+       Number of initial iterations discarded to equilibration.
+    nslices : int, optional, default=10
+       Number of fractions of the production data.
+
+    Returns
+    -------
+    iterations : numpy array of int
+       The sorted uncorrelated iterations of all the slices.
+
+    """
+    production_indices, slices = _get_convergence_slices(u_n, nequil, nslices)
+    return np.unique(np.concatenate([production_indices] + [indices for _, _, indices in slices]))
+
+
+def estimate_convergence(u_kln, u_n, nequil, nslices=10, nprocesses=1, iterations=None):
+    """
+    Estimate the free energy difference on growing forward and reverse fractions of the data.
+
+    The forward (reverse) slice i contains the first (last) (i+1)/nslices
+    fraction of the production iterations. The slices are grouped in runs of
+    neighbouring fractions that are solved in a process pool; in each run,
+    MBAR is initialized with the free energies of the previous (larger) slice,
+    starting from the free energies of all the production data.
+
+    Parameters
+    ----------
+    u_kln : numpy array of numpy.float64
+       u_kln[k,l,n] is the reduced potential in state l of the replica that
+       was in state k at iteration n (or at iteration iterations[n]), as
+       returned by read_energies().
+    u_n : numpy array of numpy.float64
+       u_n[n] is the total reduced potential of iteration n.
+    nequil : int
+       Number of initial iterations discarded to equilibration.
+    nslices : int, optional, default=10
+       Number of fractions of the production data.
+    nprocesses : int, optional, default=1
+       Number of processes solving slices in parallel.
+    iterations : numpy array of int, optional, default=None
+       If specified, u_kln contains only the energies of these iterations,
+       which must include those returned by get_convergence_iterations().
+
+    Returns
+    -------
+    convergence : dict
+       Arrays 'fractions', 'forward_DeltaF', 'forward_dDeltaF', 'reverse_DeltaF'
+       and 'reverse_dDeltaF' with the free energy difference between the first
+       and last state (in kT) for each fraction.
+
+    """
+    convergence = dict(fractions=np.arange(1, nslices + 1) / float(nslices))
+    for name in ['forward_DeltaF', 'forward_dDeltaF', 'reverse_DeltaF', 'reverse_dDeltaF']:
+        convergence[name] = np.zeros([nslices], np.float64)
+
+    # Map the uncorrelated iterations of each slice to the columns of u_kln.
+    if iterations is None:
+        iterations = np.arange(u_n.size)
+    iterations = np.asarray(iterations, np.int64)
+
+    def get_columns(indices):
+        columns = np.minimum(np.searchsorted(iterations, indices), len(iterations) - 1)
+        if not np.all(iterations[columns] == indices):
+            raise ValueError('The energies of some uncorrelated iterations are missing from u_kln.')
+        return columns
+
+    production_indices, slices = _get_convergence_slices(u_n, nequil, nslices)
+
+    # All production data is shared by the forward and reverse series.
+    f_k, DeltaF, dDeltaF = _solve_slice(u_kln, get_columns(production_indices), None)
+    for direction in ['forward', 'reverse']:
+        convergence[direction + '_DeltaF'][-1] = DeltaF
+        convergence[direction + '_dDeltaF'][-1] = dDeltaF
+
+    # Split the other slices, from the largest to the smallest, in runs of neighbouring fractions.
+    nruns_per_direction = max(1, nprocesses // 2)
+    run_size = max(1, int(np.ceil((nslices - 1) / float(nruns_per_direction))))
+    runs = []
+    for direction in ['forward', 'reverse']:
+        direction_slices = [(direction, fraction_index, get_columns(indices))
+                            for slice_direction, fraction_index, indices in slices
+                            if slice_direction == direction]
+        runs.extend(direction_slices[i:i+run_size] for i in range(0, len(direction_slices), run_size))
+
+    if nprocesses > 1 and len(runs) > 1:
+        pool = multiprocessing.Pool(min(nprocesses, len(runs)), initializer=_initialize_convergence_worker,
+                                    initargs=(u_kln, f_k))
+        try:
+            run_results = pool.map(_convergence_slices, runs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _initialize_convergence_worker(u_kln, f_k)
+        try:
+            run_results = [_convergence_slices(run) for run in runs]
+        finally:
+            _convergence_data.clear()
+
+    for run_result in run_results:
+        for direction, fraction_index, DeltaF, dDeltaF in run_result:
+            convergence[direction + '_DeltaF'][fraction_index] = DeltaF
+            convergence[direction + '_dDeltaF'][fraction_index] = dDeltaF
+
+    return convergence
 
-    return True
 
 #=============================================================================================
-# ANALYZE STORE FILES
+# PERSISTED ANALYSIS STATE
 #=============================================================================================
 
-def analyze(source_directory):
+def get_analysis_cache_path(store_path):
+    """Return the path of the sidecar file storing the analysis state of a phase."""
+    return utils.get_companion_store_path(store_path, 'analysis.npz')
+
+
+def read_analysis_cache(store_path, ncfile=None):
     """
-    Analyze contents of store files to compute free energy differences.
+    Read the analysis intermediates persisted for a phase.
+
+    The cache is a dict that can contain the u_n timeseries of the first
+    'niterations' iterations ('u_n'), the last equilibration estimate
+    ('nequil', 'g_t', 'Neff_max'), the transition counts ('Nij',
+    'Nij_nequil', 'Nij_niterations'), the last MBAR free energies ('f_k')
+    and the results of analyze() ('results_*') computed with the number of
+    iterations and bootstrap options in 'results_key'.
 
     Parameters
     ----------
-    source_directory : string
-       The location of the NetCDF simulation storage files.
+    store_path : str
+       The path to the main NetCDF store file of the phase.
+    ncfile : netCDF4.Dataset, optional, default=None
+       If specified, the cache is discarded if its last u_n entry does not
+       match the energies in this file (e.g. the store has been recreated).
+
+    Returns
+    -------
+    analysis_cache : dict
+       The persisted analysis state, or an empty dict if there is none.
+
+    """
+    cache_path = get_analysis_cache_path(store_path)
+    if not os.path.isfile(cache_path):
+        return dict()
+    try:
+        cache_file = np.load(cache_path)
+        analysis_cache = {name: cache_file[name] for name in cache_file.files}
+        cache_file.close()
+    except Exception as e:
+        logger.warning("Could not read analysis cache {} ({}); analyzing from scratch.".format(cache_path, e))
+        return dict()
+
+    # Convert 0-dimensional arrays back to scalars.
+    for name, value in analysis_cache.items():
+        if value.shape == ():
+            analysis_cache[name] = value.item()
+
+    # Check that the cache refers to the data in the store.
+    if ncfile is not None and 'u_n' in analysis_cache:
+        u_n = analysis_cache['u_n']
+        niterations = ncfile.variables['states'].shape[0]
+        if len(u_n) == 0 or len(u_n) > niterations or not np.isclose(read_energies(ncfile, [len(u_n) - 1])[1][0], u_n[-1]):
+            logger.info("Analysis cache {} does not match the store; analyzing from scratch.".format(cache_path))
+            return dict()
+    return analysis_cache
+
+
+def write_analysis_cache(store_path, analysis_cache):
+    """
+    Atomically write the analysis intermediates of a phase.
+
+    Parameters
+    ----------
+    store_path : str
+       The path to the main NetCDF store file of the phase.
+    analysis_cache : dict
+       The analysis state in the format returned by read_analysis_cache().
 
     """
+    cache_path = get_analysis_cache_path(store_path)
+    tmp_cache_path = cache_path + '.tmp'
+    try:
+        with open(tmp_cache_path, 'wb') as f:
+            np.savez(f, **analysis_cache)
+        os.rename(tmp_cache_path, cache_path)
+    except (IOError, OSError) as e:
+        # The store directory may be read-only; the cache is only an optimization.
+        logger.debug("Could not write analysis cache {}: {}".format(cache_path, e))
+
+#=============================================================================================
+# SHOW STATUS OF STORE FILES
+#=============================================================================================
+
+def read_throughput(ncfile, nrecent=100):
+    """
+    Compute the throughput of a simulation from the timings of its last iterations.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The store file (or its energy store).
+    nrecent : int, optional, default=100
+       Number of most recent timed iterations averaged.
+
+    Returns
+    -------
+    throughput : dict or None
+       'seconds_per_iteration', the fraction of the iteration time spent out of
+       propagation ('overhead_fraction'), the simulated nanoseconds per day of
+       each replica ('ns_per_day', None if unknown), the number of remaining
+       iterations ('niterations_remaining') and the estimated remaining time in
+       seconds ('eta', None if unknown). None if no timed iteration is stored.
+
+    """
+    if 'timings' not in ncfile.groups:
+        return None
+    ncgrp_timings = ncfile.groups['timings']
+
+    # Iterations that have not been timed (e.g. the initial one) are masked.
+    iteration_times = np.ma.asarray(ncgrp_timings.variables['iteration'][:])
+    timed_iterations = np.where(~np.ma.getmaskarray(iteration_times))[0][-nrecent:]
+    if len(timed_iterations) == 0:
+        return None
+    total_time = float(iteration_times[timed_iterations].sum())
+    seconds_per_iteration = total_time / len(timed_iterations)
+
+    overhead_time = 0.0
+    for name in ['mixing', 'energies', 'storage', 'analysis']:
+        if name in ncgrp_timings.variables:
+            overhead_time += float(np.ma.asarray(ncgrp_timings.variables[name][:])[timed_iterations].sum())
+
+    ns_per_day = None
+    if 'ns_per_iteration' in ncgrp_timings.ncattrs():
+        ns_per_day = ncgrp_timings.ns_per_iteration / seconds_per_iteration * 24*60*60
+
+    niterations_remaining, eta = None, None
+    if 'options' in ncfile.groups and 'number_of_iterations' in ncfile.groups['options'].variables:
+        number_of_iterations = int(ncfile.groups['options'].variables['number_of_iterations'].getValue())
+        niterations_remaining = max(0, number_of_iterations - ncfile.variables['states'].shape[0])
+        eta = niterations_remaining * seconds_per_iteration
+
+    return dict(seconds_per_iteration=seconds_per_iteration, overhead_fraction=overhead_time / total_time,
+                ns_per_day=ns_per_day, niterations_remaining=niterations_remaining, eta=eta)
+
+
+def read_memory_diagnostics(ncfile, nallocations=3):
+    """
+    Read the memory diagnostics of the last iteration of a simulation.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset
+       The store file (or its energy store).
+    nallocations : int, optional, default=3
+       Number of top allocations returned.
+
+    Returns
+    -------
+    diagnostics : dict or None
+       The memory in MB of the variables 'rss', 'peak_rss', 'contexts',
+       'systems', 'replica_buffers' and 'trace_buffer' of the timings group at
+       the last measured iteration, the largest 'peak_rss' over the simulation
+       ('max_peak_rss'), and the last recorded 'top_allocations' as a list of
+       [location, MB, number of blocks] (None if never recorded). None if the
+       memory diagnostics were not recorded.
+
+    """
+    if 'timings' not in ncfile.groups or 'rss' not in ncfile.groups['timings'].variables:
+        return None
+    ncgrp_timings = ncfile.groups['timings']
+
+    # Iterations that have not been measured are masked.
+    rss = np.ma.asarray(ncgrp_timings.variables['rss'][:])
+    measured_iterations = np.where(~np.ma.getmaskarray(rss))[0]
+    if len(measured_iterations) == 0:
+        return None
+    last_iteration = measured_iterations[-1]
+
+    diagnostics = dict()
+    for name in ['rss', 'peak_rss', 'contexts', 'systems', 'replica_buffers', 'trace_buffer']:
+        if name in ncgrp_timings.variables:
+            diagnostics[name] = float(ncgrp_timings.variables[name][last_iteration])
+    diagnostics['max_peak_rss'] = float(np.ma.asarray(ncgrp_timings.variables['peak_rss'][:]).max())
+
+    # Top allocations are recorded only every memory_diagnostics_interval iterations.
+    diagnostics['top_allocations'] = None
+    if 'top_allocations' in ncgrp_timings.variables:
+        ncvar_allocations = ncgrp_timings.variables['top_allocations']
+        for iteration in reversed(measured_iterations):
+            if iteration < ncvar_allocations.shape[0] and ncvar_allocations[iteration]:
+                diagnostics['top_allocations'] = json.loads(ncvar_allocations[iteration])[:nallocations]
+                break
+
+    return diagnostics
+
+
+#=============================================================================================
+# ANALYZE STORE FILES
+#=============================================================================================
+
+def read_analysis_script(source_directory):
+    """Return the list of (phase_name, sign) pairs in the analysis.yaml script of source_directory."""
     analysis_script_path = os.path.join(source_directory, 'analysis.yaml')
     if not os.path.isfile(analysis_script_path):
         err_msg = 'Cannot find analysis.yaml script in {}'.format(source_directory)
         logger.error(err_msg)
         raise RuntimeError(err_msg)
     with open(analysis_script_path, 'r') as f:
-        analysis = yaml.load(f)
-    phases = [phase_name for phase_name, sign in analysis]
+        return yaml.load(f)
 
-    # Storage for different phases.
-    data = dict()
 
-    # Process each netcdf file.
-    for phase in phases:
-        ncfile_path = os.path.join(source_directory, phase + '.nc')
+def analyze_phase(ncfile_path, nbootstraps=0, bootstrap_block_size=1, bootstrap_time_limit=None,
+                  nprocesses=1):
+    """
+    Analyze the store file of a single phase.
 
-        # Open NetCDF file for reading.
-        logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
-        try:
-            ncfile = netcdf.Dataset(ncfile_path, 'r')
+    Parameters
+    ----------
+    ncfile_path : string
+       The path to the NetCDF store file of the phase.
+    nbootstraps : int, optional, default=0
+       If positive, uncertainties are estimated by bootstrapping the uncorrelated
+       samples with this many replicates (see analyze).
+    bootstrap_block_size : int, optional, default=1
+       Number of contiguous uncorrelated samples resampled together.
+    bootstrap_time_limit : float, optional, default=None
+       Maximum wall time in seconds spent computing bootstrap replicates.
+    nprocesses : int, optional, default=1
+       Number of processes solving bootstrap replicates in parallel.
 
-            logger.debug("dimensions:")
-            for dimension_name in ncfile.dimensions.keys():
-                logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
+    Returns
+    -------
+    entry : dict
+       The free energy ('DeltaF', 'dDeltaF') and enthalpy ('DeltaH', 'dDeltaH')
+       differences between the first and last state, and the standard state
+       correction ('DeltaF_restraints'), all in kT, the thermal energy 'kT'
+       in kcal/mol and the number of iterations 'niterations'.
 
-            # Read dimensions.
-            niterations = ncfile.variables['positions'].shape[0]
-            nstates = ncfile.variables['positions'].shape[1]
-            logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
+    """
+    # Open NetCDF file for reading.
+    logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
+    ncfile = open_analysis_ncfile(ncfile_path)
+    try:
+        logger.debug("dimensions:")
+        for dimension_name in ncfile.dimensions.keys():
+            logger.debug("%16s %8d" % (dimension_name, len(ncfile.dimensions[dimension_name])))
 
-            # Read phase direction and standard state correction free energy.
-            # Yank sets correction to 0 if there are no restraints
-            DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+        # Read dimensions.
+        niterations = ncfile.variables['states'].shape[0]
+        nstates = ncfile.variables['states'].shape[1]
+        logger.info("Read %(niterations)d iterations, %(nstates)d states" % vars())
+
+        # Read phase direction and standard state correction free energy.
+        # Yank sets correction to 0 if there are no restraints
+        DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+
+        # Reuse the analysis intermediates persisted by previous analyses.
+        analysis_cache = read_analysis_cache(ncfile_path, ncfile)
+
+        # Results computed with a bootstrap time limit may be based on fewer replicates.
+        results_key = (niterations, nbootstraps, bootstrap_block_size,
+                       -1.0 if bootstrap_time_limit is None else float(bootstrap_time_limit))
+        if tuple(analysis_cache.get('results_key', ())) == results_key:
+            # Nothing has changed since the last analysis.
+            logger.info("Using analysis cached for %(niterations)d iterations." % vars())
+            Deltaf_ij = analysis_cache['results_Deltaf_ij']
+            dDeltaf_ij = analysis_cache['results_dDeltaf_ij']
+            DeltaH_i = analysis_cache['results_DeltaH_i']
+            dDeltaH_i = analysis_cache['results_dDeltaH_i']
+        else:
+            # Extract u_n reading only the iterations added since the last analysis.
+            u_n = update_u_n(ncfile, analysis_cache.get('u_n'))
+            analysis_cache.update(u_n=u_n, niterations=niterations)
 
             # Choose number of samples to discard to equilibration
             MIN_ITERATIONS = 10 # minimum number of iterations to use automatic detection
             if niterations > MIN_ITERATIONS:
-                from pymbar import timeseries
-                u_n = extract_u_n(ncfile)
                 u_n = u_n[1:] # discard initial frame of zero energies TODO: Get rid of initial frame of zero energies
-                [nequil, g_t, Neff_max] = timeseries.detectEquilibration(u_n)
+                t0_guess = analysis_cache['nequil'] - 1 if 'nequil' in analysis_cache else None
+                [nequil, g_t, Neff_max] = detect_equilibration(u_n, t0_guess=t0_guess)
                 nequil += 1 # account for initial frame of zero energies
                 logger.info([nequil, Neff_max])
             else:
                 nequil = 1 # discard first frame
                 g_t = 1
                 Neff_max = niterations
+            analysis_cache.update(nequil=nequil, g_t=g_t, Neff_max=Neff_max)
 
             # Examine acceptance probabilities.
-            show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil)
+            show_mixing_statistics(ncfile, cutoff=0.05, nequil=nequil, analysis_cache=analysis_cache)
 
             # Estimate free energies.
-            (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, ndiscard = nequil, g=g_t)
+            (Deltaf_ij, dDeltaf_ij) = estimate_free_energies(ncfile, ndiscard = nequil, g=g_t,
+                                                             analysis_cache=analysis_cache,
+                                                             nbootstraps=nbootstraps,
+                                                             bootstrap_block_size=bootstrap_block_size,
+                                                             bootstrap_time_limit=bootstrap_time_limit,
+                                                             nprocesses=nprocesses)
 
             # Estimate average enthalpies
-            (DeltaH_i, dDeltaH_i) = estimate_enthalpies(ncfile, ndiscard = nequil, g=g_t)
-
-            # Accumulate free energy differences
-            entry = dict()
-            entry['DeltaF'] = Deltaf_ij[0,nstates-1]
-            entry['dDeltaF'] = dDeltaf_ij[0,nstates-1]
-            entry['DeltaH'] = DeltaH_i[nstates-1] - DeltaH_i[0]
-            entry['dDeltaH'] = np.sqrt(dDeltaH_i[0]**2 + dDeltaH_i[nstates-1]**2)
-            entry['DeltaF_restraints'] = DeltaF_restraints
-            data[phase] = entry
-
-            # Get temperatures.
-            ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
-            temperature = ncvar[0] * units.kelvin
-            kT = kB * temperature
+            (DeltaH_i, dDeltaH_i) = estimate_enthalpies(ncfile, ndiscard = nequil, g=g_t,
+                                                        analysis_cache=analysis_cache,
+                                                        nbootstraps=nbootstraps,
+                                                        bootstrap_block_size=bootstrap_block_size)
+
+            # Persist the analysis state.
+            analysis_cache.update(results_key=np.array(results_key),
+                                  results_Deltaf_ij=Deltaf_ij, results_dDeltaf_ij=dDeltaf_ij,
+                                  results_DeltaH_i=DeltaH_i, results_dDeltaH_i=dDeltaH_i)
+            write_analysis_cache(ncfile_path, analysis_cache)
+
+        # Accumulate free energy differences
+        entry = dict()
+        entry['DeltaF'] = float(Deltaf_ij[0,nstates-1])
+        entry['dDeltaF'] = float(dDeltaf_ij[0,nstates-1])
+        entry['DeltaH'] = float(DeltaH_i[nstates-1] - DeltaH_i[0])
+        entry['dDeltaH'] = float(np.sqrt(dDeltaH_i[0]**2 + dDeltaH_i[nstates-1]**2))
+        entry['DeltaF_restraints'] = float(DeltaF_restraints)
+        entry['niterations'] = niterations
+
+        # Get temperatures.
+        ncvar = ncfile.groups['thermodynamic_states'].variables['temperatures']
+        temperature = ncvar[0] * units.kelvin
+        entry['kT'] = kB * temperature / units.kilocalories_per_mole
 
-        finally:
-            ncfile.close()
+    finally:
+        ncfile.close()
 
-    # Compute free energy and enthalpy
+    return entry
+
+
+def combine_phases(analysis, data):
+    """
+    Combine the free energies and enthalpies of the phases of a calculation.
+
+    Parameters
+    ----------
+    analysis : list of (str, int)
+       The (phase_name, sign) pairs read from analysis.yaml.
+    data : dict
+       data[phase_name] is the entry returned by analyze_phase().
+
+    Returns
+    -------
+    DeltaF, dDeltaF, DeltaH, dDeltaH : float
+       Free energy and enthalpy differences with their uncertainties in kT.
+
+    """
     DeltaF = 0.0
     dDeltaF = 0.0
     DeltaH = 0.0
@@ -519,8 +1280,56 @@ def analyze(source_directory):
         dDeltaF += data[phase]['dDeltaF']**2
         DeltaH -= sign * (data[phase]['DeltaH'] + data[phase]['DeltaF_restraints'])
         dDeltaH += data[phase]['dDeltaH']**2
-    dDeltaF = np.sqrt(dDeltaF)
-    dDeltaH = np.sqrt(dDeltaH)
+    return DeltaF, np.sqrt(dDeltaF), DeltaH, np.sqrt(dDeltaH)
+
+
+def analyze(source_directory, nbootstraps=0, bootstrap_block_size=1, bootstrap_time_limit=None,
+            nprocesses=1):
+    """
+    Analyze contents of store files to compute free energy differences.
+
+    Parameters
+    ----------
+    source_directory : string
+       The location of the NetCDF simulation storage files.
+    nbootstraps : int, optional, default=0
+       If positive, uncertainties are estimated by bootstrapping the uncorrelated
+       samples with this many replicates instead of using the MBAR asymptotic
+       covariance.
+    bootstrap_block_size : int, optional, default=1
+       Number of contiguous uncorrelated samples resampled together.
+    bootstrap_time_limit : float, optional, default=None
+       Maximum wall time in seconds spent computing bootstrap replicates of each phase.
+    nprocesses : int, optional, default=1
+       Number of processes solving bootstrap replicates in parallel.
+
+    """
+    analysis = read_analysis_script(source_directory)
+    phases = [phase_name for phase_name, sign in analysis]
+
+    # Storage for different phases.
+    data = dict()
+
+    # Process each netcdf file.
+    for phase in phases:
+        ncfile_path = os.path.join(source_directory, phase + '.nc')
+        data[phase] = analyze_phase(ncfile_path, nbootstraps=nbootstraps,
+                                    bootstrap_block_size=bootstrap_block_size,
+                                    bootstrap_time_limit=bootstrap_time_limit,
+                                    nprocesses=nprocesses)
+        kT = data[phase]['kT']
+
+    # Compute free energy and enthalpy
+    DeltaF, dDeltaF, DeltaH, dDeltaH = combine_phases(analysis, data)
+
+    # Update the results catalog of the output tree, if any.
+    catalog_path = catalog.find_catalog(source_directory)
+    if catalog_path is not None:
+        stores = [(phase, os.path.join(source_directory, phase + '.nc'), data[phase]['niterations'])
+                  for phase in phases]
+        with catalog.ResultsCatalog(catalog_path) as results_catalog:
+            results_catalog.record_results(source_directory, DeltaF=DeltaF, dDeltaF=dDeltaF, DeltaH=DeltaH,
+                                           dDeltaH=dDeltaH, kT=kT, stores=stores)
 
     # Attempt to guess type of calculation
     calculation_type = ''
@@ -533,8 +1342,7 @@ def analyze(source_directory):
     # Print energies
     logger.info("")
     logger.info("Free energy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
-        calculation_type, DeltaF, dDeltaF, DeltaF * kT / units.kilocalories_per_mole,
-        dDeltaF * kT / units.kilocalories_per_mole))
+        calculation_type, DeltaF, dDeltaF, DeltaF * kT, dDeltaF * kT))
     logger.info("")
 
     for phase in phases:
@@ -545,19 +1353,369 @@ def analyze(source_directory):
                                                              data[phase]['DeltaF_restraints']))
     logger.info("")
     logger.info("Enthalpy{}: {:16.3f} +- {:.3f} kT ({:16.3f} +- {:.3f} kcal/mol)".format(
-        calculation_type, DeltaH, dDeltaH, DeltaH * kT / units.kilocalories_per_mole,
-        dDeltaH * kT / units.kilocalories_per_mole))
+        calculation_type, DeltaH, dDeltaH, DeltaH * kT, dDeltaH * kT))
+
+
+def _analyze_phase_job(job):
+    """Analyze a phase in a worker process returning the error message instead of raising."""
+    experiment_dir, phase, ncfile_path, kwargs = job
+    try:
+        return experiment_dir, phase, analyze_phase(ncfile_path, **kwargs), None
+    except Exception as e:
+        return experiment_dir, phase, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def find_experiment_directories(directory):
+    """Return the sorted list of directories containing an analysis.yaml script under directory."""
+    experiment_dirs = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        if 'analysis.yaml' in file_names:
+            experiment_dirs.append(dir_path)
+    return sorted(experiment_dirs)
+
+
+def analyze_directory(directory, output_path=None, nbootstraps=0, bootstrap_block_size=1,
+                      bootstrap_time_limit=None, nprocesses=1, catalog_path=''):
+    """
+    Analyze all the experiments in a directory tree in parallel.
+
+    Every directory containing an analysis.yaml script (for example each
+    experiment in the output of a combinatorial YAML script) is analyzed. All
+    the phases of all the experiments are analyzed in a pool of processes, and
+    the experiments that fail are reported without stopping the others.
+
+    Parameters
+    ----------
+    directory : string
+       The root of the tree to search (e.g. the YAML output_dir).
+    output_path : string, optional, default=None
+       If specified, the results table is written to this file in JSON format
+       if the extension is .json and in CSV format otherwise.
+    catalog_path : string, optional
+       The results catalog updated with the results. By default, the catalog
+       of the output tree containing directory is used, or a new catalog is
+       created in directory. If None, no catalog is updated.
+    nbootstraps, bootstrap_block_size, bootstrap_time_limit
+       Bootstrap options passed to analyze_phase().
+    nprocesses : int, optional, default=1
+       Number of phases analyzed in parallel.
+
+    Returns
+    -------
+    results : list of dict
+       One entry per experiment with its 'experiment' directory relative to
+       directory, the binding or solvation 'DeltaF', 'dDeltaF', 'DeltaH' and
+       'dDeltaH' in kT and kcal/mol, the thermal energy 'kT' in kcal/mol,
+       the per-phase entries in 'phases' and an 'error' message joining the
+       errors of all the failed phases, which is None if the analysis
+       succeeded.
+
+    """
+    phase_kwargs = dict(nbootstraps=nbootstraps, bootstrap_block_size=bootstrap_block_size,
+                        bootstrap_time_limit=bootstrap_time_limit)
+
+    # Discover the phases of all experiments.
+    analyses = {}
+    errors = {}  # List of the errors of each failed experiment.
+    experiment_store_paths = {}
+    jobs = []
+    for experiment_dir in find_experiment_directories(directory):
+        try:
+            analysis = read_analysis_script(experiment_dir)
+            store_paths = utils.find_phases_in_store_directory(experiment_dir)
+            for phase, sign in analysis:
+                if phase not in store_paths:
+                    raise RuntimeError('Cannot find store file of phase {}'.format(phase))
+        except Exception as e:
+            errors[experiment_dir] = ['{}: {}'.format(type(e).__name__, e)]
+            continue
+        analyses[experiment_dir] = analysis
+        experiment_store_paths[experiment_dir] = store_paths
+        jobs.extend((experiment_dir, phase, store_paths[phase], phase_kwargs) for phase, sign in analysis)
+    logger.info("Analyzing {} phases of {} experiments...".format(len(jobs), len(analyses) + len(errors)))
+
+    if nprocesses > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nprocesses, len(jobs)))
+        try:
+            job_results = pool.map(_analyze_phase_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        job_results = [_analyze_phase_job(job) for job in jobs]
+
+    data = {experiment_dir: {} for experiment_dir in analyses}
+    for experiment_dir, phase, entry, error in job_results:
+        if error is not None:
+            errors.setdefault(experiment_dir, []).append('{}: {}'.format(phase, error))
+        else:
+            data[experiment_dir][phase] = entry
+
+    # Combine the phases of each experiment.
+    results = []
+    for experiment_dir in sorted(set(analyses) | set(errors)):
+        result = dict(experiment=os.path.relpath(experiment_dir, directory), error=None)
+        if experiment_dir in errors:
+            result['error'] = '; '.join(errors[experiment_dir])
+        if result['error'] is None:
+            phases = data[experiment_dir]
+            DeltaF, dDeltaF, DeltaH, dDeltaH = combine_phases(analyses[experiment_dir], phases)
+            kT = phases[analyses[experiment_dir][-1][0]]['kT']
+            result.update(DeltaF=DeltaF, dDeltaF=dDeltaF, DeltaH=DeltaH, dDeltaH=dDeltaH, kT=kT,
+                          DeltaF_kcalmol=DeltaF * kT, dDeltaF_kcalmol=dDeltaF * kT,
+                          DeltaH_kcalmol=DeltaH * kT, dDeltaH_kcalmol=dDeltaH * kT, phases=phases)
+            logger.info("{}: DeltaG = {:.3f} +- {:.3f} kcal/mol".format(result['experiment'], DeltaF * kT,
+                                                                       dDeltaF * kT))
+        else:
+            logger.error("{}: analysis failed: {}".format(result['experiment'], result['error']))
+        results.append(result)
+
+    # Update the results catalog.
+    if catalog_path == '':
+        catalog_path = catalog.find_catalog(directory)
+        if catalog_path is None:
+            catalog_path = os.path.join(directory, catalog.CATALOG_FILE_NAME)
+    if catalog_path is not None:
+        with catalog.ResultsCatalog(catalog_path) as results_catalog:
+            for result in results:
+                experiment_dir = os.path.join(directory, result['experiment'])
+                if result['error'] is not None:
+                    results_catalog.record_results(experiment_dir, error=result['error'])
+                    continue
+                stores = [(phase, experiment_store_paths[experiment_dir][phase], entry['niterations'])
+                          for phase, entry in result['phases'].items()]
+                results_catalog.record_results(experiment_dir, DeltaF=result['DeltaF'], dDeltaF=result['dDeltaF'],
+                                               DeltaH=result['DeltaH'], dDeltaH=result['dDeltaH'], kT=result['kT'],
+                                               stores=stores)
+
+    if output_path is not None:
+        write_results_table(results, output_path)
+    return results
+
+
+def write_results_table(results, output_path):
+    """
+    Write the results of analyze_directory() to a CSV or JSON file.
+
+    The format is determined by the extension of output_path. The per-phase
+    entries are included only in the JSON format.
+
+    """
+    if os.path.splitext(output_path)[1].lower() == '.json':
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        return
+
+    columns = ['experiment', 'DeltaF', 'dDeltaF', 'DeltaH', 'dDeltaH', 'DeltaF_kcalmol',
+               'dDeltaF_kcalmol', 'DeltaH_kcalmol', 'dDeltaH_kcalmol', 'error']
+    with open(output_path, 'wb') as f:
+        writer = csv.DictWriter(f, columns, extrasaction='ignore')
+        writer.writeheader()
+        for result in results:
+            writer.writerow({column: '' if result.get(column) is None else result[column]
+                             for column in columns})
+
+
+def get_convergence_path(source_directory, phase=None):
+    """Return the path of the convergence time series of a phase or of the combined estimate."""
+    if phase is None:
+        return os.path.join(source_directory, 'convergence.npz')
+    return utils.get_companion_store_path(os.path.join(source_directory, phase + '.nc'), 'convergence.npz')
+
+
+def analyze_convergence(source_directory, nslices=10, nprocesses=1):
+    """
+    Compute forward and reverse time series of the free energy differences.
+
+    The u_n timeseries of each phase is computed streaming the energies in
+    blocks, and only the energies of the uncorrelated samples of the slices
+    are deconvoluted. The time series of each phase are saved next to its
+    store file in <phase>.convergence.npz and the combined estimate,
+    including the standard state correction, is saved in convergence.npz in
+    the source directory.
+
+    Parameters
+    ----------
+    source_directory : string
+       The location of the NetCDF simulation storage files.
+    nslices : int, optional, default=10
+       Number of fractions of the production data analyzed.
+    nprocesses : int, optional, default=1
+       Number of processes solving slices in parallel.
+
+    Returns
+    -------
+    convergence : dict
+       The combined estimate (in kT) with the same keys as the dictionary
+       returned by estimate_convergence().
+
+    """
+    analysis = read_analysis_script(source_directory)
+
+    combined = dict(fractions=np.arange(1, nslices + 1) / float(nslices))
+    for name in ['forward_DeltaF', 'forward_dDeltaF', 'reverse_DeltaF', 'reverse_dDeltaF']:
+        combined[name] = np.zeros([nslices], np.float64)
+
+    for phase, sign in analysis:
+        ncfile_path = os.path.join(source_directory, phase + '.nc')
+        logger.info("Opening NetCDF trajectory file %(ncfile_path)s for reading..." % vars())
+        ncfile = open_analysis_ncfile(ncfile_path)
+        try:
+            u_n = extract_u_n(ncfile)
+            DeltaF_restraints = ncfile.groups['metadata'].variables['standard_state_correction'][0]
+
+            # Discard initial frame of zero energies and equilibration.
+            nequil = detect_equilibration(u_n[1:])[0] + 1
+            if u_n.size - nequil < nslices:
+                raise RuntimeError('Phase {} has only {} production iterations to split in {} '
+                                   'slices'.format(phase, u_n.size - nequil, nslices))
+
+            # Deconvolute only the energies of the uncorrelated samples of the slices.
+            iterations = get_convergence_iterations(u_n, nequil, nslices)
+            u_kln, _ = read_energies(ncfile, iterations=iterations)
+        finally:
+            ncfile.close()
+
+        logger.info("Computing %d forward and reverse slices of %d production iterations..."
+                    % (nslices, u_n.size - nequil))
+        convergence = estimate_convergence(u_kln, u_n, nequil, nslices=nslices, nprocesses=nprocesses,
+                                           iterations=iterations)
+        np.savez(get_convergence_path(source_directory, phase), nequil=nequil, **convergence)
+
+        logger.info("{:>8} {:>25} {:>25}".format('fraction', 'forward DeltaG (kT)', 'reverse DeltaG (kT)'))
+        for i, fraction in enumerate(convergence['fractions']):
+            logger.info("{:8.2f} {:16.3f} +- {:5.3f} {:16.3f} +- {:5.3f}".format(
+                fraction, convergence['forward_DeltaF'][i], convergence['forward_dDeltaF'][i],
+                convergence['reverse_DeltaF'][i], convergence['reverse_dDeltaF'][i]))
+
+        # Accumulate the combined estimate as in analyze().
+        for direction in ['forward', 'reverse']:
+            combined[direction + '_DeltaF'] -= sign * (convergence[direction + '_DeltaF'] + DeltaF_restraints)
+            combined[direction + '_dDeltaF'] += convergence[direction + '_dDeltaF']**2
+
+    for direction in ['forward', 'reverse']:
+        combined[direction + '_dDeltaF'] = np.sqrt(combined[direction + '_dDeltaF'])
+    np.savez(get_convergence_path(source_directory), **combined)
+
+    logger.info("")
+    logger.info("{:>8} {:>25} {:>25}".format('fraction', 'forward DeltaG (kT)', 'reverse DeltaG (kT)'))
+    for i, fraction in enumerate(combined['fractions']):
+        logger.info("{:8.2f} {:16.3f} +- {:5.3f} {:16.3f} +- {:5.3f}".format(
+            fraction, combined['forward_DeltaF'][i], combined['forward_dDeltaF'][i],
+            combined['reverse_DeltaF'][i], combined['reverse_dDeltaF'][i]))
+
+    return combined
 
 
 # ==============================================================================
 # Extract trajectory from NetCDF4 file
 # ==============================================================================
 
+# Maximum size in bytes of the blocks of positions read at once during extraction.
+POSITIONS_BLOCK_BYTES = 256 * 1024**2
+
+# Formats written frame block by frame block through mdtraj.formats writers.
+_STREAMED_FORMATS = frozenset(['.dcd', '.xtc', '.trr', '.nc', '.h5', '.binpos', '.pdb'])
+
+
+class _TrajectoryWriter(object):
+    """Write blocks of frames to a trajectory file in a format supported by mdtraj.
+
+    The formats in _STREAMED_FORMATS are appended to disk as blocks are written;
+    the frames of the other formats are accumulated in memory and saved with
+    mdtraj.Trajectory when the writer is closed.
+
+    """
+
+    def __init__(self, output_path, topology):
+        import mdtraj
+        self._output_path = output_path
+        self._topology = topology
+        self._extension = os.path.splitext(output_path)[1].lower()
+        self._nframes = 0
+        self._frames = []
+        self._file = None
+        if self._extension not in _STREAMED_FORMATS and not hasattr(mdtraj.Trajectory, 'save_' + self._extension[1:]):
+            raise ValueError('Cannot detect format from extension of file {}'.format(output_path))
+
+        # Create output directory
+        output_dir = os.path.dirname(output_path)
+        if output_dir != '' and not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        if self._extension in _STREAMED_FORMATS:
+            self._file = mdtraj.open(output_path, 'w')
+            if self._extension == '.h5':
+                self._file.topology = topology
+
+    def write(self, xyz):
+        """Write a block of frames given as an array (nframes, natoms, 3) in nanometers."""
+        if self._file is None:
+            self._frames.append(xyz)
+        else:
+            import mdtraj
+            xyz = mdtraj.utils.in_units_of(xyz, 'nanometers', self._file.distance_unit)
+            if self._extension == '.pdb':
+                for positions in xyz:
+                    self._file.write(positions, self._topology, modelIndex=self._nframes)
+                    self._nframes += 1
+            else:
+                self._file.write(xyz)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            return
+        import mdtraj
+        trajectory = mdtraj.Trajectory(np.concatenate(self._frames), self._topology)
+        getattr(trajectory, 'save_' + self._extension[1:])(self._output_path)
+
+
+def _as_key(indices):
+    """Return a slice equivalent to the increasing indices if they are evenly spaced."""
+    if len(indices) == 1:
+        return slice(int(indices[0]), int(indices[0]) + 1)
+    steps = np.diff(indices)
+    if steps[0] > 0 and np.all(steps == steps[0]):
+        return slice(int(indices[0]), int(indices[-1]) + 1, int(steps[0]))
+    return indices
+
+
+def _get_extraction_atoms(nc_file, keep_solvent):
+    """
+    Return the topology of the extracted atoms and their key in the positions variable.
+
+    The key is a slice when the extracted atoms are contiguous in the stored
+    positions, so that they can be read with a single hyperslab.
+
+    """
+    from pipeline import _SOLVENT_RESNAMES
+
+    topology = utils.deserialize_topology(nc_file.groups['metadata'].variables['topology'][0])
+    if 'positions_atom_indices' in nc_file.variables:
+        atom_indices = nc_file.variables['positions_atom_indices'][:]
+        topology = topology.subset(atom_indices)
+
+    # Select the atoms before reading the positions.
+    if keep_solvent:
+        return topology, slice(None)
+    selected = np.array([atom.index for atom in topology.atoms
+                         if atom.residue.name not in _SOLVENT_RESNAMES], np.int64)
+    topology = topology.subset(selected)
+    if len(selected) > 1 and np.all(np.diff(selected) == 1):
+        return topology, _as_key(selected)
+    return topology, selected
+
+
 def extract_trajectory(output_path, nc_path, state_index=None, replica_index=None,
                        start_frame=0, end_frame=-1, skip_frame=1, keep_solvent=True,
-                       discard_equilibration=False):
+                       discard_equilibration=False, nprocesses=1):
     """Extract phase trajectory from the NetCDF4 file.
 
+    Only the selected atoms are read from the store, and the frames are read
+    in blocks of at most POSITIONS_BLOCK_BYTES which are written directly to
+    the output file for the formats supported by mdtraj.formats writers.
+
     Parameters
     ----------
     output_path : str
@@ -583,8 +1741,11 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
     keep_solvent : bool, optional
         If False, solvent molecules are ignored (default is True).
     discard_equilibration : bool, optional
-        If True, initial equilibration frames are discarded (see the method
-        pymbar.timeseries.detectEquilibration() for details, default is False).
+        If True, initial equilibration frames are discarded (see the function
+        detect_equilibration() for details, default is False).
+    nprocesses : int, optional
+        Number of processes used to read the segment files of a segmented
+        store in parallel (default is 1).
 
     """
     # Check correct input
@@ -595,71 +1756,157 @@ def extract_trajectory(output_path, nc_path, state_index=None, replica_index=Non
         raise ValueError('Cannot find file {}'.format(nc_path))
 
     # Import simulation data
+    nc_file = storage.open_store(nc_path, nprocesses=nprocesses)
     try:
-        nc_file = netcdf.Dataset(nc_path, 'r')
-
-        # Get dimensions
-        n_iterations = nc_file.variables['positions'].shape[0]
-        n_atoms = nc_file.variables['positions'].shape[2]
-
-        # Determine frames to extract
-        if start_frame <= 0:
-            # TODO yank saves first frame with 0 energy!
-            start_frame = 1
-        if end_frame < 0:
-            end_frame = n_iterations + end_frame + 1
-        frame_indices = range(start_frame, end_frame, skip_frame)
-        if len(frame_indices) == 0:
-            raise ValueError('No frames selected')
-
-        # Discard equilibration samples
-        if discard_equilibration:
-            u_n = extract_u_n(nc_file)[frame_indices]
-            n_equil, g, n_eff = timeseries.detectEquilibration(u_n)
-            logger.info(("Discarding initial {} equilibration samples (leaving {} "
-                         "effectively uncorrelated samples)...").format(n_equil, n_eff))
-            frame_indices = frame_indices[n_equil:-1]
-
-        # Extract state positions
-        positions = np.zeros((len(frame_indices), n_atoms, 3))
-        if state_index is not None:
-            # Deconvolute state indices
-            state_indices = np.zeros(len(frame_indices))
-            for i, iteration in enumerate(frame_indices):
-                replica_indices = nc_file.variables['states'][iteration, :]
-                state_indices[i] = np.where(replica_indices == state_index)[0][0]
-
-            # Extract positions
-            for i, iteration in enumerate(frame_indices):
-                replica_index = state_indices[i]
-                positions[i, :, :] = nc_file.variables['positions'][iteration, replica_index, :, :]
-
-        # Extract replica positions
-        else:
-            positions = nc_file.variables['positions'][:, replica_index, :, :]
+        frame_indices = _select_frames(nc_file, nc_path, start_frame, end_frame, skip_frame,
+                                       discard_equilibration)
 
-        # Extract topology
-        serialized_topology = nc_file.groups['metadata'].variables['topology'][0]
+        # Select atoms from the stored topology
+        topology, atom_key = _get_extraction_atoms(nc_file, keep_solvent)
+        writer = _TrajectoryWriter(output_path, topology)
+
+        # Stream blocks of frames to the output file
+        try:
+            for states, positions in _read_position_blocks(nc_file, frame_indices, atom_key, topology.n_atoms):
+                if state_index is not None:
+                    # Deconvolute state indices
+                    replica_indices = np.argmax(states == state_index, axis=1)
+                else:
+                    replica_indices = replica_index
+                writer.write(positions[np.arange(len(positions)), replica_indices])
+        finally:
+            writer.close()
     finally:
         nc_file.close()
 
-    # Create trajectory object
-    topology = utils.deserialize_topology(serialized_topology)
-    trajectory = mdtraj.Trajectory(positions, topology)
 
-    # Remove solvent
-    if not keep_solvent:
-        trajectory = trajectory.remove_solvent()
+def extract_trajectories(output_path, nc_path, state_indices=None, replica_indices=None,
+                         start_frame=0, end_frame=-1, skip_frame=1, keep_solvent=True,
+                         discard_equilibration=False, nprocesses=1, max_open_files=64):
+    """Extract the trajectories of several states or replicas in a single pass.
+
+    The positions are read once and the frames of all the trajectories are
+    written simultaneously. At most max_open_files trajectory files are open
+    at the same time: if more trajectories are requested, they are extracted
+    in groups of max_open_files, each reading the positions once.
+
+    Parameters
+    ----------
+    output_path : str
+        Path to the trajectory files to be created. Occurrences of '{}' are
+        replaced by the index of the state or replica; if there are none, the
+        index is appended to the file name before the extension. The extension
+        of the file determines the format.
+    nc_path : str
+        Path to the NetCDF4 file containing the trajectory.
+    state_indices : list of int or 'all', optional
+        The indices of the alchemical states for which to extract the
+        trajectories. One and only one between state_indices and replica_indices
+        must be not None (default is None).
+    replica_indices : list of int or 'all', optional
+        The indices of the replicas for which to extract the trajectories. One
+        and only one between state_indices and replica_indices must be not None
+        (default is None).
+    max_open_files : int, optional
+        Maximum number of trajectory files open at the same time (default is 64).
+
+    The other parameters are the same of extract_trajectory().
+
+    Returns
+    -------
+    output_paths : dict
+        output_paths[index] is the path of the trajectory of the state or
+        replica index.
+
+    """
+    # Check correct input
+    if (state_indices is None) == (replica_indices is None):
+        raise ValueError('One and only one between "state_indices" and '
+                         '"replica_indices" must be specified.')
+    if not os.path.isfile(nc_path):
+        raise ValueError('Cannot find file {}'.format(nc_path))
+    if '{}' not in output_path:
+        output_path = '{}{{}}{}'.format(*os.path.splitext(output_path))
 
-    # Detect format
-    extension = os.path.splitext(output_path)[1][1:]  # remove dot
+    nc_file = storage.open_store(nc_path, nprocesses=nprocesses)
     try:
-        save_function = getattr(trajectory, 'save_' + extension)
-    except AttributeError:
-        raise ValueError('Cannot detect format from extension of file {}'.format(output_path))
-
-    # Create output directory and save trajectory
-    output_dir = os.path.dirname(output_path)
-    if output_dir != '' and not os.path.isdir(output_dir):
-        os.makedirs(output_dir)
-    save_function(output_path)
+        indices = state_indices if state_indices is not None else replica_indices
+        if indices == 'all':
+            indices = range(nc_file.variables['positions'].shape[1])
+        output_paths = collections.OrderedDict((index, output_path.format(index)) for index in indices)
+
+        frame_indices = _select_frames(nc_file, nc_path, start_frame, end_frame, skip_frame,
+                                       discard_equilibration)
+        topology, atom_key = _get_extraction_atoms(nc_file, keep_solvent)
+
+        for group_start in range(0, len(output_paths), max_open_files):
+            group = output_paths.keys()[group_start:group_start+max_open_files]
+            writers = []
+            try:
+                for index in group:
+                    writers.append(_TrajectoryWriter(output_paths[index], topology))
+                for states, positions in _read_position_blocks(nc_file, frame_indices, atom_key, topology.n_atoms):
+                    frames = np.arange(len(positions))
+                    for index, writer in zip(group, writers):
+                        if state_indices is not None:
+                            writer.write(positions[frames, np.argmax(states == index, axis=1)])
+                        else:
+                            writer.write(positions[:, index])
+            finally:
+                for writer in writers:
+                    writer.close()
+    finally:
+        nc_file.close()
+
+    return output_paths
+
+
+def _select_frames(nc_file, nc_path, start_frame, end_frame, skip_frame, discard_equilibration):
+    """Return the array of the stored iterations to extract."""
+    if 'positions' not in nc_file.variables:
+        raise ValueError('No trajectory was stored in {} (checkpoint-only '
+                         'storage policy)'.format(nc_path))
+
+    # Get dimensions
+    n_iterations = nc_file.variables['states'].shape[0]
+
+    # Only one iteration every positions_stride has been stored
+    stride = int(getattr(nc_file.variables['positions'], 'stride', 1))
+
+    # Determine frames to extract
+    if start_frame <= 0:
+        # TODO yank saves first frame with 0 energy!
+        start_frame = 1
+    if end_frame < 0:
+        end_frame = n_iterations + end_frame + 1
+    frame_indices = [frame for frame in range(start_frame, end_frame, skip_frame)
+                     if frame % stride == 0]
+    if len(frame_indices) == 0:
+        raise ValueError('No frames selected')
+
+    # Discard equilibration samples
+    if discard_equilibration:
+        u_n = extract_u_n(nc_file)[frame_indices]
+        n_equil, g, n_eff = detect_equilibration(u_n)
+        logger.info(("Discarding initial {} equilibration samples (leaving {} "
+                     "effectively uncorrelated samples)...").format(n_equil, n_eff))
+        frame_indices = frame_indices[n_equil:-1]
+    return np.array(frame_indices, np.int64)
+
+
+def _read_position_blocks(nc_file, frame_indices, atom_key, n_atoms):
+    """
+    Yield the states and the positions of all replicas for blocks of frames.
+
+    All replicas are stored in the same chunk, so they are read together and
+    selected in memory. Each block is at most POSITIONS_BLOCK_BYTES.
+
+    """
+    n_replicas = nc_file.variables['positions'].shape[1]
+    block_size = max(1, POSITIONS_BLOCK_BYTES // (4 * 3 * n_replicas * max(1, n_atoms)))
+    for block_start in range(0, len(frame_indices), block_size):
+        block_frames = frame_indices[block_start:block_start+block_size]
+        frames_key = _as_key(block_frames)
+        states = np.array(nc_file.variables['states'][frames_key], np.int64)
+        positions = nc_file.variables['positions'][frames_key, :, atom_key, :]
+        yield states, np.asarray(positions, np.float32).reshape(len(block_frames), n_replicas, n_atoms, 3)
@@ -0,0 +1,17 @@
+#!/usr/local/bin/env python
+
+"""
+YANK benchmarks.
+
+Reproducible performance benchmarks run by the 'yank benchmark' command. The
+results are returned as JSON-serializable dictionaries that can be saved and
+compared against a baseline to detect performance regressions.
+
+"""
+
+import reports
+import synthetic
+import simulation
+import analysis
+import scaling
+import setup_pipeline
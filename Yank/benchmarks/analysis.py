@@ -0,0 +1,276 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Analysis benchmarks
+===================
+
+Time the analysis entry points on synthetic store files.
+
+Each case writes a synthetic store (see yank.benchmarks.synthetic) and times,
+in a fresh process, the entry points of the offline and online analysis:
+show_mixing_statistics(), estimate_free_energies(), extract_trajectory() and
+the online analysis of ReplicaExchange, both from scratch and with the cache
+of a previous analysis. The free energy estimate is checked against the exact
+free energy of the synthetic model.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+import shutil
+import tempfile
+import collections
+import multiprocessing
+
+from yank.benchmarks import synthetic
+from yank.benchmarks.reports import get_peak_memory, create_report, compare_reports
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# BENCHMARK SUITE
+#=============================================================================================
+
+# Timed entry points, in order of execution.
+ENTRY_POINTS = ['show_mixing_statistics', 'estimate_free_energies', 'extract_trajectory',
+                'online_analysis', 'online_analysis_cached']
+
+# Entries identifying a case.
+CASE_KEYS = ['layout', 'codec', 'energy_store', 'nstates', 'niterations', 'natoms']
+
+# Metrics compared against the baseline, larger is worse.
+COMPARED_METRICS = ENTRY_POINTS + ['peak_memory_mb']
+
+#=============================================================================================
+# BENCHMARKS
+#=============================================================================================
+
+def _time_online_analysis(store_path, energy_store):
+    """Time the online analysis of a ReplicaExchange bound to the store, without and with cache."""
+    import netCDF4 as netcdf
+    from yank import utils
+    from yank.repex import ReplicaExchange
+
+    # Bind a simulation to the store without restoring the thermodynamic states.
+    simulation = ReplicaExchange(store_path)
+    simulation.ncfile = netcdf.Dataset(store_path, 'r')
+    if energy_store:
+        simulation.energy_ncfile = netcdf.Dataset(utils.get_companion_store_path(store_path, 'energies.nc'), 'r')
+    try:
+        timings = dict()
+        for name in ['online_analysis', 'online_analysis_cached']:
+            start_time = time.time()
+            simulation._analysis()
+            timings[name] = time.time() - start_time
+    finally:
+        simulation.ncfile.close()
+        simulation.ncfile = None
+        if simulation.energy_ncfile is not None:
+            simulation.energy_ncfile.close()
+            simulation.energy_ncfile = None
+    return timings
+
+
+def time_analysis(store_path, energy_store=False):
+    """
+    Time the analysis entry points on an existing store in the current process.
+
+    Parameters
+    ----------
+    store_path : str
+       The path of the main store file written by create_synthetic_store().
+    energy_store : bool, optional, default=False
+       Whether the store has an energy store file.
+
+    Returns
+    -------
+    timings : dict
+       The wall-clock time in seconds of each of the ENTRY_POINTS that can be
+       run on the store, the free energy estimate 'DeltaF' between the end
+       states and its error 'DeltaF_error' with respect to the exact value.
+
+    """
+    from yank import analyze, storage, utils
+
+    timings = collections.OrderedDict()
+
+    ncfile = analyze.open_analysis_ncfile(store_path)
+    try:
+        nstates = ncfile.variables['states'].shape[1]
+
+        start_time = time.time()
+        analyze.show_mixing_statistics(ncfile, nequil=1)
+        timings['show_mixing_statistics'] = time.time() - start_time
+
+        start_time = time.time()
+        Deltaf_ij, dDeltaf_ij = analyze.estimate_free_energies(ncfile, ndiscard=1)
+        timings['estimate_free_energies'] = time.time() - start_time
+    finally:
+        ncfile.close()
+
+    timings['DeltaF'] = float(Deltaf_ij[0, nstates-1])
+    timings['DeltaF_error'] = float(Deltaf_ij[0, nstates-1] - synthetic.get_free_energies(nstates)[-1])
+
+    # Extract the trajectory of the first state if positions are stored.
+    nc_file = storage.open_store(store_path)
+    has_positions = 'positions' in nc_file.variables
+    nc_file.close()
+    if has_positions:
+        trajectory_path = utils.get_companion_store_path(store_path, 'state0.dcd')
+        start_time = time.time()
+        analyze.extract_trajectory(trajectory_path, store_path, state_index=0)
+        timings['extract_trajectory'] = time.time() - start_time
+        os.remove(trajectory_path)
+
+    # The online analysis starts from scratch and then reuses its cache.
+    cache_path = analyze.get_analysis_cache_path(store_path)
+    if os.path.exists(cache_path):
+        os.remove(cache_path)
+    timings.update(_time_online_analysis(store_path, energy_store))
+
+    return timings
+
+
+def _time_analysis_job(kwargs):
+    """Time the analysis in a worker, returning the error message instead of raising."""
+    try:
+        timings = time_analysis(**kwargs)
+        timings['peak_memory_mb'] = get_peak_memory()
+        return timings
+    except Exception as e:
+        return dict(error=str(e))
+
+
+def run_analysis_benchmark(niterations=1000, nstates=10, natoms=1000, layout='single', codec='zlib',
+                           energy_store=False, directory=None, pool=None):
+    """
+    Write a synthetic store and time its analysis.
+
+    Parameters
+    ----------
+    niterations, nstates, natoms, layout, codec, energy_store
+       The parameters of the synthetic store (see create_synthetic_store()).
+    directory : str, optional
+       The directory where the store is written and deleted after the
+       benchmark. A temporary directory is used by default.
+    pool : multiprocessing.Pool, optional
+       If specified, the analysis is timed in a worker of the pool, otherwise
+       in the current process.
+
+    Returns
+    -------
+    result : dict
+       The parameters of the case, the size of the store files 'store_mb',
+       the time spent writing the store 'generation' and the timings returned
+       by time_analysis() with the 'peak_memory_mb' of the process timing them.
+       If the analysis fails, the dictionary has an 'error' entry.
+
+    """
+    tmp_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        store_path = os.path.join(tmp_dir, 'synthetic.nc')
+        start_time = time.time()
+        store_files = synthetic.create_synthetic_store(store_path, niterations=niterations, nstates=nstates,
+                                                       natoms=natoms, layout=layout, codec=codec,
+                                                       energy_store=energy_store)
+        generation_time = time.time() - start_time
+
+        result = collections.OrderedDict()
+        result['layout'] = layout
+        result['codec'] = codec
+        result['energy_store'] = energy_store
+        result['nstates'] = nstates
+        result['niterations'] = niterations
+        result['natoms'] = natoms
+        result['store_mb'] = sum(os.path.getsize(path) for path in store_files) / 1024.0**2
+        result['generation'] = generation_time
+
+        kwargs = dict(store_path=store_path, energy_store=energy_store)
+        if pool is not None:
+            result.update(pool.apply(_time_analysis_job, (kwargs,)))
+        else:
+            result.update(_time_analysis_job(kwargs))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return result
+
+
+def run_analysis_benchmarks(nstates_list=(10, 100), niterations=1000, natoms=1000,
+                            layouts=('single', 'segmented'), codecs=('zlib',), energy_store=False,
+                            directory=None):
+    """
+    Run the analysis benchmark for all the combinations of the given parameters.
+
+    The analysis of each case is timed in a separate process.
+
+    Parameters
+    ----------
+    nstates_list : list of int, optional
+       The numbers of states.
+    niterations, natoms, energy_store
+       The parameters of the synthetic stores (see create_synthetic_store()).
+    layouts : list of str, optional
+       The layouts of the stores (see synthetic.LAYOUTS).
+    codecs : list of str, optional
+       The codecs of the positions (see synthetic.CODECS).
+    directory : str, optional
+       The directory where the synthetic stores are temporarily written.
+
+    Returns
+    -------
+    report : dict
+       A JSON-serializable dictionary with the host and software versions and
+       the list of 'results' of run_analysis_benchmark().
+
+    """
+    for layout in layouts:
+        if layout not in synthetic.LAYOUTS:
+            raise ValueError("Unknown layout '{}', choose among {}".format(layout, ', '.join(synthetic.LAYOUTS)))
+    for codec in codecs:
+        if codec not in synthetic.CODECS:
+            raise ValueError("Unknown codec '{}', choose among {}".format(codec, ', '.join(synthetic.CODECS)))
+
+    report = create_report(benchmark='analysis')
+
+    # A fresh worker for each case isolates their memory high-water marks.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for nstates in nstates_list:
+            for layout in layouts:
+                for codec in codecs:
+                    logger.info("Running analysis benchmark with {} iterations, {} states, {} atoms, "
+                                "{} layout, {} codec...".format(niterations, nstates, natoms, layout, codec))
+                    result = run_analysis_benchmark(niterations=niterations, nstates=nstates, natoms=natoms,
+                                                    layout=layout, codec=codec, energy_store=energy_store,
+                                                    directory=directory, pool=pool)
+                    if 'error' in result:
+                        logger.error("Analysis benchmark failed: {}".format(result['error']))
+                    report['results'].append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1):
+    """
+    Find the timings that regressed with respect to a baseline report.
+
+    Returns
+    -------
+    regressions : list of tuple
+       The values of CASE_KEYS of the case followed by the metric, its
+       baseline value and its current value (see reports.compare_reports()).
+
+    """
+    return compare_reports(report, baseline, case_keys=CASE_KEYS, metrics=COMPARED_METRICS,
+                           tolerance=tolerance)
@@ -0,0 +1,104 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Benchmark reports
+=================
+
+Utilities shared by the benchmark suites to describe the host, measure memory
+and compare a report against a saved baseline.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import sys
+import time
+import socket
+import collections
+
+#=============================================================================================
+# REPORTS
+#=============================================================================================
+
+def get_peak_memory():
+    """Return the memory high-water mark of the current process in MB."""
+    import resource
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OSX and in kilobytes on Linux.
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0**2
+    return maxrss / 1024.0
+
+
+def create_report(**kwargs):
+    """Return an empty report with the host and software versions and the given entries."""
+    from yank import version
+
+    report = collections.OrderedDict()
+    report['yank_version'] = version.version
+    report['hostname'] = socket.gethostname()
+    report['date'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    report.update(kwargs)
+    report['results'] = list()
+    return report
+
+
+def compare_reports(report, baseline, case_keys, metrics, tolerance=0.1):
+    """
+    Find the metrics that regressed with respect to a baseline report.
+
+    Parameters
+    ----------
+    report : dict
+       A report whose 'results' are dictionaries.
+    baseline : dict
+       A report saved previously.
+    case_keys : list of str
+       The entries that identify a case in the results.
+    metrics : list of str
+       The entries compared. Larger values are worse.
+    tolerance : float, optional, default=0.1
+       The relative increase over the baseline that is flagged as a regression.
+
+    Returns
+    -------
+    regressions : list of tuple
+       The values of the case_keys of the case followed by the metric, its
+       baseline value and its current value. Failed cases, and cases missing
+       from the baseline, are ignored.
+
+    Examples
+    --------
+    >>> baseline = {'results': [{'n': 1, 'time': 1.0}, {'n': 2, 'time': 2.0}]}
+    >>> report = {'results': [{'n': 1, 'time': 1.05}, {'n': 2, 'time': 3.0}, {'n': 3, 'time': 9.0}]}
+    >>> compare_reports(report, baseline, case_keys=['n'], metrics=['time'])
+    [(2, 'time', 2.0, 3.0)]
+
+    """
+    def get_case(result):
+        return tuple(result.get(key) for key in case_keys)
+
+    baseline_results = {get_case(result): result for result in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        case = get_case(result)
+        if case not in baseline_results:
+            continue
+        baseline_result = baseline_results[case]
+        for metric in metrics:
+            if metric not in result or metric not in baseline_result:
+                continue
+            if result[metric] > baseline_result[metric] * (1.0 + tolerance):
+                regressions.append(case + (metric, baseline_result[metric], result[metric]))
+    return regressions
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,462 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+MPI scaling benchmarks
+======================
+
+Strong and weak scaling of the replica-exchange iteration on a single machine.
+
+Each case runs the alchemical simulation of yank.benchmarks.simulation under
+'mpirun -np NPROCESSES'. The simulation communicates through a
+CountingCommunicator that records the calls, the pickled bytes and the time
+spent in each collective operation, so that the time per iteration and its
+split into phases can be compared with the time each process spends blocked
+waiting for the others and with the volume of the communication.
+
+In strong scaling the number of states is fixed, and the parallel efficiency
+of N processes with respect to 1 is T(1) / (N * T(N)). In weak scaling the
+number of states grows proportionally to the number of processes, and the
+efficiency is T(1) / T(N).
+
+The module is executed by mpirun on every process of a case as
+
+    mpirun -np NPROCESSES python -m yank.benchmarks.scaling CASE_FILE RESULT_FILE
+
+where CASE_FILE is a JSON file with the arguments of run_scaling_case().
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import collections
+import cPickle as pickle
+
+import numpy as np
+
+from yank.benchmarks import simulation
+from yank.benchmarks.reports import get_peak_memory, create_report, compare_reports
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# BENCHMARK SUITE
+#=============================================================================================
+
+# Scaling modes.
+MODES = ['strong', 'weak']
+
+# Default numbers of MPI processes.
+DEFAULT_NPROCESSES = [1, 2, 4, 8]
+
+# Collective operations counted by CountingCommunicator.
+COLLECTIVES = ['bcast', 'scatter', 'gather', 'allgather', 'reduce', 'allreduce', 'barrier']
+
+# Per-iteration phases reported for each case.
+PHASE_NAMES = ['mixing', 'propagation', 'energies', 'storage']
+
+# Entries identifying a case.
+CASE_KEYS = ['mode', 'system', 'nprocesses', 'nstates']
+
+# Metrics compared against the baseline, larger is worse.
+COMPARED_METRICS = ['seconds_per_iteration'] + PHASE_NAMES + ['wait', 'mb_per_iteration', 'peak_memory_mb']
+
+#=============================================================================================
+# COMMUNICATION STATISTICS
+#=============================================================================================
+
+def _pickled_size(obj):
+    """Return the number of bytes of the object pickled as mpi4py does."""
+    return len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+
+class CountingCommunicator(object):
+    """
+    Wrap an mpi4py communicator to count the bytes and the time of the collective operations.
+
+    Only the lowercase, pickle-based collective operations used by YANK are
+    counted. All other attributes are those of the wrapped communicator.
+
+    The bytes are those of the pickled objects sent by this process, that is
+    the object of the root process for bcast and scatter and the object of
+    every process for the other operations. The time of an operation includes
+    the time this process waits for the others to reach it, which dominates
+    when the work of the processes is unbalanced.
+
+    Parameters
+    ----------
+    mpicomm : mpi4py communicator
+       The wrapped communicator.
+
+    Attributes
+    ----------
+    statistics : dict
+       statistics[operation] is a dict with the number of 'calls', the 'bytes'
+       sent and the wall-clock 'seconds' spent in the collective operation.
+
+    """
+
+    def __init__(self, mpicomm):
+        self._mpicomm = mpicomm
+        self.reset()
+
+    def __getattr__(self, name):
+        return getattr(self._mpicomm, name)
+
+    def reset(self):
+        """Set all the statistics to zero."""
+        self.statistics = collections.OrderedDict(
+            (operation, dict(calls=0, bytes=0, seconds=0.0)) for operation in COLLECTIVES)
+
+    def _count(self, operation, nbytes, function, *args, **kwargs):
+        start_time = time.time()
+        result = function(*args, **kwargs)
+        statistics = self.statistics[operation]
+        statistics['seconds'] += time.time() - start_time
+        statistics['calls'] += 1
+        statistics['bytes'] += nbytes
+        return result
+
+    def bcast(self, obj, root=0):
+        nbytes = _pickled_size(obj) if self._mpicomm.rank == root else 0
+        return self._count('bcast', nbytes, self._mpicomm.bcast, obj, root=root)
+
+    def scatter(self, sendobj, root=0):
+        nbytes = _pickled_size(sendobj) if self._mpicomm.rank == root else 0
+        return self._count('scatter', nbytes, self._mpicomm.scatter, sendobj, root=root)
+
+    def gather(self, sendobj, root=0):
+        return self._count('gather', _pickled_size(sendobj), self._mpicomm.gather, sendobj, root=root)
+
+    def allgather(self, sendobj):
+        return self._count('allgather', _pickled_size(sendobj), self._mpicomm.allgather, sendobj)
+
+    def reduce(self, sendobj, *args, **kwargs):
+        return self._count('reduce', _pickled_size(sendobj), self._mpicomm.reduce, sendobj, *args, **kwargs)
+
+    def allreduce(self, sendobj, *args, **kwargs):
+        return self._count('allreduce', _pickled_size(sendobj), self._mpicomm.allreduce, sendobj, *args, **kwargs)
+
+    def barrier(self):
+        return self._count('barrier', 0, self._mpicomm.barrier)
+
+#=============================================================================================
+# BENCHMARKS
+#=============================================================================================
+
+def _read_phase_timings(store_filename, first_iteration):
+    """Return the mean of the phase timings of the iterations from first_iteration on."""
+    import netCDF4 as netcdf
+
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    try:
+        ncgrp_timings = ncfile.groups['timings']
+        timings = dict()
+        for name in ['iteration', 'mixing', 'energies', 'storage', 'analysis']:
+            timings[name] = float(np.mean(ncgrp_timings.variables[name][first_iteration:]))
+    finally:
+        ncfile.close()
+    # Replicas are propagated in parallel, so the propagation takes the rest of the iteration.
+    timings['propagation'] = timings['iteration'] - sum(timings[name] for name in
+                                                        ['mixing', 'energies', 'storage', 'analysis'])
+    return timings
+
+
+def run_scaling_case(store_directory, system_name, nstates, niterations=5, nsteps_per_iteration=500,
+                     platform_name='CPU', nwarmup=1):
+    """
+    Time the iterations of an alchemical replica-exchange simulation on all MPI processes.
+
+    This must be called by every process launched by mpirun. Without mpirun,
+    the simulation runs serially in the current process.
+
+    Parameters
+    ----------
+    store_directory : str
+       An existing directory shared by all processes where the store is written.
+    system_name : str
+       One of the keys of simulation.BENCHMARK_SYSTEMS.
+    nstates : int
+       The number of alchemical states.
+    niterations : int, optional, default=5
+       The number of timed iterations.
+    nsteps_per_iteration : int, optional, default=500
+       The number of integration steps per iteration.
+    platform_name : str, optional, default='CPU'
+       The OpenMM platform.
+    nwarmup : int, optional, default=1
+       The number of iterations run before the timed ones to create the Contexts.
+
+    Returns
+    -------
+    result : dict or None
+       On the root process, the description of the case, the
+       'seconds_per_iteration' with its split into PHASE_NAMES, the mean and
+       maximum over the processes of the seconds per iteration spent in
+       collective operations ('wait' and 'wait_max'), the megabytes sent by
+       all processes per iteration 'mb_per_iteration', the per-iteration
+       statistics of each operation in 'collectives', and the largest
+       'peak_memory_mb' of the processes. None on the other processes.
+
+    """
+    from yank import utils
+    from yank.sampling import ModifiedHamiltonianExchange
+
+    mpicomm = utils.initialize_mpi()
+    rank = mpicomm.rank if mpicomm else 0
+    nprocesses = mpicomm.size if mpicomm else 1
+
+    # The root process creates the store, the others only resume from it.
+    store_filename = os.path.join(store_directory, 'scaling.nc')
+    if rank == 0:
+        reference_state, positions = simulation.create_alchemical_system(system_name)
+        replica_exchange = ModifiedHamiltonianExchange(store_filename)
+        replica_exchange.create(reference_state, simulation.create_alchemical_protocol(nstates), positions)
+        del replica_exchange
+    counting_mpicomm = None
+    if mpicomm:
+        mpicomm.barrier()
+        counting_mpicomm = CountingCommunicator(mpicomm)
+
+    options = dict(platform_name=platform_name, minimize=False, number_of_equilibration_iterations=0,
+                   nsteps_per_iteration=nsteps_per_iteration, number_of_iterations=nwarmup + niterations + 1,
+                   show_energies=False, show_mixing_statistics=False)
+    replica_exchange = ModifiedHamiltonianExchange(store_filename, mpicomm=counting_mpicomm)
+    replica_exchange.resume(options=options)
+    replica_exchange.run(niterations_to_run=nwarmup)
+    first_iteration = replica_exchange.iteration
+
+    if counting_mpicomm:
+        counting_mpicomm.reset()
+    replica_exchange.run(niterations_to_run=niterations)
+    natoms = replica_exchange.natoms
+    del replica_exchange
+
+    # Collect the communication statistics of all processes on the root.
+    if mpicomm:
+        all_statistics = mpicomm.gather((counting_mpicomm.statistics, get_peak_memory()), root=0)
+    else:
+        all_statistics = [(None, get_peak_memory())]
+    if rank != 0:
+        return None
+
+    timings = _read_phase_timings(store_filename, first_iteration)
+
+    result = collections.OrderedDict()
+    result['system'] = system_name
+    result['nprocesses'] = nprocesses
+    result['nstates'] = nstates
+    result['natoms'] = natoms
+    result['niterations'] = niterations
+    result['nsteps_per_iteration'] = nsteps_per_iteration
+    result['seconds_per_iteration'] = timings['iteration']
+    for name in PHASE_NAMES:
+        result[name] = timings[name]
+
+    # Per-iteration communication statistics.
+    collectives = collections.OrderedDict()
+    wait_times = np.zeros(len(all_statistics))
+    for operation in COLLECTIVES:
+        operation_statistics = [process_statistics[operation] for process_statistics, _ in all_statistics
+                                if process_statistics is not None]
+        if len(operation_statistics) == 0 or operation_statistics[0]['calls'] == 0:
+            continue
+        seconds = np.array([s['seconds'] for s in operation_statistics]) / niterations
+        wait_times += seconds
+        collectives[operation] = collections.OrderedDict([
+            ('calls', operation_statistics[0]['calls'] / float(niterations)),
+            ('mb', sum(s['bytes'] for s in operation_statistics) / 1024.0**2 / niterations),
+            ('seconds', float(seconds.mean())),
+            ('seconds_max', float(seconds.max()))
+        ])
+    result['wait'] = float(wait_times.mean())
+    result['wait_max'] = float(wait_times.max())
+    result['mb_per_iteration'] = sum(collective['mb'] for collective in collectives.values())
+    result['collectives'] = collectives
+    result['peak_memory_mb'] = max(peak_memory for _, peak_memory in all_statistics)
+    return result
+
+
+def compute_scaling_efficiency(results, mode):
+    """
+    Compute the speedup and parallel efficiency of the cases with respect to the one with fewest processes.
+
+    Parameters
+    ----------
+    results : list of dict
+       The results of run_scaling_case() for increasing numbers of processes.
+       Failed cases, with an 'error' entry, are skipped.
+    mode : str
+       'strong' if all cases have the same number of states, 'weak' if the
+       number of states is proportional to the number of processes.
+
+    Returns
+    -------
+    results : list of dict
+       The same results with the entries 'speedup' and 'efficiency'. In weak
+       scaling, the speedup is scaled by the size of the problem.
+
+    Examples
+    --------
+    >>> results = [{'nprocesses': 1, 'seconds_per_iteration': 4.0}, {'nprocesses': 2, 'seconds_per_iteration': 2.5}]
+    >>> [result['efficiency'] for result in compute_scaling_efficiency(results, 'strong')]
+    [1.0, 0.8]
+    >>> [result['efficiency'] for result in compute_scaling_efficiency(results, 'weak')]
+    [1.0, 1.6]
+
+    """
+    successful_results = [result for result in results if 'error' not in result]
+    if len(successful_results) == 0:
+        return results
+    reference = min(successful_results, key=lambda result: result['nprocesses'])
+    for result in successful_results:
+        relative_nprocesses = result['nprocesses'] / float(reference['nprocesses'])
+        relative_time = reference['seconds_per_iteration'] / result['seconds_per_iteration']
+        if mode == 'strong':
+            result['speedup'] = relative_time
+            result['efficiency'] = relative_time / relative_nprocesses
+        else:
+            result['speedup'] = relative_time * relative_nprocesses
+            result['efficiency'] = relative_time
+    return results
+
+
+def _run_scaling_case_mpirun(mpirun, nprocesses, case, directory=None):
+    """Run a case of run_scaling_case() under mpirun, returning the error message instead of raising."""
+    tmp_dir = tempfile.mkdtemp(dir=directory)
+    try:
+        case_path = os.path.join(tmp_dir, 'case.json')
+        result_path = os.path.join(tmp_dir, 'result.json')
+        case = dict(case, store_directory=tmp_dir)
+        with open(case_path, 'w') as f:
+            json.dump(case, f)
+
+        command = mpirun.split() + ['-np', str(nprocesses), sys.executable, '-m',
+                                    'yank.benchmarks.scaling', case_path, result_path]
+        returncode = subprocess.call(command)
+        if returncode != 0 or not os.path.exists(result_path):
+            return dict(system=case['system_name'], nprocesses=nprocesses, nstates=case['nstates'],
+                        error="'{}' exited with status {}".format(' '.join(command), returncode))
+        with open(result_path, 'r') as f:
+            return json.load(f, object_pairs_hook=collections.OrderedDict)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def run_scaling_benchmark(system_names=None, nprocesses_list=None, mode='strong', nstates_per_process=4,
+                          niterations=5, nsteps_per_iteration=500, platform_name='CPU', mpirun='mpirun',
+                          directory=None):
+    """
+    Run the scaling benchmark, each number of processes in a separate mpirun.
+
+    Parameters
+    ----------
+    system_names : list of str, optional
+       The benchmark systems to run (default is 'alanine-implicit').
+    nprocesses_list : list of int, optional
+       The numbers of MPI processes (default is DEFAULT_NPROCESSES).
+    mode : str, optional, default='strong'
+       One of MODES. In strong scaling, all cases have nstates_per_process
+       states for each of the largest number of processes; in weak scaling,
+       nstates_per_process states for each process of the case.
+    nstates_per_process : int, optional, default=4
+       The number of alchemical states per process.
+    niterations, nsteps_per_iteration, platform_name
+       See run_scaling_case().
+    mpirun : str, optional, default='mpirun'
+       The command launching the MPI processes, followed by '-np NPROCESSES'.
+    directory : str, optional
+       The directory where the stores are temporarily written. It must be
+       accessible by all processes.
+
+    Returns
+    -------
+    report : dict
+       A JSON-serializable dictionary with the host and software versions and
+       the list of 'results' of run_scaling_case() with the speedup and
+       efficiency computed by compute_scaling_efficiency() for each system.
+       Failed cases have an 'error' entry.
+
+    """
+    import simtk.openmm
+
+    if system_names is None:
+        system_names = ['alanine-implicit']
+    if nprocesses_list is None:
+        nprocesses_list = DEFAULT_NPROCESSES
+    if mode not in MODES:
+        raise ValueError("Unknown scaling mode '{}', choose among {}".format(mode, ', '.join(MODES)))
+    for system_name in system_names:
+        if system_name not in simulation.BENCHMARK_SYSTEMS:
+            raise ValueError("Unknown benchmark system '{}', choose among {}".format(
+                system_name, ', '.join(simulation.BENCHMARK_SYSTEMS.keys())))
+
+    report = create_report(benchmark='scaling', openmm_version=simtk.openmm.version.version,
+                           platform=platform_name, mode=mode, mpirun=mpirun)
+
+    for system_name in system_names:
+        system_results = list()
+        for nprocesses in sorted(nprocesses_list):
+            if mode == 'strong':
+                nstates = nstates_per_process * max(nprocesses_list)
+            else:
+                nstates = nstates_per_process * nprocesses
+            logger.info("Running {} scaling benchmark {} with {} states on {} processes...".format(
+                mode, system_name, nstates, nprocesses))
+            case = dict(system_name=system_name, nstates=nstates, niterations=niterations,
+                        nsteps_per_iteration=nsteps_per_iteration, platform_name=platform_name)
+            result = _run_scaling_case_mpirun(mpirun, nprocesses, case, directory=directory)
+            if 'error' in result:
+                logger.error("Scaling benchmark {} on {} processes failed: {}".format(
+                    system_name, nprocesses, result['error']))
+            result['mode'] = mode
+            system_results.append(result)
+        report['results'].extend(compute_scaling_efficiency(system_results, mode))
+    return report
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1):
+    """
+    Find the metrics that regressed with respect to a baseline report.
+
+    Returns
+    -------
+    regressions : list of tuple
+       The values of CASE_KEYS of the case followed by the metric, its
+       baseline value and its current value (see reports.compare_reports()).
+
+    """
+    return compare_reports(report, baseline, case_keys=CASE_KEYS, metrics=COMPARED_METRICS,
+                           tolerance=tolerance)
+
+
+def _run_scaling_case_main(case_path, result_path):
+    """Run the case described in a JSON file on this MPI process, the root writes the result."""
+    with open(case_path, 'r') as f:
+        case = json.load(f)
+    # JSON strings are unicode.
+    case = dict((str(key), str(value) if isinstance(value, unicode) else value) for key, value in case.items())
+    result = run_scaling_case(**case)
+    if result is not None:
+        with open(result_path, 'w') as f:
+            json.dump(result, f, indent=2)
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        _run_scaling_case_main(sys.argv[1], sys.argv[2])
+    else:
+        import doctest
+        doctest.testmod()
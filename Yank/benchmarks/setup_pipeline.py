@@ -0,0 +1,354 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Setup pipeline benchmarks
+=========================
+
+Micro-benchmarks of the utilities run by 'yank script' before any simulation.
+
+The geometry utilities of yamlbuild (compute_min_dist(), compute_dist_bound(),
+pack_transformation(), pull_close() and remove_overlap()) are timed on a
+synthetic receptor, a sphere of randomly placed atoms with the density of a
+protein, and a small synthetic ligand placed so that the utility has work to
+do. The combinatorial expansion is timed on synthetic YAML scripts whose
+experiments expand to the requested number of combinations.
+
+Every case runs in a fresh process, which reports the time of the call and
+the increase of the memory high-water mark of the process during the call.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import time
+import collections
+import multiprocessing
+
+import numpy as np
+
+from yank.benchmarks.reports import get_peak_memory, create_report, compare_reports
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# BENCHMARK SUITE
+#=============================================================================================
+
+# Timed geometry utilities of yamlbuild.
+GEOMETRY_FUNCTIONS = ['compute_min_dist', 'compute_dist_bound', 'pack_transformation',
+                      'pull_close', 'remove_overlap']
+
+# Timed steps of the combinatorial expansion of a YAML script.
+SCRIPT_FUNCTIONS = ['parse', 'expand_experiments', 'iterate_tree']
+
+# Default numbers of atoms of the synthetic receptors.
+DEFAULT_NATOMS = [1000, 10000, 200000]
+
+# Default numbers of combinations of the synthetic scripts.
+DEFAULT_NCOMBINATIONS = [10, 1000, 100000]
+
+# Number of atoms of the synthetic ligand.
+LIGAND_NATOMS = 50
+
+# Atom density of the synthetic molecules in atoms/A^3, close to the one of proteins.
+ATOM_DENSITY = 0.1
+
+# Entries identifying a case.
+CASE_KEYS = ['function', 'size']
+
+# Metrics compared against the baseline, larger is worse.
+COMPARED_METRICS = ['seconds', 'peak_memory_mb']
+
+#=============================================================================================
+# SYNTHETIC INPUTS
+#=============================================================================================
+
+def create_synthetic_molecule(natoms, center=(0.0, 0.0, 0.0), seed=0):
+    """
+    Place atoms uniformly at random in a sphere with the density of a protein.
+
+    Parameters
+    ----------
+    natoms : int
+       The number of atoms.
+    center : array-like, optional
+       The center of the sphere in Angstroms.
+    seed : int, optional, default=0
+       The seed of the random number generator.
+
+    Returns
+    -------
+    positions : numpy.ndarray
+       The natoms x 3 positions in Angstroms.
+
+    Examples
+    --------
+    >>> positions = create_synthetic_molecule(100, center=[10.0, 0.0, 0.0])
+    >>> positions.shape
+    (100, 3)
+    >>> bool(np.linalg.norm(positions - [10.0, 0.0, 0.0], axis=1).max() <= get_molecule_radius(100))
+    True
+
+    """
+    random_state = np.random.RandomState(seed)
+    radius = get_molecule_radius(natoms)
+    # Uniform sampling of the sphere volume.
+    directions = random_state.randn(natoms, 3)
+    directions /= np.linalg.norm(directions, axis=1)[:, np.newaxis]
+    distances = radius * random_state.random_sample(natoms)**(1.0/3.0)
+    return directions * distances[:, np.newaxis] + np.array(center, dtype=np.float64)
+
+
+def get_molecule_radius(natoms):
+    """Return the radius in Angstroms of a synthetic molecule with natoms atoms."""
+    return (3.0 * natoms / (4.0 * np.pi * ATOM_DENSITY))**(1.0/3.0)
+
+
+def create_synthetic_script(ncombinations, output_dir='output'):
+    """
+    Create a YAML script whose experiments expand to the given number of combinations.
+
+    The ligand is a combinatorial molecule with up to 100 SMILES strings, which
+    expands into combinatorial systems, and the remaining combinations come
+    from a combinatorial experiment option.
+
+    Parameters
+    ----------
+    ncombinations : int
+       The number of experiments of the script. If it is larger than 100,
+       it is rounded to a multiple of 100.
+    output_dir : str, optional, default='output'
+       The output directory of the script.
+
+    Returns
+    -------
+    script : str
+       The YAML script.
+
+    """
+    import yaml
+    from yank import utils
+    from yank.yamlbuild import YankDumper
+
+    nligands = min(ncombinations, 100)
+    noptions = max(ncombinations // nligands, 1)
+
+    lambdas = [1.0, 0.5, 0.0]
+    alchemical_path = {'lambda_electrostatics': lambdas, 'lambda_sterics': lambdas}
+    experiment = {'system': 'complex', 'protocol': 'absolute-binding'}
+    if noptions > 1:
+        experiment['options'] = {'number_of_iterations': utils.CombinatorialLeaf(range(1, noptions + 1))}
+
+    script = {
+        'options': {'output_dir': output_dir},
+        'molecules': {
+            'receptor': {'smiles': 'c1ccccc1'},
+            'ligand': {'smiles': utils.CombinatorialLeaf(['C' * (i + 1) for i in range(nligands)])}
+        },
+        'solvents': {'vacuum': {'nonbonded_method': 'NoCutoff'}},
+        'systems': {'complex': {'receptor': 'receptor', 'ligand': 'ligand', 'solvent': 'vacuum'}},
+        'protocols': {'absolute-binding': {'complex': {'alchemical_path': alchemical_path},
+                                           'solvent': {'alchemical_path': alchemical_path}}},
+        'experiments': experiment
+    }
+    return yaml.dump(script, Dumper=YankDumper)
+
+#=============================================================================================
+# BENCHMARKS
+#=============================================================================================
+
+def _get_geometry_function(function_name, natoms):
+    """Return the function of yamlbuild with its arguments on a synthetic receptor of natoms atoms."""
+    from yank import yamlbuild
+
+    receptor = create_synthetic_molecule(natoms)
+    receptor_radius = get_molecule_radius(natoms)
+    ligand_radius = get_molecule_radius(LIGAND_NATOMS)
+    min_distance = yamlbuild.SetupDatabase.CLASH_THRESHOLD
+
+    if function_name == 'compute_min_dist':
+        ligand = create_synthetic_molecule(LIGAND_NATOMS, center=[receptor_radius + 5.0, 0.0, 0.0], seed=1)
+        return yamlbuild.compute_min_dist, (ligand, receptor), {}
+    elif function_name == 'compute_dist_bound':
+        ligand = create_synthetic_molecule(LIGAND_NATOMS, center=[receptor_radius + 5.0, 0.0, 0.0], seed=1)
+        return yamlbuild.compute_dist_bound, (receptor, ligand), {}
+    elif function_name == 'pack_transformation':
+        # The ligand is at the center of the receptor and must be moved to the surface.
+        ligand = create_synthetic_molecule(LIGAND_NATOMS, seed=1)
+        return yamlbuild.pack_transformation, (receptor, ligand, min_distance, 10.0), {}
+    elif function_name == 'pull_close':
+        # The ligand is far from the receptor and must be pulled close.
+        ligand = create_synthetic_molecule(LIGAND_NATOMS, center=[receptor_radius + 30.0, 0.0, 0.0], seed=1)
+        return yamlbuild.pull_close, (receptor, ligand, min_distance, 5.0), {}
+    elif function_name == 'remove_overlap':
+        # The ligand partially overlaps the surface of the receptor.
+        ligand = create_synthetic_molecule(LIGAND_NATOMS, center=[receptor_radius + ligand_radius / 2.0, 0.0, 0.0],
+                                           seed=1)
+        return yamlbuild.remove_overlap, (ligand, receptor), dict(min_distance=min_distance, sigma=2.0)
+    raise ValueError("Unknown geometry function '{}', choose among {}".format(
+        function_name, ', '.join(GEOMETRY_FUNCTIONS)))
+
+
+def _get_script_function(function_name, ncombinations):
+    """Return the step of the expansion of a synthetic script with its arguments."""
+    import tempfile
+    from yank.yamlbuild import YamlBuilder
+
+    script = create_synthetic_script(ncombinations, output_dir=tempfile.gettempdir())
+    if function_name == 'parse':
+        return YamlBuilder().parse, (script,), {}
+
+    yaml_builder = YamlBuilder(script)
+    if function_name == 'expand_experiments':
+        return lambda: list(yaml_builder._expand_experiments()), (), {}
+    elif function_name == 'iterate_tree':
+        experiment = yaml_builder._experiments['experiments']
+        return lambda: list(experiment), (), {}
+    raise ValueError("Unknown script function '{}', choose among {}".format(
+        function_name, ', '.join(SCRIPT_FUNCTIONS)))
+
+
+def time_setup_function(function_name, size, nrepeats=3):
+    """
+    Time a utility of the setup pipeline in the current process.
+
+    Parameters
+    ----------
+    function_name : str
+       One of GEOMETRY_FUNCTIONS or SCRIPT_FUNCTIONS.
+    size : int
+       The number of atoms of the synthetic receptor for GEOMETRY_FUNCTIONS,
+       or the number of combinations of the synthetic script for
+       SCRIPT_FUNCTIONS.
+    nrepeats : int, optional, default=3
+       The number of calls. The random number generator is reseeded before
+       each call, so that the calls do the same work.
+
+    Returns
+    -------
+    timings : dict
+       The minimum wall-clock time of the calls 'seconds', the increase of
+       the memory high-water mark of the process during the calls
+       'memory_mb', and the 'peak_memory_mb' of the process.
+
+    """
+    if function_name in GEOMETRY_FUNCTIONS:
+        function, args, kwargs = _get_geometry_function(function_name, size)
+    else:
+        function, args, kwargs = _get_script_function(function_name, size)
+
+    initial_peak_memory = get_peak_memory()
+    elapsed_times = []
+    for _ in range(nrepeats):
+        np.random.seed(0)
+        start_time = time.time()
+        function(*args, **kwargs)
+        elapsed_times.append(time.time() - start_time)
+    peak_memory = get_peak_memory()
+
+    timings = collections.OrderedDict()
+    timings['seconds'] = min(elapsed_times)
+    timings['memory_mb'] = peak_memory - initial_peak_memory
+    timings['peak_memory_mb'] = peak_memory
+    return timings
+
+
+def _time_setup_function_job(kwargs):
+    """Time a setup utility in a worker, returning the error message instead of raising."""
+    try:
+        return time_setup_function(**kwargs)
+    except Exception as e:
+        return dict(error=str(e))
+
+
+def run_setup_benchmarks(natoms_list=None, ncombinations_list=None, geometry_functions=None,
+                         script_functions=None, nrepeats=3):
+    """
+    Run the setup pipeline benchmarks, each case in a separate process.
+
+    Parameters
+    ----------
+    natoms_list : list of int, optional
+       The numbers of atoms of the synthetic receptors (default is DEFAULT_NATOMS).
+    ncombinations_list : list of int, optional
+       The numbers of combinations of the synthetic scripts (default is
+       DEFAULT_NCOMBINATIONS).
+    geometry_functions : list of str, optional
+       The geometry utilities timed (default is GEOMETRY_FUNCTIONS).
+    script_functions : list of str, optional
+       The steps of the script expansion timed (default is SCRIPT_FUNCTIONS).
+    nrepeats : int, optional, default=3
+       The number of calls of the geometry utilities. The script expansion is
+       timed once.
+
+    Returns
+    -------
+    report : dict
+       A JSON-serializable dictionary with the host and software versions and
+       the list of 'results', each with the 'function', its 'size' and the
+       timings returned by time_setup_function(). Failed cases have an
+       'error' entry.
+
+    """
+    if natoms_list is None:
+        natoms_list = DEFAULT_NATOMS
+    if ncombinations_list is None:
+        ncombinations_list = DEFAULT_NCOMBINATIONS
+    if geometry_functions is None:
+        geometry_functions = GEOMETRY_FUNCTIONS
+    if script_functions is None:
+        script_functions = SCRIPT_FUNCTIONS
+    for function_name in list(geometry_functions) + list(script_functions):
+        if function_name not in GEOMETRY_FUNCTIONS + SCRIPT_FUNCTIONS:
+            raise ValueError("Unknown setup function '{}', choose among {}".format(
+                function_name, ', '.join(GEOMETRY_FUNCTIONS + SCRIPT_FUNCTIONS)))
+
+    report = create_report(benchmark='setup', ligand_natoms=LIGAND_NATOMS)
+
+    cases = [(function_name, natoms, nrepeats) for function_name in geometry_functions
+             for natoms in natoms_list]
+    cases += [(function_name, ncombinations, 1) for function_name in script_functions
+              for ncombinations in ncombinations_list]
+
+    # A fresh worker for each case isolates their memory high-water marks.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for function_name, size, case_nrepeats in cases:
+            logger.info("Timing {} of size {}...".format(function_name, size))
+            result = collections.OrderedDict([('function', function_name), ('size', size)])
+            kwargs = dict(function_name=function_name, size=size, nrepeats=case_nrepeats)
+            result.update(pool.apply(_time_setup_function_job, (kwargs,)))
+            if 'error' in result:
+                logger.error("Setup benchmark {} of size {} failed: {}".format(function_name, size,
+                                                                             result['error']))
+            report['results'].append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1):
+    """
+    Find the metrics that regressed with respect to a baseline report.
+
+    Returns
+    -------
+    regressions : list of tuple
+       The values of CASE_KEYS of the case followed by the metric, its
+       baseline value and its current value (see reports.compare_reports()).
+
+    """
+    return compare_reports(report, baseline, case_keys=CASE_KEYS, metrics=COMPARED_METRICS,
+                           tolerance=tolerance)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,317 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Simulation benchmarks
+=====================
+
+End-to-end throughput of the alchemical replica-exchange iteration.
+
+Each benchmark case builds an openmmtools test system, alchemically modifies
+its first residue, and runs a fixed number of iterations of
+ModifiedHamiltonianExchange with an alchemical protocol of the requested
+number of states. The time per iteration is split into mixing, propagation,
+energy computation and storage as recorded in the 'timings' group of the
+store file, and the memory high-water mark of the process running the case
+is reported as well.
+
+Every case runs in a fresh process so that the memory high-water marks of
+different cases do not contaminate each other.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+import shutil
+import tempfile
+import collections
+import multiprocessing
+
+import numpy as np
+
+from yank.benchmarks.reports import get_peak_memory, create_report, compare_reports
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# BENCHMARK SUITE
+#=============================================================================================
+
+# Name of the benchmark system -> name of the openmmtools.testsystems class.
+BENCHMARK_SYSTEMS = collections.OrderedDict([
+    ('alanine-implicit', 'AlanineDipeptideImplicit'),
+    ('alanine-explicit', 'AlanineDipeptideExplicit'),
+    ('src-implicit', 'SrcImplicit'),
+    ('src-explicit', 'SrcExplicit'),
+])
+
+# Default numbers of alchemical states of the protocols.
+DEFAULT_NSTATES = [10, 100]
+
+# Per-iteration timings reported for each case, as named in the store timings group.
+TIMING_NAMES = ['mixing', 'propagation', 'energies', 'storage']
+
+# Metrics compared against the baseline, larger is worse.
+COMPARED_METRICS = ['seconds_per_iteration'] + TIMING_NAMES + ['peak_memory_mb']
+
+#=============================================================================================
+# UTILITY FUNCTIONS
+#=============================================================================================
+
+def create_alchemical_protocol(nstates):
+    """
+    Create a protocol that turns off electrostatics and then sterics.
+
+    Parameters
+    ----------
+    nstates : int
+       The number of alchemical states (at least 3).
+
+    Returns
+    -------
+    alchemical_states : list of AlchemicalState
+       The states, starting from the fully interacting one.
+
+    """
+    from alchemy import AlchemicalState
+
+    # Split the states between the electrostatics and sterics legs.
+    nelectrostatics = nstates // 2
+    nsterics = nstates - nelectrostatics
+    lambda_electrostatics = np.concatenate([np.linspace(1.0, 0.0, nelectrostatics + 1)[:-1],
+                                            np.zeros(nsterics)])
+    lambda_sterics = np.concatenate([np.ones(nelectrostatics), np.linspace(1.0, 0.0, nsterics)])
+
+    alchemical_states = list()
+    for electrostatics, sterics in zip(lambda_electrostatics, lambda_sterics):
+        alchemical_state = AlchemicalState()
+        alchemical_state['lambda_electrostatics'] = float(electrostatics)
+        alchemical_state['lambda_sterics'] = float(sterics)
+        alchemical_states.append(alchemical_state)
+    return alchemical_states
+
+
+def create_alchemical_system(system_name):
+    """
+    Alchemically modify the first residue of a benchmark system.
+
+    Parameters
+    ----------
+    system_name : str
+       One of the keys of BENCHMARK_SYSTEMS.
+
+    Returns
+    -------
+    reference_state : ThermodynamicState
+       The state of the alchemically modified system at 298 K.
+    positions : simtk.unit.Quantity
+       The initial positions of the test system.
+
+    """
+    from openmmtools import testsystems
+    from simtk import unit
+    from alchemy import AbsoluteAlchemicalFactory
+    from yank.repex import ThermodynamicState
+
+    testsystem = getattr(testsystems, BENCHMARK_SYSTEMS[system_name])()
+    first_residue = next(testsystem.topology.residues())
+    ligand_atoms = [atom.index for atom in first_residue.atoms()]
+    factory = AbsoluteAlchemicalFactory(testsystem.system, ligand_atoms=ligand_atoms)
+    reference_state = ThermodynamicState(testsystem.system, temperature=298.0*unit.kelvin)
+    reference_state.system = factory.alchemically_modified_system
+    return reference_state, testsystem.positions
+
+
+def _read_iteration_timings(store_filename, nwarmup):
+    """Return the mean of the timings of the iterations after the first nwarmup."""
+    import netCDF4 as netcdf
+
+    ncfile = netcdf.Dataset(store_filename, 'r')
+    try:
+        ncgrp_timings = ncfile.groups['timings']
+        # Iteration 0 is written by the initialization and it is not timed.
+        first_iteration = 1 + nwarmup
+        timings = dict()
+        for name in ['iteration', 'mixing', 'energies', 'storage']:
+            timings[name] = float(np.mean(ncgrp_timings.variables[name][first_iteration:]))
+        # Replicas are propagated serially, so the propagation time is their sum.
+        propagate = ncgrp_timings.variables['propagate'][first_iteration:]
+        timings['propagation'] = float(np.mean(np.sum(propagate, axis=1)))
+    finally:
+        ncfile.close()
+    return timings
+
+#=============================================================================================
+# BENCHMARKS
+#=============================================================================================
+
+def run_simulation_benchmark(system_name, nstates, niterations=5, nsteps_per_iteration=500,
+                             platform_name='CPU', nwarmup=1):
+    """
+    Time the iterations of an alchemical replica-exchange simulation.
+
+    The case runs in the current process. Use run_benchmarks() to run each
+    case in a separate process.
+
+    Parameters
+    ----------
+    system_name : str
+       One of the keys of BENCHMARK_SYSTEMS.
+    nstates : int
+       The number of alchemical states.
+    niterations : int, optional, default=5
+       The number of timed iterations.
+    nsteps_per_iteration : int, optional, default=500
+       The number of integration steps per iteration.
+    platform_name : str, optional, default='CPU'
+       The OpenMM platform.
+    nwarmup : int, optional, default=1
+       The number of iterations run before the timed ones to create the Contexts.
+
+    Returns
+    -------
+    result : dict
+       The description of the case, the 'seconds_per_iteration' with its split
+       into TIMING_NAMES, and the 'peak_memory_mb' of the process.
+
+    """
+    from yank.sampling import ModifiedHamiltonianExchange
+
+    reference_state, positions = create_alchemical_system(system_name)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'benchmark.nc')
+        simulation = ModifiedHamiltonianExchange(store_filename)
+        options = dict(platform_name=platform_name, minimize=False, number_of_equilibration_iterations=0,
+                       nsteps_per_iteration=nsteps_per_iteration,
+                       number_of_iterations=nwarmup + niterations + 1,
+                       show_energies=False, show_mixing_statistics=False)
+        simulation.create(reference_state, create_alchemical_protocol(nstates), positions, options=options)
+
+        start_time = time.time()
+        simulation.run()
+        elapsed_time = time.time() - start_time
+        del simulation
+
+        timings = _read_iteration_timings(store_filename, nwarmup)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    result = collections.OrderedDict()
+    result['system'] = system_name
+    result['nstates'] = nstates
+    result['natoms'] = reference_state.system.getNumParticles()
+    result['niterations'] = niterations
+    result['nsteps_per_iteration'] = nsteps_per_iteration
+    result['seconds_per_iteration'] = timings['iteration']
+    for name in TIMING_NAMES:
+        result[name] = timings[name]
+    result['wall_time'] = elapsed_time
+    result['peak_memory_mb'] = get_peak_memory()
+    return result
+
+
+def _run_simulation_benchmark_job(kwargs):
+    """Run a benchmark case in a worker, returning the error message instead of raising."""
+    try:
+        return run_simulation_benchmark(**kwargs)
+    except Exception as e:
+        return dict(system=kwargs['system_name'], nstates=kwargs['nstates'], error=str(e))
+
+
+def run_benchmarks(system_names=None, nstates_list=None, niterations=5, nsteps_per_iteration=500,
+                   platform_name='CPU'):
+    """
+    Run the simulation benchmark suite, each case in a separate process.
+
+    Parameters
+    ----------
+    system_names : list of str, optional
+       The benchmark systems to run (default is all BENCHMARK_SYSTEMS).
+    nstates_list : list of int, optional
+       The numbers of alchemical states to run for each system (default is
+       DEFAULT_NSTATES).
+    niterations, nsteps_per_iteration, platform_name
+       See run_simulation_benchmark().
+
+    Returns
+    -------
+    report : dict
+       A JSON-serializable dictionary with the host and software versions and
+       the list of 'results' of the cases. Failed cases have an 'error' entry.
+
+    """
+    import simtk.openmm
+
+    if system_names is None:
+        system_names = list(BENCHMARK_SYSTEMS.keys())
+    if nstates_list is None:
+        nstates_list = DEFAULT_NSTATES
+    for system_name in system_names:
+        if system_name not in BENCHMARK_SYSTEMS:
+            raise ValueError("Unknown benchmark system '{}', choose among {}".format(
+                system_name, ', '.join(BENCHMARK_SYSTEMS.keys())))
+
+    report = create_report(benchmark='simulation', openmm_version=simtk.openmm.version.version,
+                           platform=platform_name)
+
+    # A fresh worker for each case isolates their memory high-water marks.
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    try:
+        for system_name in system_names:
+            for nstates in nstates_list:
+                logger.info("Running benchmark {} with {} states...".format(system_name, nstates))
+                kwargs = dict(system_name=system_name, nstates=nstates, niterations=niterations,
+                              nsteps_per_iteration=nsteps_per_iteration, platform_name=platform_name)
+                result = pool.apply(_run_simulation_benchmark_job, (kwargs,))
+                if 'error' in result:
+                    logger.error("Benchmark {} with {} states failed: {}".format(system_name, nstates,
+                                                                              result['error']))
+                report['results'].append(result)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+
+def compare_benchmarks(report, baseline, tolerance=0.1):
+    """
+    Find the metrics that regressed with respect to a baseline report.
+
+    Parameters
+    ----------
+    report : dict
+       The report returned by run_benchmarks().
+    baseline : dict
+       A report saved previously.
+    tolerance : float, optional, default=0.1
+       The relative increase over the baseline that is flagged as a regression.
+
+    Returns
+    -------
+    regressions : list of (str, int, str, float, float)
+       The (system, nstates, metric, baseline_value, value) of the regressions.
+
+    Examples
+    --------
+    >>> baseline = {'results': [{'system': 'alanine-implicit', 'nstates': 10, 'seconds_per_iteration': 1.0}]}
+    >>> report = {'results': [{'system': 'alanine-implicit', 'nstates': 10, 'seconds_per_iteration': 1.5}]}
+    >>> compare_benchmarks(report, baseline)
+    [('alanine-implicit', 10, 'seconds_per_iteration', 1.0, 1.5)]
+
+    """
+    return compare_reports(report, baseline, case_keys=['system', 'nstates'],
+                           metrics=COMPARED_METRICS, tolerance=tolerance)
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,359 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Synthetic stores
+================
+
+Generate synthetic YANK store files of arbitrary size without running a simulation.
+
+The files have the layout, dimensions, chunking and units written by
+ReplicaExchange, so that every analysis entry point can read them, but their
+content is drawn from a model with an analytical solution: state l is a 3D
+harmonic oscillator with spring constant K_l (in kT/nm^2) spanning one order
+of magnitude along the protocol, replicas are exchanged between neighboring
+states, and atoms fluctuate around random reference positions.
+
+The thermodynamic states are not serialized, so synthetic stores can be
+analyzed but not resumed.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+
+import numpy as np
+import netCDF4 as netcdf
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+# Where the positions are stored: in the main file, in segment files, or nowhere
+# (checkpoint-only storage policy).
+LAYOUTS = ['single', 'segmented', 'no-positions']
+
+# Compression of the positions (ReplicaExchange uses zlib).
+CODECS = ['zlib', 'none']
+
+# Maximum size in bytes of the blocks of iterations generated at once.
+BLOCK_BYTES = 64 * 1024**2
+
+# Number of atoms of the solute, the rest are water molecules.
+_NSOLUTE_ATOMS = 30
+
+# Number density of atoms used to set the box size (atoms/nm^3).
+_ATOM_DENSITY = 100.0
+
+# Standard deviation of the atomic fluctuations around the reference positions (nm).
+_POSITIONS_SIGMA = 0.05
+
+#=============================================================================================
+# SYNTHETIC MODEL
+#=============================================================================================
+
+def get_spring_constants(nstates):
+    """Return the spring constants (in kT/nm^2) of the harmonic oscillator states."""
+    if nstates == 1:
+        return np.ones(1)
+    return 10.0**(np.arange(nstates) / float(nstates - 1))
+
+
+def get_free_energies(nstates):
+    """
+    Return the exact reduced free energies of the states relative to the first one.
+
+    Examples
+    --------
+    >>> f_k = get_free_energies(3)
+    >>> print('{:.3f}'.format(f_k[-1]))
+    3.454
+
+    """
+    K_k = get_spring_constants(nstates)
+    f_k = 1.5 * np.log(K_k / (2.0 * np.pi))
+    return f_k - f_k[0]
+
+
+def create_synthetic_topology(natoms):
+    """Create an mdtraj Topology with a 'MOL' solute followed by water molecules."""
+    import mdtraj
+
+    nwaters = max(0, natoms - _NSOLUTE_ATOMS) // 3
+    nsolute_atoms = natoms - 3*nwaters
+    topology = mdtraj.Topology()
+    chain = topology.add_chain()
+    residue = topology.add_residue('MOL', chain)
+    for atom_index in range(nsolute_atoms):
+        topology.add_atom('C{}'.format(atom_index), mdtraj.element.carbon, residue)
+    for water_index in range(nwaters):
+        residue = topology.add_residue('HOH', chain)
+        oxygen = topology.add_atom('O', mdtraj.element.oxygen, residue)
+        for hydrogen_name in ['H1', 'H2']:
+            topology.add_bond(oxygen, topology.add_atom(hydrogen_name, mdtraj.element.hydrogen, residue))
+    return topology
+
+
+class _SyntheticSampler(object):
+    """Generate blocks of iterations of the synthetic replica-exchange simulation."""
+
+    def __init__(self, nstates, natoms, random_state):
+        self.nstates = nstates
+        self.natoms = natoms
+        self.random_state = random_state
+        self.K_k = get_spring_constants(nstates)
+        self.box_edge = (max(natoms, 1) / _ATOM_DENSITY)**(1.0/3.0)
+        self.reference_positions = random_state.uniform(0.0, self.box_edge, size=(natoms, 3)).astype(np.float32)
+        self.replica_states = np.arange(nstates, dtype=np.int32)
+        self.niterations = 0
+
+    def sample_states(self, niterations):
+        """Return states[iteration,replica] and the proposed and accepted swaps of each iteration."""
+        nstates = self.nstates
+        states = np.zeros([niterations, nstates], np.int32)
+        proposed = np.zeros([niterations, nstates, nstates], np.int32)
+        accepted = np.zeros([niterations, nstates, nstates], np.int32)
+        state_replicas = np.argsort(self.replica_states)
+        for iteration in range(niterations):
+            # Alternate swap attempts between even and odd neighbor pairs.
+            istates = np.arange((self.niterations + iteration) % 2, nstates - 1, 2)
+            proposed[iteration, istates, istates+1] = 1
+            istates = istates[self.random_state.uniform(size=len(istates)) < 0.5]
+            accepted[iteration, istates, istates+1] = 1
+            state_replicas[istates], state_replicas[istates+1] = state_replicas[istates+1], state_replicas[istates].copy()
+            states[iteration, state_replicas] = np.arange(nstates, dtype=np.int32)
+        proposed += proposed.transpose(0, 2, 1)
+        accepted += accepted.transpose(0, 2, 1)
+        self.replica_states = states[-1]
+        self.niterations += niterations
+        return states, proposed, accepted
+
+    def sample_energies(self, states):
+        """Return the reduced energies of replicas drawn from the harmonic oscillators of their states."""
+        r2 = self.random_state.chisquare(3, size=states.shape) / self.K_k[states]
+        return 0.5 * r2[:, :, np.newaxis] * self.K_k[np.newaxis, np.newaxis, :]
+
+    def sample_positions(self, niterations):
+        """Return positions[iteration,replica,atom,spatial] fluctuating around the reference positions."""
+        shape = (niterations, self.nstates, self.natoms, 3)
+        noise = self.random_state.normal(scale=_POSITIONS_SIGMA, size=shape).astype(np.float32)
+        return self.reference_positions + noise
+
+#=============================================================================================
+# STORE GENERATION
+#=============================================================================================
+
+def _create_dimensions(ncfile, nstates, natoms):
+    """Create the dimensions and global attributes of a store file."""
+    ncfile.createDimension('iteration', 0)
+    ncfile.createDimension('replica', nstates)
+    ncfile.createDimension('atom', natoms)
+    ncfile.createDimension('spatial', 3)
+    for attribute_name, value in [('title', 'Synthetic YANK store'), ('application', 'YANK'),
+                                  ('program', 'yank.benchmarks.synthetic'), ('programVersion', 'unknown'),
+                                  ('Conventions', 'YANK'), ('ConventionVersion', '0.1')]:
+        setattr(ncfile, attribute_name, value)
+
+
+def _create_positions_variables(ncfile, nstates, natoms, zlib):
+    """Create the variables of ReplicaExchange._initialize_positions_netcdf()."""
+    ncvar = ncfile.createVariable('box_vectors', 'f4', ('iteration', 'replica', 'spatial', 'spatial'),
+                                  zlib=False, chunksizes=(1, nstates, 3, 3))
+    ncvar.units = 'nm'
+    ncvar = ncfile.createVariable('positions', 'f4', ('iteration', 'replica', 'atom', 'spatial'),
+                                  zlib=zlib, chunksizes=(1, nstates, natoms, 3))
+    ncvar.units = 'nm'
+    ncvar.stride = 1
+
+
+def _create_iteration_variables(ncfile, nstates):
+    """Create the per-iteration variables and timings of ReplicaExchange._initialize_netcdf()."""
+    for variable_name, dtype, dimensions, units in [('states', 'i4', ('iteration', 'replica'), 'none'),
+                                                    ('energies', 'f8', ('iteration', 'replica', 'replica'), 'kT'),
+                                                    ('proposed', 'i4', ('iteration', 'replica', 'replica'), 'none'),
+                                                    ('accepted', 'i4', ('iteration', 'replica', 'replica'), 'none'),
+                                                    ('volumes', 'f8', ('iteration', 'replica'), 'nm**3')]:
+        chunksizes = (1,) + (nstates,) * (len(dimensions) - 1)
+        ncvar = ncfile.createVariable(variable_name, dtype, dimensions, zlib=False, chunksizes=chunksizes)
+        ncvar.units = units
+    ncvar = ncfile.createVariable('timestamp', 'f8', ('iteration',), zlib=False, chunksizes=(1,))
+    ncvar.units = 'seconds since 1970-01-01 00:00:00 UTC'
+
+    ncgrp_timings = ncfile.createGroup('timings')
+    for variable_name in ['iteration', 'mixing', 'energies', 'storage', 'analysis']:
+        ncgrp_timings.createVariable(variable_name, 'f', ('iteration',), zlib=False, chunksizes=(1,))
+    ncgrp_timings.createVariable('propagate', 'f', ('iteration', 'replica'), zlib=False, chunksizes=(1, nstates))
+    ncgrp_timings.ns_per_iteration = 1.0e-3
+
+
+def _store_static_data(ncfile, nstates, niterations, topology):
+    """Store the thermodynamic states, options and metadata needed by the analysis."""
+    ncfile.createDimension('scalar', 1)
+
+    ncgrp = ncfile.createGroup('thermodynamic_states')
+    ncgrp.createVariable('nstates', int).assignValue(nstates)
+    ncvar = ncgrp.createVariable('temperatures', 'f', ('replica',))
+    ncvar.units = 'K'
+    ncvar[:] = 300.0
+
+    ncgrp = ncfile.createGroup('options')
+    ncvar = ncgrp.createVariable('number_of_iterations', int)
+    ncvar.assignValue(niterations)
+    ncvar.type = 'int'
+
+    ncgrp = ncfile.createGroup('metadata')
+    ncvar = ncgrp.createVariable('standard_state_correction', 'f8')
+    ncvar.assignValue(0.0)
+    ncvar.type = 'float'
+    if topology is not None:
+        from yank import utils
+        ncvar = ncgrp.createVariable('topology', str, 'scalar')
+        packed_data = np.empty(1, 'O')
+        packed_data[0] = utils.serialize_topology(topology)
+        ncvar[:] = packed_data
+        ncvar.type = 'str'
+
+
+def create_synthetic_store(store_path, niterations=1000, nstates=10, natoms=1000, layout='single',
+                           codec='zlib', energy_store=False, segment_iterations=1000, seed=0):
+    """
+    Write a synthetic store file with the format of the files written by ReplicaExchange.
+
+    Parameters
+    ----------
+    store_path : str
+       The path of the main NetCDF store file.
+    niterations : int, optional, default=1000
+       The number of iterations, including the initial one.
+    nstates : int, optional, default=10
+       The number of thermodynamic states and replicas.
+    natoms : int, optional, default=1000
+       The number of atoms.
+    layout : str, optional, default='single'
+       One of LAYOUTS.
+    codec : str, optional, default='zlib'
+       The compression of the positions, one of CODECS.
+    energy_store : bool, optional, default=False
+       If True, the states and energies are mirrored in the energy store file.
+    segment_iterations : int, optional, default=1000
+       The number of iterations of each segment file with the 'segmented' layout.
+    seed : int, optional, default=0
+       The seed of the random number generator.
+
+    Returns
+    -------
+    store_files : list of str
+       The paths of all the files written.
+
+    """
+    from yank import storage, utils
+
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout '{}', choose among {}".format(layout, ', '.join(LAYOUTS)))
+    if codec not in CODECS:
+        raise ValueError("Unknown codec '{}', choose among {}".format(codec, ', '.join(CODECS)))
+
+    sampler = _SyntheticSampler(nstates, natoms, np.random.RandomState(seed))
+    topology = create_synthetic_topology(natoms)
+    positions_zlib = codec == 'zlib'
+
+    # Open the main file and the energy store.
+    ncfile = netcdf.Dataset(store_path, 'w', version='NETCDF4')
+    _create_dimensions(ncfile, nstates, natoms)
+    if layout == 'single':
+        _create_positions_variables(ncfile, nstates, natoms, positions_zlib)
+    _create_iteration_variables(ncfile, nstates)
+    _store_static_data(ncfile, nstates, niterations, topology)
+    store_files = [store_path]
+    ncfiles = [ncfile]
+    if energy_store:
+        energy_store_path = utils.get_companion_store_path(store_path, 'energies.nc')
+        energy_ncfile = netcdf.Dataset(energy_store_path, 'w', version='NETCDF4')
+        _create_dimensions(energy_ncfile, nstates, natoms)
+        _create_iteration_variables(energy_ncfile, nstates)
+        _store_static_data(energy_ncfile, nstates, niterations, None)
+        store_files.append(energy_store_path)
+        ncfiles.append(energy_ncfile)
+
+    # Generate blocks of iterations that fit in memory and never straddle two segments.
+    iteration_bytes = nstates * nstates * (8 + 4 + 4)
+    if layout != 'no-positions':
+        iteration_bytes += 4 * nstates * natoms * 3
+    block_niterations = max(1, BLOCK_BYTES // iteration_bytes)
+
+    segments = []
+    segment_ncfile = None
+    box_vectors = np.eye(3, dtype=np.float32) * sampler.box_edge
+    start_time = time.time()
+    try:
+        block_start = 0
+        while block_start < niterations:
+            block_end = min(block_start + block_niterations, niterations)
+            if layout == 'segmented':
+                next_segment_start = (block_start // segment_iterations + 1) * segment_iterations
+                block_end = min(block_end, next_segment_start)
+            block = slice(block_start, block_end)
+            nblock = block_end - block_start
+
+            states, proposed, accepted = sampler.sample_states(nblock)
+            energies = sampler.sample_energies(states)
+            for nc in ncfiles:
+                nc.variables['states'][block] = states
+                nc.variables['energies'][block] = energies
+                nc.variables['proposed'][block] = proposed
+                nc.variables['accepted'][block] = accepted
+                nc.variables['volumes'][block] = np.ones([nblock, nstates]) * sampler.box_edge**3
+                nc.variables['timestamp'][block] = start_time + np.arange(block_start, block_end)
+                ncgrp_timings = nc.groups['timings']
+                for variable_name in ['iteration', 'mixing', 'energies', 'storage', 'analysis']:
+                    ncgrp_timings.variables[variable_name][block] = np.ones(nblock)
+                ncgrp_timings.variables['propagate'][block] = np.ones([nblock, nstates])
+
+            # Write the positions in the main file or in the current segment.
+            if layout == 'single':
+                ncfile.variables['positions'][block] = sampler.sample_positions(nblock)
+                ncfile.variables['box_vectors'][block] = np.tile(box_vectors, (nblock, nstates, 1, 1))
+            elif layout == 'segmented':
+                if block_start % segment_iterations == 0:
+                    if segment_ncfile is not None:
+                        segment_ncfile.close()
+                    segment_path = storage.get_segment_path(store_path, len(segments))
+                    segment_ncfile = netcdf.Dataset(segment_path, 'w', version='NETCDF4')
+                    _create_dimensions(segment_ncfile, nstates, natoms)
+                    segment_ncfile.first_iteration = block_start
+                    _create_positions_variables(segment_ncfile, nstates, natoms, positions_zlib)
+                    segments.append({'file': os.path.basename(segment_path), 'first_iteration': block_start})
+                    store_files.append(segment_path)
+                frames = slice(block_start - segments[-1]['first_iteration'], block_end - segments[-1]['first_iteration'])
+                segment_ncfile.variables['positions'][frames] = sampler.sample_positions(nblock)
+                segment_ncfile.variables['box_vectors'][frames] = np.tile(box_vectors, (nblock, nstates, 1, 1))
+
+            block_start = block_end
+    finally:
+        if segment_ncfile is not None:
+            segment_ncfile.close()
+        for nc in ncfiles:
+            nc.close()
+
+    if layout == 'segmented':
+        storage.write_segment_manifest(store_path, segments)
+        store_files.append(storage.get_manifest_path(store_path))
+
+    logger.debug("Wrote synthetic store {} ({} iterations, {} states, {} atoms) in {:.3f} s".format(
+        store_path, niterations, nstates, natoms, time.time() - start_time))
+    return store_files
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,218 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Catalog
+=======
+
+A small SQLite catalog of the experiments in a YANK output tree.
+
+The catalog ('catalog.sqlite' in the output directory) is updated by
+YamlBuilder when an experiment is set up and by the analysis functions when
+a calculation is analyzed. It records, for each experiment, the system and
+protocol IDs, the number of iterations and the latest free energy estimates,
+and the store files with their modification times, so that the results of a
+large campaign can be queried without opening any store file.
+
+Experiment directories and store paths are stored relative to the directory
+containing the catalog so that the output tree can be moved.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import time
+import sqlite3
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+CATALOG_FILE_NAME = 'catalog.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment TEXT PRIMARY KEY,
+    system_id TEXT,
+    protocol_id TEXT,
+    niterations INTEGER,
+    DeltaF REAL,
+    dDeltaF REAL,
+    DeltaH REAL,
+    dDeltaH REAL,
+    kT REAL,
+    analysis_time REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS stores (
+    store_path TEXT PRIMARY KEY,
+    experiment TEXT,
+    phase TEXT,
+    niterations INTEGER,
+    mtime REAL
+);
+"""
+
+# Columns of the experiments table returned by query().
+EXPERIMENT_COLUMNS = ['experiment', 'system_id', 'protocol_id', 'niterations', 'DeltaF', 'dDeltaF',
+                      'DeltaH', 'dDeltaH', 'kT', 'analysis_time', 'error']
+
+#=============================================================================================
+# CATALOG
+#=============================================================================================
+
+def find_catalog(directory):
+    """Return the path of the catalog in directory or in its closest ancestor, or None."""
+    directory = os.path.abspath(directory)
+    while True:
+        catalog_path = os.path.join(directory, CATALOG_FILE_NAME)
+        if os.path.isfile(catalog_path):
+            return catalog_path
+        parent_directory = os.path.dirname(directory)
+        if parent_directory == directory:
+            return None
+        directory = parent_directory
+
+
+class ResultsCatalog(object):
+    """
+    SQLite catalog of the experiments and results in an output tree.
+
+    Parameters
+    ----------
+    catalog_path : str
+       The path to the SQLite file. It is created if it does not exist.
+
+    Examples
+    --------
+    >>> import tempfile
+    >>> tmp_dir = tempfile.mkdtemp()
+    >>> with ResultsCatalog(os.path.join(tmp_dir, CATALOG_FILE_NAME)) as catalog:
+    ...     catalog.record_experiment(os.path.join(tmp_dir, 'experiments', 'exp0'), 'sys0', 'protocol')
+    ...     catalog.record_results(os.path.join(tmp_dir, 'experiments', 'exp0'), DeltaF=-10.0, dDeltaF=0.5)
+    ...     [experiment['DeltaF'] for experiment in catalog.query()]
+    [-10.0]
+
+    """
+
+    def __init__(self, catalog_path):
+        self._directory = os.path.dirname(os.path.abspath(catalog_path))
+        self._connection = sqlite3.connect(catalog_path, timeout=60.0)
+        self._connection.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Commit the changes and close the catalog."""
+        self._connection.commit()
+        self._connection.close()
+
+    def _relative_path(self, path):
+        return os.path.relpath(os.path.abspath(path), self._directory)
+
+    def record_experiment(self, experiment_dir, system_id=None, protocol_id=None):
+        """Add an experiment to the catalog or update its system and protocol IDs."""
+        experiment = self._relative_path(experiment_dir)
+        with self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO experiments (experiment) VALUES (?)",
+                                     (experiment,))
+            self._connection.execute("UPDATE experiments SET system_id=COALESCE(?, system_id), "
+                                     "protocol_id=COALESCE(?, protocol_id) WHERE experiment=?",
+                                     (system_id, protocol_id, experiment))
+
+    def record_results(self, experiment_dir, DeltaF=None, dDeltaF=None, DeltaH=None, dDeltaH=None,
+                       kT=None, stores=(), error=None):
+        """
+        Record the latest analysis of an experiment.
+
+        Parameters
+        ----------
+        experiment_dir : str
+           The directory of the experiment.
+        DeltaF, dDeltaF, DeltaH, dDeltaH : float, optional
+           Free energy and enthalpy with their uncertainties in kT.
+        kT : float, optional
+           Thermal energy in kcal/mol.
+        stores : list of (str, str, int)
+           The (phase, store_path, niterations) of the phases analyzed. The
+           modification times of the store files are recorded as well.
+        error : str, optional
+           The error message if the analysis failed.
+
+        """
+        experiment = self._relative_path(experiment_dir)
+        niterations = min([store[2] for store in stores]) if len(stores) > 0 else None
+        self.record_experiment(experiment_dir)
+        with self._connection:
+            self._connection.execute("UPDATE experiments SET niterations=?, DeltaF=?, dDeltaF=?, DeltaH=?, "
+                                     "dDeltaH=?, kT=?, analysis_time=?, error=? WHERE experiment=?",
+                                     (niterations, DeltaF, dDeltaF, DeltaH, dDeltaH, kT,
+                                      time.time(), error, experiment))
+            for phase, store_path, store_niterations in stores:
+                self._connection.execute("INSERT OR REPLACE INTO stores VALUES (?, ?, ?, ?, ?)",
+                                         (self._relative_path(store_path), experiment, phase,
+                                          store_niterations, os.path.getmtime(store_path)))
+
+    def query(self, limit=None, include_failed=True):
+        """
+        Return the experiments sorted by increasing free energy.
+
+        Experiments that have not been analyzed yet are listed last.
+
+        Parameters
+        ----------
+        limit : int, optional, default=None
+           If specified, only the first limit experiments are returned.
+        include_failed : bool, optional, default=True
+           If False, the experiments whose last analysis failed are skipped.
+
+        Returns
+        -------
+        experiments : list of dict
+           Dictionaries with the keys in EXPERIMENT_COLUMNS and 'stores', the
+           list of (phase, store_path, niterations, mtime) of the experiment.
+           Paths are relative to the directory containing the catalog.
+
+        """
+        sql = "SELECT {} FROM experiments".format(', '.join(EXPERIMENT_COLUMNS))
+        if not include_failed:
+            sql += " WHERE error IS NULL"
+        sql += " ORDER BY DeltaF IS NULL, DeltaF, experiment"
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+
+        experiments = []
+        for row in self._connection.execute(sql):
+            experiment = dict(zip(EXPERIMENT_COLUMNS, row))
+            experiment['stores'] = self._connection.execute(
+                "SELECT phase, store_path, niterations, mtime FROM stores WHERE experiment=? ORDER BY phase",
+                (experiment['experiment'],)).fetchall()
+            experiments.append(experiment)
+        return experiments
+
+    def get_modified_stores(self):
+        """Return the paths of the catalogued store files modified after the last analysis."""
+        modified = []
+        for store_path, mtime in self._connection.execute("SELECT store_path, mtime FROM stores"):
+            full_path = os.path.join(self._directory, store_path)
+            if not os.path.isfile(full_path) or os.path.getmtime(full_path) != mtime:
+                modified.append(store_path)
+        return modified
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -14,6 +14,7 @@ YANK command-line interface (cli)
 #=============================================================================================
 
 import sys
+import importlib
 import docopt
 
 #=============================================================================================
@@ -29,12 +30,20 @@ Usage:
   yank platforms
   yank prepare binding amber --setupdir=DIRECTORY --ligand=DSLSTRING (-s=STORE | --store=STORE) [-n=NSTEPS | --nsteps=NSTEPS] [-i=NITER | --iterations=NITER] [--equilibrate=NEQUIL] [--restraints <restraint_type>] [--randomize-ligand] [--nbmethod=METHOD] [--cutoff=CUTOFF] [--gbsa=GBSA] [--constraints=CONSTRAINTS] [--temperature=TEMPERATURE] [--pressure=PRESSURE] [--minimize] [-y=FILEPATH | --yaml=FILEPATH] [-v | --verbose]
   yank prepare binding gromacs --setupdir=DIRECTORY --ligand=DSLSTRING (-s=STORE | --store=STORE) [--gromacsinclude=DIRECTORY] [-n=NSTEPS | --nsteps=NSTEPS] [-i=NITER | --iterations=NITER] [--equilibrate=NEQUIL] [--restraints <restraint_type>] [--randomize-ligand] [--nbmethod=METHOD] [--cutoff=CUTOFF] [--gbsa=GBSA] [--constraints=CONSTRAINTS] [--temperature=TEMPERATURE] [--pressure=PRESSURE] [--minimize] [-y=FILEPATH | --yaml=FILEPATH] [-v | --verbose]
-  yank run (-s=STORE | --store=STORE) [-m | --mpi] [-i=NITER | --iterations=NITER] [--platform=PLATFORM] [--precision=PRECISION] [--phase=PHASE] [-o | --online-analysis] [-v | --verbose]
-  yank script (-y=FILEPATH | --yaml=FILEPATH)
-  yank status (-s=STORE | --store=STORE) [-v | --verbose]
-  yank analyze (-s STORE | --store=STORE) [-v | --verbose]
-  yank analyze extract-trajectory --netcdf=FILEPATH (--state=STATE | --replica=REPLICA) --trajectory=FILEPATH [--start=START_FRAME] [--skip=SKIP_FRAME] [--end=END_FRAME] [--nosolvent] [--discardequil] [-v | --verbose]
+  yank run (-s=STORE | --store=STORE) [-m | --mpi] [-i=NITER | --iterations=NITER] [--platform=PLATFORM] [--precision=PRECISION] [--phase=PHASE] [-o | --online-analysis] [--trace=FILEPATH] [--profile [--profile-iterations=RANGE]] [-v | --verbose]
+  yank script (-y=FILEPATH | --yaml=FILEPATH) [--profile [--profile-iterations=RANGE]]
+  yank status (-s=STORE | --store=STORE) [--watch=SECONDS] [-v | --verbose]
+  yank analyze (-s STORE | --store=STORE) [--bootstrap=NBOOTSTRAPS] [--bootstrap-block=BLOCK_SIZE] [--bootstrap-time=SECONDS] [--nprocesses=NPROCESSES] [-v | --verbose]
+  yank analyze batch (-s STORE | --store=STORE) [--output=FILEPATH] [--bootstrap=NBOOTSTRAPS] [--bootstrap-block=BLOCK_SIZE] [--bootstrap-time=SECONDS] [--nprocesses=NPROCESSES] [-v | --verbose]
+  yank analyze convergence (-s STORE | --store=STORE) [--slices=NSLICES] [--nprocesses=NPROCESSES] [-v | --verbose]
+  yank analyze extract-trajectory --netcdf=FILEPATH (--state=STATE | --replica=REPLICA) --trajectory=FILEPATH [--start=START_FRAME] [--skip=SKIP_FRAME] [--end=END_FRAME] [--nosolvent] [--discardequil] [--nprocesses=NPROCESSES] [-v | --verbose]
   yank cleanup (-s=STORE | --store=STORE) [-v | --verbose]
+  yank compact (-s=STORE | --store=STORE) [--stride=STRIDE] [--nosolvent] [--keep-systems] [--force] [--nprocesses=NPROCESSES] [-v | --verbose]
+  yank catalog (-s=STORE | --store=STORE) [--best=NEXPERIMENTS] [--nofailed] [-v | --verbose]
+  yank benchmark [--systems=SYSTEMS] [--states=NSTATES] [-i=NITER | --iterations=NITER] [-n=NSTEPS | --nsteps=NSTEPS] [--platform=PLATFORM] [--output=FILEPATH] [--compare=FILEPATH] [--tolerance=TOLERANCE] [-v | --verbose]
+  yank benchmark analysis [--states=NSTATES] [-i=NITER | --iterations=NITER] [--atoms=NATOMS] [--layouts=LAYOUTS] [--codecs=CODECS] [--energy-store] [--output=FILEPATH] [--compare=FILEPATH] [--tolerance=TOLERANCE] [-v | --verbose]
+  yank benchmark setup [--atoms=NATOMS] [--combinations=NCOMBINATIONS] [--output=FILEPATH] [--compare=FILEPATH] [--tolerance=TOLERANCE] [-v | --verbose]
+  yank benchmark scaling [--systems=SYSTEMS] [--nprocesses=NPROCESSES] [--states-per-process=NSTATES] [--weak] [-i=NITER | --iterations=NITER] [-n=NSTEPS | --nsteps=NSTEPS] [--platform=PLATFORM] [--mpirun=COMMAND] [--output=FILEPATH] [--compare=FILEPATH] [--tolerance=TOLERANCE] [-v | --verbose]
 
 Commands:
   selftest                      Run selftests.
@@ -47,6 +56,12 @@ Commands:
   analyze                       Analyze data
   extract-trajectory            Extract trajectory from a NetCDF file in a common format.
   cleanup                       Clean up (delete) run files.
+  compact                       Rewrite finished store files in a compact form for archival.
+  catalog                       List the experiments in the results catalog of an output directory.
+  benchmark                     Measure the time per iteration of a standard set of alchemical simulations.
+  benchmark analysis            Measure the time of the analysis of synthetic store files.
+  benchmark setup               Measure the time and memory of the geometry and combinatorial utilities of the YAML setup pipeline.
+  benchmark scaling             Measure the strong or weak scaling of the simulations with the number of MPI processes.
 
 General options:
   -h, --help                    Print command line help
@@ -74,6 +89,9 @@ Simulation options:
   --cutoff=CUTOFF               OpenMM nonbonded cutoff (in units of distance) [default: 1*nanometer]
   --constraints=CONSTRAINTS     OpenMM constraints (None, HBonds, AllBonds, HAngles) [default: HBonds]
   --phase=PHASE                 Resume only specified phase of calculation (solvent, complex)
+  --trace=FILEPATH              Record a trace of the simulation hot path and write it in Chrome trace-event JSON format
+  --profile                     Profile the iterations on each MPI rank with cProfile and write the statistics of each rank and a report aggregated over the ranks next to the log file
+  --profile-iterations=RANGE    Profile only the iterations FIRST:LAST (LAST excluded) of each phase
   --temperature=TEMPERATURE     Temperature for simulation (in K, or simtk.unit readable string) [default: 298*kelvin]
   --pressure=PRESSURE           Pressure for simulation (in atm, or simtk.unit readable string) [default: 1*atmospheres]
 
@@ -84,19 +102,57 @@ Amber options:
 Gromacs options:
   --gromacsinclude=DIRECTORY    Include directory for gromacs files [default: /usr/local/gromacs/share/gromacs/top]
 
+Status options:
+  --watch=SECONDS               Print the status of all the phases in the directory tree every SECONDS seconds until interrupted
+
+Analyze options:
+  --bootstrap=NBOOTSTRAPS       Estimate uncertainties from this many bootstrap replicates instead of the MBAR asymptotic estimate
+  --bootstrap-block=BLOCK_SIZE  Number of contiguous uncorrelated samples resampled together in bootstrap replicates [default: 1]
+  --bootstrap-time=SECONDS      Maximum wall time spent computing bootstrap replicates of each phase
+  --output=FILEPATH             Write the results of all the experiments found by batch to this CSV (or .json) file, or the benchmark results to this JSON file
+  --slices=NSLICES              Number of forward and reverse fractions of the production data analyzed by convergence [default: 10]
+
 Extract-trajectory options:
   --netcdf=FILEPATH             Path to the NetCDF file.
-  --state=STATE_IDX             Index of the alchemical state for which to extract the trajectory
-  --replica=REPLICA_IDX         Index of the replica for which to extract the trajectory
-  --trajectory=FILEPATH         Path to the trajectory file to create (extension determines the format)
+  --state=STATE_IDX             Index of the alchemical state for which to extract the trajectory, or 'all'
+  --replica=REPLICA_IDX         Index of the replica for which to extract the trajectory, or 'all'
+  --trajectory=FILEPATH         Path to the trajectory file to create (extension determines the format). With 'all', '{}' is replaced by the index of each state or replica
   --start=START_FRAME           Index of the first frame to keep
   --end=END_FRAME               Index of the last frame to keep
   --skip=SKIP_FRAME             Extract one frame every SKIP_FRAME
   --nosolvent                   Do not extract solvent
   --discardequil                Detect and discard equilibration frames
+  --nprocesses=NPROCESSES       Number of processes used to read segmented store files (or to compact store files, or to compute bootstrap replicates and convergence slices, or to analyze phases in batch) in parallel, or comma-separated numbers of MPI processes of the scaling benchmark
+
+Compact options:
+  --stride=STRIDE               Keep the positions of one stored iteration every STRIDE, or drop all positions if 0 [default: 1]
+  --keep-systems                Keep the serialized Systems needed to resume the calculation
+  --force                       Compact also the stores whose simulation has not finished
+
+Catalog options:
+  --best=NEXPERIMENTS           Show only the experiments with the lowest free energies
+  --nofailed                    Do not show the experiments whose last analysis failed
+
+Benchmark options:
+  --systems=SYSTEMS             Comma-separated benchmark systems (alanine-implicit, alanine-explicit, src-implicit, src-explicit)
+  --states=NSTATES              Comma-separated numbers of alchemical states of the benchmark protocols [default: 10,100]
+  --compare=FILEPATH            Compare the results with a baseline saved with --output and flag regressions
+  --tolerance=TOLERANCE         Relative increase over the baseline flagged as a regression [default: 0.1]
+  --atoms=NATOMS                Number of atoms of the synthetic stores (default is 1000), or comma-separated numbers of atoms of the synthetic receptors of the setup benchmark (default is 1000,10000,200000)
+  --layouts=LAYOUTS             Comma-separated layouts of the synthetic stores (single, segmented, no-positions) [default: single,segmented]
+  --codecs=CODECS               Comma-separated compression codecs of the synthetic positions (zlib, none) [default: zlib]
+  --energy-store                Write the states and energies of the synthetic stores also in an energy store file
+  --combinations=NCOMBINATIONS  Comma-separated numbers of experiments of the synthetic YAML scripts of the setup benchmark [default: 10,1000,100000]
+  --states-per-process=NSTATES  Number of alchemical states per MPI process of the scaling benchmark [default: 4]
+  --weak                        Increase the number of states with the number of MPI processes (weak scaling) instead of keeping it fixed (strong scaling)
+  --mpirun=COMMAND              Command launching the MPI processes of the scaling benchmark [default: mpirun]
 
 """
 
+def _import_command(command):
+    """Import the module of a command, which imports the dependencies of that command only."""
+    return importlib.import_module('yank.commands.' + command)
+
 # TODO: Add optional arguments that we can use to override sys.argv for testing purposes.
 def main(argv=None):
     # Parse command-line arguments.
@@ -105,20 +161,19 @@ def main(argv=None):
     args = docopt(usage, version=version.version, argv=argv)
 
     dispatched = False # Flag set to True if we have correctly dispatched a command.
-    from . import commands # TODO: This would be clearer if we could do 'from yank import commands', but can't figure out how
 
     # Handle simple arguments.
     if args['--help']:
         print usage
         dispatched = True
     if args['--cite']:
-        dispatched = commands.cite.dispatch(args)
+        dispatched = _import_command('cite').dispatch(args)
 
     # Handle commands.
-    command_list = ['selftest', 'platforms', 'prepare', 'run', 'script', 'status', 'analyze', 'cleanup'] # TODO: Build this list automagically by introspection of commands submodule.
+    command_list = ['selftest', 'platforms', 'prepare', 'run', 'script', 'status', 'analyze', 'cleanup', 'compact', 'catalog', 'benchmark'] # TODO: Build this list automagically by introspection of commands submodule.
     for command in command_list:
         if args[command]:
-            dispatched = getattr(commands, command).dispatch(args)
+            dispatched = _import_command(command).dispatch(args)
 
     # If unsuccessful, print usage and exit with an error.
     if not dispatched:
@@ -3,15 +3,8 @@
 """
 YANK cli commands.
 
-"""
+Each command is a submodule with a dispatch(args) function. The submodules
+are imported by cli.main() only when their command is dispatched, so that
+every command imports only the dependencies it needs.
 
-import help
-import cite
-import selftest
-import platforms
-import prepare
-import run
-import script
-import status
-import analyze
-import cleanup
+"""
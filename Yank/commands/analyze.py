@@ -25,8 +25,33 @@ def dispatch(args):
 
     if args['extract-trajectory']:
         return dispatch_extract_trajectory(args)
+    if args['convergence']:
+        return dispatch_convergence(args)
 
-    analyze.analyze(args['--store'])
+    # Get keyword arguments to pass to analyze()
+    kwargs = {}
+    if args['--bootstrap']:
+        kwargs['nbootstraps'] = int(args['--bootstrap'])
+        kwargs['bootstrap_block_size'] = int(args['--bootstrap-block'])
+    if args['--bootstrap-time']:
+        kwargs['bootstrap_time_limit'] = float(args['--bootstrap-time'])
+    if args['--nprocesses']:
+        kwargs['nprocesses'] = int(args['--nprocesses'])
+
+    if args['batch']:
+        analyze.analyze_directory(args['--store'], output_path=args['--output'], **kwargs)
+        return True
+
+    analyze.analyze(args['--store'], **kwargs)
+    return True
+
+
+def dispatch_convergence(args):
+    kwargs = {'nslices': int(args['--slices'])}
+    if args['--nprocesses']:
+        kwargs['nprocesses'] = int(args['--nprocesses'])
+
+    analyze.analyze_convergence(args['--store'], **kwargs)
     return True
 
 
@@ -38,7 +63,13 @@ def dispatch_extract_trajectory(args):
     # Get keyword arguments to pass to extract_trajectory()
     kwargs = {}
 
-    if args['--state']:
+    # Extract the trajectories of all states or replicas in a single pass
+    if args['--state'] == 'all' or args['--replica'] == 'all':
+        if args['--state']:
+            kwargs['state_indices'] = 'all'
+        else:
+            kwargs['replica_indices'] = 'all'
+    elif args['--state']:
         kwargs['state_index'] = int(args['--state'])
     else:
         kwargs['replica_index'] = int(args['--replica'])
@@ -54,8 +85,13 @@ def dispatch_extract_trajectory(args):
         kwargs['keep_solvent'] = False
     if args['--discardequil']:
         kwargs['discard_equilibration'] = True
+    if args['--nprocesses']:
+        kwargs['nprocesses'] = int(args['--nprocesses'])
 
     # Extract trajectory
-    analyze.extract_trajectory(output_path, nc_path, **kwargs)
+    if 'state_indices' in kwargs or 'replica_indices' in kwargs:
+        analyze.extract_trajectories(output_path, nc_path, **kwargs)
+    else:
+        analyze.extract_trajectory(output_path, nc_path, **kwargs)
 
     return True
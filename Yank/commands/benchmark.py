@@ -0,0 +1,175 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Run the YANK performance benchmarks.
+
+"""
+
+#=============================================================================================
+# MODULE IMPORTS
+#=============================================================================================
+
+import sys
+import json
+
+from yank import utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# COMMAND DISPATCH
+#=============================================================================================
+
+def dispatch(args):
+    utils.config_root_logger(args['--verbose'])
+
+    if args['analysis']:
+        report, benchmark_module = dispatch_analysis(args)
+    elif args['setup']:
+        report, benchmark_module = dispatch_setup(args)
+    elif args['scaling']:
+        report, benchmark_module = dispatch_scaling(args)
+    else:
+        report, benchmark_module = dispatch_simulation(args)
+
+    if args['--output']:
+        with open(args['--output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("Benchmark results written to {}".format(args['--output']))
+
+    # Flag regressions with respect to the baseline.
+    if args['--compare']:
+        with open(args['--compare'], 'r') as f:
+            baseline = json.load(f)
+        tolerance = float(args['--tolerance'])
+        regressions = benchmark_module.compare_benchmarks(report, baseline, tolerance=tolerance)
+        for regression in regressions:
+            case = ' '.join(str(value) for value in regression[:-3])
+            metric, baseline_value, value = regression[-3:]
+            logger.error("REGRESSION {}: {} {:.3f} -> {:.3f} (+{:.0%})".format(
+                case, metric, baseline_value, value, value / baseline_value - 1.0))
+        if len(regressions) > 0:
+            sys.exit(1)
+        logger.info("No regressions larger than {:.0%} with respect to {}".format(tolerance, args['--compare']))
+
+    return True
+
+
+def dispatch_simulation(args):
+    from yank.benchmarks import simulation
+
+    system_names = args['--systems'].split(',') if args['--systems'] else None
+    nstates_list = [int(nstates) for nstates in args['--states'].split(',')] if args['--states'] else None
+    niterations = int(args['--iterations']) if args['--iterations'] else 5
+    nsteps_per_iteration = int(args['--nsteps']) if args['--nsteps'] else 500
+    platform_name = args['--platform'] if args['--platform'] not in [None, 'None'] else 'CPU'
+
+    report = simulation.run_benchmarks(system_names=system_names, nstates_list=nstates_list,
+                                       niterations=niterations,
+                                       nsteps_per_iteration=nsteps_per_iteration,
+                                       platform_name=platform_name)
+
+    # Report results.
+    logger.info("{:<20} {:>7} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+        'system', 'states', 'atoms', 's/iter', 'mixing', 'propagate', 'energies', 'storage', 'memory (MB)'))
+    for result in report['results']:
+        if 'error' in result:
+            logger.info("{:<20} {:>7} failed: {}".format(result['system'], result['nstates'], result['error']))
+            continue
+        logger.info("{:<20} {:>7} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.1f}".format(
+            result['system'], result['nstates'], result['natoms'], result['seconds_per_iteration'],
+            result['mixing'], result['propagation'], result['energies'], result['storage'],
+            result['peak_memory_mb']))
+
+    return report, simulation
+
+
+def dispatch_analysis(args):
+    from yank.benchmarks import analysis
+
+    nstates_list = [int(nstates) for nstates in args['--states'].split(',')]
+    niterations = int(args['--iterations']) if args['--iterations'] else 1000
+
+    report = analysis.run_analysis_benchmarks(nstates_list=nstates_list, niterations=niterations,
+                                              natoms=int(args['--atoms']) if args['--atoms'] else 1000,
+                                              layouts=args['--layouts'].split(','),
+                                              codecs=args['--codecs'].split(','),
+                                              energy_store=args['--energy-store'])
+
+    # Report results in seconds.
+    logger.info("{:<12} {:<6} {:>7} {:>10} {:>10} {:>8} {:>8} {:>8} {:>8} {:>8} {:>10}".format(
+        'layout', 'codec', 'states', 'iterations', 'store (MB)', 'mixing', 'mbar', 'extract',
+        'online', 'cached', 'DeltaF err'))
+    for result in report['results']:
+        if 'error' in result:
+            logger.info("{:<12} {:<6} {:>7} failed: {}".format(result['layout'], result['codec'],
+                                                              result['nstates'], result['error']))
+            continue
+        logger.info("{:<12} {:<6} {:>7} {:>10} {:>10.1f} {:>8.3f} {:>8.3f} {:>8} {:>8.3f} {:>8.3f} {:>10.3f}".format(
+            result['layout'], result['codec'], result['nstates'], result['niterations'], result['store_mb'],
+            result['show_mixing_statistics'], result['estimate_free_energies'],
+            '{:.3f}'.format(result['extract_trajectory']) if 'extract_trajectory' in result else '-',
+            result['online_analysis'], result['online_analysis_cached'], result['DeltaF_error']))
+
+    return report, analysis
+
+
+def dispatch_setup(args):
+    from yank.benchmarks import setup_pipeline
+
+    natoms_list = [int(natoms) for natoms in args['--atoms'].split(',')] if args['--atoms'] else None
+    ncombinations_list = [int(n) for n in args['--combinations'].split(',')]
+
+    report = setup_pipeline.run_setup_benchmarks(natoms_list=natoms_list, ncombinations_list=ncombinations_list)
+
+    # Report results.
+    logger.info("{:<20} {:>8} {:>10} {:>12} {:>12}".format('function', 'size', 'seconds', 'memory (MB)',
+                                                          'peak (MB)'))
+    for result in report['results']:
+        if 'error' in result:
+            logger.info("{:<20} {:>8} failed: {}".format(result['function'], result['size'], result['error']))
+            continue
+        logger.info("{:<20} {:>8} {:>10.4f} {:>12.1f} {:>12.1f}".format(
+            result['function'], result['size'], result['seconds'], result['memory_mb'],
+            result['peak_memory_mb']))
+
+    return report, setup_pipeline
+
+
+def dispatch_scaling(args):
+    from yank.benchmarks import scaling
+
+    system_names = args['--systems'].split(',') if args['--systems'] else None
+    nprocesses_list = [int(n) for n in args['--nprocesses'].split(',')] if args['--nprocesses'] else None
+    mode = 'weak' if args['--weak'] else 'strong'
+    niterations = int(args['--iterations']) if args['--iterations'] else 5
+    nsteps_per_iteration = int(args['--nsteps']) if args['--nsteps'] else 500
+    platform_name = args['--platform'] if args['--platform'] not in [None, 'None'] else 'CPU'
+
+    report = scaling.run_scaling_benchmark(system_names=system_names, nprocesses_list=nprocesses_list,
+                                           mode=mode, nstates_per_process=int(args['--states-per-process']),
+                                           niterations=niterations, nsteps_per_iteration=nsteps_per_iteration,
+                                           platform_name=platform_name, mpirun=args['--mpirun'])
+
+    # Report the scaling curves.
+    logger.info("{} scaling".format(mode.capitalize()))
+    logger.info("{:<20} {:>6} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8} {:>10}".format(
+        'system', 'procs', 'states', 's/iter', 'mixing', 'propagate', 'energies', 'storage', 'wait',
+        'MB/iter', 'speedup', 'efficiency'))
+    for result in report['results']:
+        if 'error' in result:
+            logger.info("{:<20} {:>6} {:>7} failed: {}".format(result['system'], result['nprocesses'],
+                                                               result['nstates'], result['error']))
+            continue
+        logger.info("{:<20} {:>6} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} "
+                    "{:>10.2f} {:>8.2f} {:>10.0%}".format(
+            result['system'], result['nprocesses'], result['nstates'], result['seconds_per_iteration'],
+            result['mixing'], result['propagation'], result['energies'], result['storage'], result['wait'],
+            result['mb_per_iteration'], result['speedup'], result['efficiency']))
+
+    return report, scaling
@@ -0,0 +1,65 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Query the results catalog of a YANK output tree.
+
+"""
+
+#=============================================================================================
+# MODULE IMPORTS
+#=============================================================================================
+
+import os
+import datetime
+
+from yank import utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# COMMAND DISPATCH
+#=============================================================================================
+
+def dispatch(args):
+    from yank import catalog
+    utils.config_root_logger(args['--verbose'])
+
+    catalog_path = catalog.find_catalog(args['--store'])
+    if catalog_path is None:
+        logger.error("Could not find a results catalog in {} or its parent directories".format(args['--store']))
+        return True
+
+    limit = int(args['--best']) if args['--best'] else None
+    with catalog.ResultsCatalog(catalog_path) as results_catalog:
+        experiments = results_catalog.query(limit=limit, include_failed=not args['--nofailed'])
+        modified_stores = set(results_catalog.get_modified_stores())
+
+    logger.info("Catalog {}: {} experiments".format(catalog_path, len(experiments)))
+    logger.info("{:<40} {:>10} {:>24} {:>20}".format('experiment', 'iterations', 'DeltaG (kcal/mol)',
+                                                     'analyzed'))
+    for experiment in experiments:
+        if experiment['DeltaF'] is not None:
+            DeltaG = "{:12.3f} +- {:.3f}".format(experiment['DeltaF'] * experiment['kT'],
+                                                 experiment['dDeltaF'] * experiment['kT'])
+        else:
+            DeltaG = 'failed' if experiment['error'] is not None else 'not analyzed'
+        analysis_time = ''
+        if experiment['analysis_time'] is not None:
+            analysis_time = datetime.datetime.fromtimestamp(experiment['analysis_time']).strftime('%Y-%m-%d %H:%M')
+        # Flag experiments whose store files changed after the last analysis.
+        if any(store[1] in modified_stores for store in experiment['stores']):
+            analysis_time += ' *'
+        niterations = '' if experiment['niterations'] is None else experiment['niterations']
+        logger.info("{:<40} {:>10} {:>24} {:>20}".format(experiment['experiment'], niterations,
+                                                         DeltaG, analysis_time))
+        if experiment['error'] is not None:
+            logger.debug("  {}".format(experiment['error']))
+
+    if len(modified_stores) > 0:
+        logger.info("* store files modified after the last analysis")
+    return True
@@ -24,8 +24,16 @@ import sys
 def dispatch(args):
     verbose = args['--verbose']
 
-    # Remove NetCDF files in the destination directory.
-    for filename in glob.glob(os.path.join(args['--store'], '*.nc')):
+    # Remove NetCDF files, segment manifests, restart checkpoints, status files and analysis caches in the destination directory.
+    filenames = glob.glob(os.path.join(args['--store'], '*.nc'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.segments.yaml'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.checkpoint.npz'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.status.json'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.status.json.tmp'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.analysis.npz'))
+    filenames += glob.glob(os.path.join(args['--store'], '*.convergence.npz'))
+    filenames += glob.glob(os.path.join(args['--store'], 'convergence.npz'))
+    for filename in filenames:
         if verbose: print "Removing file %s" % filename
         os.remove(filename)
 
@@ -0,0 +1,50 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Compact the store files of finished YANK calculations for archival.
+
+"""
+
+#=============================================================================================
+# MODULE IMPORTS
+#=============================================================================================
+
+from yank import utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# COMMAND DISPATCH
+#=============================================================================================
+
+def dispatch(args):
+    from yank import storage
+    utils.config_root_logger(args['--verbose'])
+
+    nprocesses = int(args['--nprocesses']) if args['--nprocesses'] else 1
+    results = storage.compact_directory(args['--store'], nprocesses=nprocesses,
+                                        positions_stride=int(args['--stride']),
+                                        keep_solvent=not args['--nosolvent'],
+                                        keep_systems=args['--keep-systems'],
+                                        force=args['--force'])
+
+    # Report bytes saved.
+    total_input_bytes, total_output_bytes, nfailed = 0, 0, 0
+    for store_path, input_bytes, output_bytes, error in results:
+        if error is not None:
+            logger.error("Could not compact {}: {}".format(store_path, error))
+            nfailed += 1
+            continue
+        logger.info("{}: {:.1f} MB -> {:.1f} MB".format(store_path, input_bytes / 1024.0**2,
+                                                       output_bytes / 1024.0**2))
+        total_input_bytes += input_bytes
+        total_output_bytes += output_bytes
+    logger.info("Compacted {} store files, saved {:.1f} MB ({} failed)".format(
+        len(results) - nfailed, (total_input_bytes - total_output_bytes) / 1024.0**2, nfailed))
+
+    return True
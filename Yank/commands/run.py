@@ -82,7 +82,35 @@ def dispatch(args):
     if args['--phase']: phases=[args['--phase']]
     yank.resume(phases=phases)
 
+    # Record a trace of the run if requested.
+    if args['--trace']:
+        from yank import tracing
+        tracing.enable(rank=mpicomm.rank if mpicomm else 0, file_path=args['--trace'])
+
+    # Profile each rank if requested.
+    if args['--profile']:
+        from yank import profiling
+        profiling.enable(*profiling.parse_iteration_range(args['--profile-iterations']))
+
     # Run simulation.
-    yank.run()
+    try:
+        yank.run()
+    except:
+        # Keep the events and statistics of this rank in its files: merging
+        # them requires all the ranks, which may not get here if one failed.
+        if args['--trace']:
+            tracing.disable()
+            tracing.flush()
+        if args['--profile']:
+            profiling.disable()
+            profiling.write_rank_profile(store_directory, rank=mpicomm.rank if mpicomm else 0)
+        raise
+
+    if args['--trace']:
+        tracing.disable()
+        tracing.write_trace(args['--trace'], mpicomm=mpicomm)
+    if args['--profile']:
+        profiling.disable()
+        profiling.write_profile(store_directory, mpicomm=mpicomm)
 
     return True
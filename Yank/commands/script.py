@@ -37,8 +37,17 @@ def dispatch(args):
         if not os.path.isfile(yaml_path):
             raise ValueError('Cannot find YAML script "{}"'.format(yaml_path))
 
+        # Profile each rank if requested, the profiles are written next to the log of each experiment.
+        if args['--profile']:
+            from yank import profiling
+            profiling.enable(*profiling.parse_iteration_range(args['--profile-iterations']))
+
         yaml_builder = YamlBuilder(yaml_source=yaml_path)
-        yaml_builder.build_experiments()
+        try:
+            yaml_builder.build_experiments()
+        finally:
+            if args['--profile']:
+                profiling.disable()
         return True
 
     return False
@@ -13,6 +13,8 @@ Query output files for quick status.
 # MODULE IMPORTS
 #=============================================================================================
 
+import time
+
 from yank import utils
 
 #=============================================================================================
@@ -20,7 +22,20 @@ from yank import utils
 #=============================================================================================
 
 def dispatch(args):
-    from yank import analyze
+    from yank import status
     utils.config_root_logger(args['--verbose'])
-    success = analyze.print_status(args['--store'])
-    return success
+    if not args['--watch']:
+        return status.print_status(args['--store'])
+
+    # Reprint the status until interrupted. The status files are replaced
+    # atomically, so they can be read while the simulations are running.
+    interval = float(args['--watch'])
+    try:
+        while True:
+            print time.strftime('%c')
+            status.print_status(args['--store'])
+            print ''
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    return True
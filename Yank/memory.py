@@ -0,0 +1,217 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Memory
+======
+
+Memory diagnostics of the replica-exchange simulations.
+
+When the 'memory_diagnostics' option of ReplicaExchange is set, every
+iteration records the resident set size (RSS) and the high-water mark of the
+process, and an estimate of the memory held by each subsystem:
+
+* 'contexts': the growth of the RSS during the creation of the OpenMM Context
+  objects cached by the simulation (memory allocated on GPUs is not counted),
+* 'systems': the serialized size of the distinct OpenMM System objects of the
+  thermodynamic states, a proxy for their size in memory,
+* 'replica_buffers': the positions, box vectors, energies and mixing
+  statistics of the replicas held by the simulation,
+* 'trace_buffer': the events buffered by the tracing module until they are
+  flushed to the file of the rank. The store files have no write queue:
+  every iteration is written and synced synchronously.
+
+Every 'memory_diagnostics_interval' iterations, the allocations of the Python
+code with the largest size are also recorded with tracemalloc, if available.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import sys
+import resource
+
+import numpy as np
+
+import tracing
+
+# tracemalloc is in the standard library only from Python 3.4 (pytracemalloc on Python 2).
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+# Subsystems whose memory is accounted for, in MB.
+SUBSYSTEMS = ['contexts', 'systems', 'replica_buffers', 'trace_buffer']
+
+# Per-iteration memory diagnostics stored in the timings group, in MB.
+MEMORY_VARIABLES = ['rss', 'peak_rss'] + SUBSYSTEMS
+
+_MEGABYTE = 1024.0 * 1024.0
+
+#=============================================================================================
+# PROCESS MEMORY
+#=============================================================================================
+
+def get_peak_rss():
+    """Return the memory high-water mark of this process in MB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux.
+    if sys.platform == 'darwin':
+        return peak_rss / _MEGABYTE
+    return peak_rss / 1024.0
+
+
+def get_rss():
+    """
+    Return the current resident set size of this process in MB.
+
+    The RSS is read from /proc on Linux. On other platforms, the high-water
+    mark is returned instead.
+
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            npages = int(f.read().split()[1])
+    except (IOError, OSError, IndexError, ValueError):
+        return get_peak_rss()
+    return npages * os.sysconf('SC_PAGE_SIZE') / _MEGABYTE
+
+
+class RSSGrowth(object):
+    """
+    Measure the growth of the resident set size during a with block.
+
+    Examples
+    --------
+    >>> with RSSGrowth() as growth:
+    ...     buffer = bytearray(10 * 1024 * 1024)
+    >>> growth.megabytes >= 0.0
+    True
+
+    """
+
+    def __enter__(self):
+        self.megabytes = 0.0
+        self._initial_rss = get_rss()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.megabytes = max(0.0, get_rss() - self._initial_rss)
+        return False
+
+#=============================================================================================
+# SUBSYSTEMS
+#=============================================================================================
+
+def get_arrays_megabytes(arrays):
+    """
+    Return the total size in MB of a list of arrays.
+
+    Parameters
+    ----------
+    arrays : list of numpy.ndarray or simtk.unit.Quantity
+       The arrays. Quantities wrapping an array are unwrapped.
+
+    """
+    nbytes = 0
+    for array in arrays:
+        nbytes += np.asarray(getattr(array, '_value', array)).nbytes
+    return nbytes / _MEGABYTE
+
+
+def get_systems_megabytes(systems):
+    """
+    Return the total serialized size in MB of the distinct OpenMM Systems in the list.
+
+    Parameters
+    ----------
+    systems : list of simtk.openmm.System
+       The systems. Systems shared by several thermodynamic states are counted once.
+
+    """
+    distinct_systems = {id(system): system for system in systems}
+    nbytes = sum(len(system.__getstate__()) for system in distinct_systems.values())
+    return nbytes / _MEGABYTE
+
+
+def get_trace_buffer_megabytes():
+    """Return an estimate in MB of the trace events buffered in memory."""
+    events = tracing.get_events()
+    if len(events) == 0:
+        return 0.0
+    # All the events have the same fields, so the last one is representative.
+    event = events[-1]
+    event_nbytes = sys.getsizeof(event) + sum(sys.getsizeof(value) for value in event.values())
+    return (sys.getsizeof(events) + len(events) * event_nbytes) / _MEGABYTE
+
+#=============================================================================================
+# ALLOCATIONS
+#=============================================================================================
+
+def start_allocation_tracking():
+    """
+    Start tracing the Python allocations with tracemalloc.
+
+    Returns
+    -------
+    started : bool
+       True if the allocations were not traced and tracing has been started,
+       False if tracemalloc is not available or it was already tracing.
+
+    """
+    if tracemalloc is None or tracemalloc.is_tracing():
+        return False
+    tracemalloc.start()
+    return True
+
+
+def stop_allocation_tracking():
+    """Stop tracing the Python allocations, if traced."""
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def get_top_allocations(nentries=10):
+    """
+    Return the source lines that allocated the largest amount of memory still in use.
+
+    Parameters
+    ----------
+    nentries : int, optional, default=10
+       The number of source lines returned.
+
+    Returns
+    -------
+    top_allocations : list of list or None
+       [location, megabytes, number of blocks] for each source line, where
+       location is 'file:line'. None if the allocations are not traced.
+
+    """
+    if tracemalloc is None or not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot()
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    top_allocations = []
+    for statistic in snapshot.statistics('lineno')[:nentries]:
+        frame = statistic.traceback[0]
+        top_allocations.append(['{}:{}'.format(frame.filename, frame.lineno),
+                                statistic.size / _MEGABYTE, statistic.count])
+    return top_allocations
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,267 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Profiling
+=========
+
+Per-rank profiling of the replica-exchange iterations.
+
+When profiling is enabled with enable(), every MPI rank runs cProfile during
+a window of iterations of each simulation. ReplicaExchange.run() marks the
+iterations with start_iteration() and stop_iteration(), so the profile does
+not include the setup of the calculation. write_profile() dumps the
+statistics of each rank in a 'profile.rankN.prof' file, which can be opened
+with pstats or any cProfile viewer, and the root node aggregates them in a
+'profile.txt' report of the functions with the largest cumulative time, with
+their spread across ranks.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import pstats
+import cProfile
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+# File names of the statistics of each rank and of the aggregated report.
+RANK_PROFILE_FILE_NAME = 'profile.rank{}.prof'
+PROFILE_REPORT_FILE_NAME = 'profile.txt'
+
+#=============================================================================================
+# PROFILING STATE
+#=============================================================================================
+
+_enabled = False
+_running = False
+_profiler = None
+_first_iteration = 0
+_last_iteration = None
+
+
+def parse_iteration_range(iteration_range):
+    """
+    Parse a range of iterations in the form 'FIRST:LAST'.
+
+    Parameters
+    ----------
+    iteration_range : str or None
+       The first iteration, included, and the last iteration, excluded,
+       separated by a colon. Either can be omitted.
+
+    Returns
+    -------
+    first_iteration : int
+       The first iteration (0 if omitted).
+    last_iteration : int or None
+       The last iteration (None if omitted).
+
+    Examples
+    --------
+    >>> parse_iteration_range('10:20')
+    (10, 20)
+    >>> parse_iteration_range('10:')
+    (10, None)
+    >>> parse_iteration_range(None)
+    (0, None)
+
+    """
+    if not iteration_range:
+        return 0, None
+    try:
+        first, last = iteration_range.split(':')
+        return (int(first) if first else 0), (int(last) if last else None)
+    except ValueError:
+        raise ValueError("Cannot parse iteration range '{}', use FIRST:LAST".format(iteration_range))
+
+
+def enable(first_iteration=0, last_iteration=None):
+    """
+    Profile the iterations of the following simulations.
+
+    Parameters
+    ----------
+    first_iteration : int, optional, default=0
+       The first profiled iteration of each simulation.
+    last_iteration : int or None, optional, default=None
+       The iteration at which profiling stops (excluded). If None, all the
+       iterations from first_iteration on are profiled.
+
+    """
+    global _enabled, _profiler, _first_iteration, _last_iteration
+    _profiler = cProfile.Profile()
+    _first_iteration = first_iteration
+    _last_iteration = last_iteration
+    _enabled = True
+
+
+def disable():
+    """Stop profiling. The statistics already collected are kept until write_profile()."""
+    global _enabled
+    stop_iteration()
+    _enabled = False
+
+
+def is_enabled():
+    """Return True if the iterations are being profiled."""
+    return _enabled
+
+
+def start_iteration(iteration):
+    """Start profiling if the iteration is in the profiled window."""
+    global _running
+    if not _enabled or _running:
+        return
+    if iteration >= _first_iteration and (_last_iteration is None or iteration < _last_iteration):
+        _profiler.enable()
+        _running = True
+
+
+def stop_iteration():
+    """Stop profiling until the next iteration in the profiled window."""
+    global _running
+    if _running:
+        _profiler.disable()
+        _running = False
+
+#=============================================================================================
+# REPORTS
+#=============================================================================================
+
+def _load_stats(profile_path):
+    """Return the raw pstats dictionary of a profile file, empty if no iteration was profiled."""
+    try:
+        return pstats.Stats(profile_path).stats
+    except TypeError:  # pstats refuses to load empty profiles
+        return {}
+
+
+def aggregate_profiles(profile_paths, nentries=30):
+    """
+    Aggregate the profiles of the ranks in a report of the functions with the largest cumulative time.
+
+    Parameters
+    ----------
+    profile_paths : list of str
+       The cProfile statistics files of the ranks, in rank order.
+    nentries : int, optional, default=30
+       The number of functions in the report.
+
+    Returns
+    -------
+    report : str
+       A table of the functions sorted by cumulative time summed over the
+       ranks, with the number of calls, the total and cumulative time summed
+       over the ranks, and the minimum, mean and maximum cumulative time of a
+       rank.
+
+    """
+    rank_stats = [_load_stats(profile_path) for profile_path in profile_paths]
+    nranks = len(rank_stats)
+
+    # Sum the statistics over ranks.
+    ncalls = dict()
+    total_times = dict()
+    cumulative_times = dict()
+    for stats in rank_stats:
+        for function, (_, nc, tt, ct, _) in stats.items():
+            ncalls[function] = ncalls.get(function, 0) + nc
+            total_times[function] = total_times.get(function, 0.0) + tt
+            cumulative_times[function] = cumulative_times.get(function, 0.0) + ct
+    top_functions = sorted(cumulative_times, key=lambda function: cumulative_times[function], reverse=True)
+
+    lines = ['Profile of {} rank(s), sorted by cumulative time (seconds).'.format(nranks), '',
+             '{:>10} {:>10} {:>10} {:>10} {:>10} {:>10}  {}'.format(
+                 'ncalls', 'tottime', 'cumtime', 'rank min', 'rank mean', 'rank max', 'function')]
+    for function in top_functions[:nentries]:
+        rank_cumulative_times = [stats[function][3] if function in stats else 0.0 for stats in rank_stats]
+        lines.append('{:>10} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}  {}'.format(
+            ncalls[function], total_times[function], cumulative_times[function],
+            min(rank_cumulative_times), sum(rank_cumulative_times) / nranks, max(rank_cumulative_times),
+            pstats.func_std_string(function)))
+    return '\n'.join(lines) + '\n'
+
+
+def write_rank_profile(directory, rank=0):
+    """
+    Write the statistics collected on this node in its rank file and reset them.
+
+    This does not communicate with the other nodes, so it is safe to call
+    when a node fails.
+
+    Parameters
+    ----------
+    directory : str
+       The directory where the file is written.
+    rank : int, optional, default=0
+       The MPI rank of this node.
+
+    Returns
+    -------
+    profile_path : str
+       The path of the statistics of this node.
+
+    """
+    global _profiler
+    stop_iteration()
+    profile_path = os.path.join(directory, RANK_PROFILE_FILE_NAME.format(rank))
+    _profiler.dump_stats(profile_path)
+    _profiler = cProfile.Profile()
+    return profile_path
+
+
+def write_profile(directory, mpicomm=None, nentries=30):
+    """
+    Write the statistics collected on every rank and their aggregated report.
+
+    This must be called by all the nodes. The statistics are reset, so that
+    the next call reports only the iterations profiled in between.
+
+    Parameters
+    ----------
+    directory : str
+       The directory where the files are written, shared by all nodes.
+    mpicomm : mpi4py communicator, optional
+       The MPI communicator, if the simulation runs under MPI.
+    nentries : int, optional, default=30
+       The number of functions in the aggregated report.
+
+    Returns
+    -------
+    report_path : str or None
+       The path of the aggregated report on the root node, None on the others.
+
+    """
+    rank = mpicomm.rank if mpicomm else 0
+    profile_path = write_rank_profile(directory, rank)
+
+    # Gathering the paths also waits for all the ranks to write their statistics.
+    if mpicomm:
+        profile_paths = mpicomm.gather(profile_path, root=0)
+    else:
+        profile_paths = [profile_path]
+    if rank != 0:
+        return None
+
+    report = aggregate_profiles(profile_paths, nentries=nentries)
+    report_path = os.path.join(directory, PROFILE_REPORT_FILE_NAME)
+    with open(report_path, 'w') as f:
+        f.write(report)
+    logger.info("Profile of {} rank(s) written to {}".format(len(profile_paths), report_path))
+    return report_path
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
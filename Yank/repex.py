@@ -62,6 +62,8 @@ from simtk import unit
 import os, os.path
 import math
 import copy
+import json
+import collections
 import time
 import datetime
 import logging
@@ -71,7 +73,11 @@ import numpy as np
 import mdtraj as md
 import netCDF4 as netcdf
 
-from utils import is_terminal_verbose, delayed_termination
+import tracing
+import profiling
+import memory
+from utils import is_terminal_verbose, delayed_termination, get_companion_store_path, STATUS_FILE_SUFFIX
+from storage import read_segment_manifest, write_segment_manifest, get_segment_path, get_manifest_path
 
 #=============================================================================================
 # MODULE CONSTANTS
@@ -101,6 +107,48 @@ class ParameterException(Exception):
     """
     pass
 
+#=============================================================================================
+# NetCDF utilities
+#=============================================================================================
+
+def _copy_netcdf_variable(ncvar, ncgrp, copy_data=True):
+    """
+    Create a copy of a NetCDF variable in another file or group.
+
+    The dimensions used by the variable must already exist in the destination.
+
+    Parameters
+    ----------
+    ncvar : netCDF4.Variable
+       The variable to copy.
+    ncgrp : netCDF4.Dataset or netCDF4.Group
+       The destination file or group.
+    copy_data : bool, optional, default=True
+       If False, only the definition of the variable and its attributes are copied.
+
+    Returns
+    -------
+    new_ncvar : netCDF4.Variable
+       The newly created variable.
+
+    """
+    chunksizes = ncvar.chunking()
+    if chunksizes == 'contiguous':
+        chunksizes = None
+    filters = ncvar.filters() or {}
+    new_ncvar = ncgrp.createVariable(ncvar.name, ncvar.dtype, ncvar.dimensions,
+                                     zlib=filters.get('zlib', False), chunksizes=chunksizes)
+    for attribute_name in ncvar.ncattrs():
+        setattr(new_ncvar, attribute_name, getattr(ncvar, attribute_name))
+
+    if copy_data:
+        if ncvar.shape == ():
+            new_ncvar.assignValue(ncvar.getValue())
+        elif ncvar.size > 0:
+            new_ncvar[:] = ncvar[:]
+
+    return new_ncvar
+
 #=============================================================================================
 # Thermodynamic state description
 #=============================================================================================
@@ -498,6 +546,44 @@ class ReplicaExchange(object):
        If True, will print energies at each iteration (default: True).
     show_mixing_statistics : bool
        If True, will show mixing statistics at each iteration (default: True).
+    energy_store : bool
+       If True, states, energies and the other per-iteration data that do not scale with
+       the number of atoms are duplicated in a separate lightweight NetCDF file
+       '<store>.energies.nc' so that analysis does not need to read the main store file
+       (default: False).
+    energy_store_sync_interval : int
+       The energy store file is synced to disk every this many iterations (default: 1).
+    segment_iterations : int
+       If positive, positions and box vectors are written to segment files '<store>.segmentNNNN.nc'
+       and a new segment is started every this many iterations (default: 0, no segmentation).
+    segment_max_gigabytes : float
+       If set, a new segment is started as soon as the current one exceeds this size in GB
+       (default: None, no size limit). Segmentation is enabled if either this option or
+       segment_iterations is set.
+    positions_stride : int
+       Positions are stored in the trajectory every this many iterations. If 0, no trajectory
+       is stored (default: 1). Whenever the trajectory does not contain the full positions of
+       every iteration, restart_checkpoint is enabled to keep the latest full positions.
+    positions_atom_indices : list of int
+       If not None, only the positions of these atoms are stored in the trajectory (default: None).
+    restart_checkpoint : bool
+       If True, the latest positions, box vectors, replica states, energies, cumulative mixing
+       statistics and random number generator state are written at every iteration to a small
+       file '<store>.checkpoint.npz' that is atomically replaced, so that the simulation can be
+       resumed without reading the trajectory (default: True).
+    memory_diagnostics : bool
+       If True, the resident set size and the high-water mark of the processes and an estimate
+       of the memory held by the cached Contexts, the Systems, the replica buffers and the
+       buffered trace events are stored in the timings group at every iteration (default: False).
+    memory_diagnostics_interval : int
+       If memory_diagnostics is set, the source lines that allocated the largest amount of
+       memory are recorded with tracemalloc every this many iterations. If 0, tracemalloc,
+       which slows down the Python code, is not used (default: 10).
+    status_file : bool
+       If True, the root node atomically replaces a small JSON file '<store>.status.json' at
+       every iteration with the progress, throughput, mixing statistics and latest online free
+       energy estimate of the simulation, which 'yank status' reads without opening the store
+       files (default: True).
 
     TODO
     ----
@@ -563,11 +649,24 @@ class ReplicaExchange(object):
                           'online_analysis': False,
                           'online_analysis_min_iterations': 20,
                           'show_energies': True,
-                          'show_mixing_statistics': True
+                          'show_mixing_statistics': True,
+                          'energy_store': False,
+                          'energy_store_sync_interval': 1,
+                          'segment_iterations': 0,
+                          'segment_max_gigabytes': None,
+                          'positions_stride': 1,
+                          'positions_atom_indices': None,
+                          'restart_checkpoint': True,
+                          'memory_diagnostics': False,
+                          'memory_diagnostics_interval': 10,
+                          'status_file': True
                           }
 
     # Options to store.
-    options_to_store = ['collision_rate', 'constraint_tolerance', 'timestep', 'nsteps_per_iteration', 'number_of_iterations', 'equilibration_timestep', 'number_of_equilibration_iterations', 'title', 'minimize', 'replica_mixing_scheme', 'online_analysis', 'show_mixing_statistics']
+    options_to_store = ['collision_rate', 'constraint_tolerance', 'timestep', 'nsteps_per_iteration', 'number_of_iterations', 'equilibration_timestep', 'number_of_equilibration_iterations', 'title', 'minimize', 'replica_mixing_scheme', 'online_analysis', 'show_mixing_statistics', 'energy_store', 'energy_store_sync_interval', 'segment_iterations', 'segment_max_gigabytes', 'positions_stride', 'restart_checkpoint', 'memory_diagnostics', 'memory_diagnostics_interval', 'status_file']
+
+    # Per-iteration variables that are mirrored in the energy store file.
+    energy_store_variables = ['states', 'energies', 'proposed', 'accepted', 'volumes', 'timestamp']
 
     def __init__(self, store_filename, mpicomm=None, mm=None, **kwargs):
         """
@@ -603,6 +702,14 @@ class ReplicaExchange(object):
         self.platform = None
         self.platform_name = None
         self.integrator = None # OpenMM integrator to use for propagating dynamics
+        self.energy_ncfile = None # handle to the energy store file, if used
+        self.segment_ncfile = None # handle to the current segment file, if the store is segmented
+        self._analysis_cache = None # analysis intermediates persisted next to the store file
+        self._contexts_megabytes = dict() # memory taken by the creation of each cached Context
+        self._systems_megabytes = None # serialized size of the Systems, computed once
+        self._allocation_tracking = False # True if tracemalloc was started by this simulation
+        self._recent_timings = collections.deque(maxlen=100) # (iteration, overhead) seconds of the last iterations
+        self._top_allocations = None # top allocations last recorded by the memory diagnostics
 
         # Initialize keywords parameters and check for unknown keywords parameters
         for par, default in self.default_parameters.items():
@@ -784,9 +891,9 @@ class ReplicaExchange(object):
         """
         status = dict()
 
-        status['number_of_iterations'] = ncfile.variables['positions'].shape[0]
-        status['nstates'] = ncfile.variables['positions'].shape[1]
-        status['natoms'] = ncfile.variables['positions'].shape[2]
+        status['number_of_iterations'] = ncfile.variables['states'].shape[0]
+        status['nstates'] = ncfile.variables['states'].shape[1]
+        status['natoms'] = len(ncfile.dimensions['atom'])
 
         return status
 
@@ -850,25 +957,40 @@ class ReplicaExchange(object):
         iteration_limit = self.number_of_iterations
         if niterations_to_run:
             iteration_limit = min(self.iteration + niterations_to_run, iteration_limit)
+        if self.memory_diagnostics and self.memory_diagnostics_interval:
+            self._allocation_tracking = memory.start_allocation_tracking() or self._allocation_tracking
         while (self.iteration < iteration_limit):
             logger.debug("\nIteration %d / %d" % (self.iteration+1, self.number_of_iterations))
+            profiling.start_iteration(self.iteration)
             initial_time = time.time()
+            timings = dict()
 
             # Attempt replica swaps to sample from equilibrium permuation of states associated with replicas.
-            self._mix_replicas()
+            with tracing.span('mix replicas', iteration=self.iteration):
+                self._mix_replicas()
+            timings['mixing'] = time.time() - initial_time
 
             # Propagate replicas.
-            self._propagate_replicas()
+            with tracing.span('propagate replicas', iteration=self.iteration):
+                self._propagate_replicas()
 
             # Compute energies of all replicas at all states.
-            self._compute_energies()
+            start_time = time.time()
+            with tracing.span('compute energies', iteration=self.iteration):
+                self._compute_energies()
+            timings['energies'] = time.time() - start_time
 
             # Show energies.
             if self.show_energies:
                 self._show_energies()
 
             # Write iteration to storage file.
-            self._write_iteration_netcdf()
+            start_time = time.time()
+            with tracing.span('write iteration', 'storage', iteration=self.iteration):
+                self._write_iteration_netcdf()
+            with tracing.span('write checkpoint', 'storage', iteration=self.iteration):
+                self._write_restart_checkpoint()
+            timings['storage'] = time.time() - start_time
 
             # Increment iteration counter.
             self.iteration += 1
@@ -878,12 +1000,27 @@ class ReplicaExchange(object):
                 self._show_mixing_statistics()
 
             # Perform online analysis.
+            start_time = time.time()
             if self.online_analysis:
-                self._analysis()
+                with tracing.span('online analysis', iteration=self.iteration - 1):
+                    self._analysis()
+            timings['analysis'] = time.time() - start_time
+
+            # Record timings of the iteration just stored.
+            final_time = time.time()
+            timings['iteration'] = final_time - initial_time
+            timings['propagate'] = self.replica_propagate_times
+            if self.memory_diagnostics:
+                with tracing.span('measure memory', iteration=self.iteration - 1):
+                    timings.update(self._measure_memory(self.iteration - 1))
+            with tracing.span('write timings', 'storage', iteration=self.iteration - 1):
+                self._write_timings_netcdf(self.iteration - 1, timings)
+            if self.status_file:
+                with tracing.span('write status', 'storage', iteration=self.iteration - 1):
+                    self._write_status_file(timings)
 
             # Show timing statistics if debug level is activated
             if logger.isEnabledFor(logging.DEBUG):
-                final_time = time.time()
                 elapsed_time = final_time - initial_time
                 estimated_time_remaining = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (self.number_of_iterations - self.iteration)
                 estimated_total_time = (final_time - run_start_time) / (self.iteration - run_start_iteration) * (self.number_of_iterations)
@@ -893,6 +1030,7 @@ class ReplicaExchange(object):
 
             # Perform sanity checks to see if we should terminate here.
             self._run_sanity_checks()
+            profiling.stop_iteration()
 
         # Clean up and close storage files.
         self._finalize()
@@ -957,6 +1095,8 @@ class ReplicaExchange(object):
         self.swap_Pij_accepted  = np.zeros([self.nstates, self.nstates], np.float64)
         self.Nij_proposed       = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
         self.Nij_accepted       = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
+        self.Nij_proposed_cumulative = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed_cumulative[i][j] is the number of swaps proposed between states i and j since the beginning of the simulation
+        self.Nij_accepted_cumulative = np.zeros([self.nstates,self.nstates], np.int64) # Nij_accepted_cumulative[i][j] is the number of swaps accepted between states i and j since the beginning of the simulation
 
         # Distribute coordinate information to replicas in a round-robin fashion, making a deep copy.
         if not self._resume:
@@ -979,15 +1119,33 @@ class ReplicaExchange(object):
         # Initialize current iteration counter.
         self.iteration = 0
 
+        # Positions are written to segment files if requested.
+        self._segmented = bool(self.segment_iterations or self.segment_max_gigabytes)
+
+        # The restart checkpoint is needed if the trajectory does not contain all the positions.
+        self._check_restart_checkpoint_policy()
+
         # Initialize NetCDF file.
         self._initialize_netcdf()
 
+        # Initialize the lightweight energy store file.
+        if self.energy_store:
+            self._initialize_energy_store()
+
         # Store initial state.
         self._write_iteration_netcdf()
+        self._write_restart_checkpoint()
 
-        # Close NetCDF file.
-        self.ncfile.close()
-        self.ncfile = None
+        # Close NetCDF files.
+        if self.ncfile is not None:
+            self.ncfile.close()
+            self.ncfile = None
+        if self.energy_ncfile is not None:
+            self.energy_ncfile.close()
+            self.energy_ncfile = None
+        if self.segment_ncfile is not None:
+            self.segment_ncfile.close()
+            self.segment_ncfile = None
 
         return
 
@@ -1042,6 +1200,8 @@ class ReplicaExchange(object):
         self.swap_Pij_accepted  = np.zeros([self.nstates, self.nstates], np.float64)
         self.Nij_proposed       = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
         self.Nij_accepted       = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed[i][j] is the number of swaps proposed between states i and j, prior of 1
+        self.Nij_proposed_cumulative = np.zeros([self.nstates,self.nstates], np.int64) # Nij_proposed_cumulative[i][j] is the number of swaps proposed between states i and j since the beginning of the simulation
+        self.Nij_accepted_cumulative = np.zeros([self.nstates,self.nstates], np.int64) # Nij_accepted_cumulative[i][j] is the number of swaps accepted between states i and j since the beginning of the simulation
 
         # Distribute coordinate information to replicas in a round-robin fashion, making a deep copy.
         if not self._resume:
@@ -1064,20 +1224,40 @@ class ReplicaExchange(object):
         # Check to make sure NetCDF file exists.
         if not os.path.exists(self.store_filename):
             raise Exception("Store file %s does not exist." % self.store_filename)
+        self._segmented = os.path.isfile(get_manifest_path(self.store_filename))
 
-        # Open NetCDF file for reading
-        logger.debug("Reading NetCDF file '%s'..." % self.store_filename)
-        ncfile = netcdf.Dataset(self.store_filename, 'r')
+        # Resume from the restart checkpoint alone if it matches one of the last two
+        # iterations in the store file, otherwise read the state of the simulation from
+        # the store file.
+        if not self._resume_from_restart_checkpoint():
+            self._resume_from_store()
 
-        # Resume from NetCDF file.
-        self._resume_from_netcdf(ncfile)
-
-        # Close NetCDF file.
-        ncfile.close()
+        # The restart checkpoint is needed if the trajectory does not contain all the positions.
+        self._check_restart_checkpoint_policy()
 
         if (self.mpicomm is None) or (self.mpicomm.rank == 0):
             # Reopen NetCDF file for appending, and maintain handle.
             self.ncfile = netcdf.Dataset(self.store_filename, 'a')
+
+            # Record the number of iterations requested by this run, so that finished
+            # stores can be recognized (see storage.is_store_finished()).
+            ncgrp_options = self.ncfile.groups['options']
+            if 'number_of_iterations' in ncgrp_options.variables:
+                ncgrp_options.variables['number_of_iterations'].assignValue(self.number_of_iterations)
+
+            # Reopen the energy store, creating it or backfilling it if needed.
+            if self.energy_store:
+                self._initialize_energy_store()
+
+            # Memory diagnostics may be enabled when resuming.
+            if self.memory_diagnostics:
+                for store_ncfile in [self.ncfile, self.energy_ncfile]:
+                    if (store_ncfile is not None) and ('timings' in store_ncfile.groups):
+                        self._initialize_memory_netcdf(store_ncfile)
+
+            # Reopen the segment containing the last iteration.
+            if self._segmented:
+                self._reopen_segment()
         else:
             self.ncfile = None
 
@@ -1129,6 +1309,11 @@ class ReplicaExchange(object):
 
         """
 
+        # Stop tracing allocations if this simulation started it.
+        if self._allocation_tracking:
+            memory.stop_allocation_tracking()
+            self._allocation_tracking = False
+
         if self.mpicomm:
             # Only the root node needs to clean up.
             if self.mpicomm.rank != 0: return
@@ -1136,6 +1321,12 @@ class ReplicaExchange(object):
         if hasattr(self, 'ncfile') and self.ncfile:
             self.ncfile.sync()
 
+        if self.energy_ncfile is not None:
+            self.energy_ncfile.sync()
+
+        if self.segment_ncfile is not None:
+            self.segment_ncfile.sync()
+
         return
 
     def __del__(self):
@@ -1154,6 +1345,14 @@ class ReplicaExchange(object):
                 self.ncfile.close()
                 self.ncfile = None
 
+        if self.energy_ncfile is not None:
+            self.energy_ncfile.close()
+            self.energy_ncfile = None
+
+        if self.segment_ncfile is not None:
+            self.segment_ncfile.close()
+            self.segment_ncfile = None
+
         return
 
     def _display_citations(self):
@@ -1235,27 +1434,32 @@ class ReplicaExchange(object):
         # Create Context and integrator.
         integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
         integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
-        if self.platform:
-            context = openmm.Context(state.system, integrator, self.platform)
-        else:
-            context = openmm.Context(state.system, integrator)
+        with tracing.span('Context', 'openmm', replica=replica_index):
+            if self.platform:
+                context = openmm.Context(state.system, integrator, self.platform)
+            else:
+                context = openmm.Context(state.system, integrator)
 
         # Set box vectors.
         box_vectors = self.replica_box_vectors[replica_index]
         context.setPeriodicBoxVectors(box_vectors[0,:], box_vectors[1,:], box_vectors[2,:])
         # Set positions.
         positions = self.replica_positions[replica_index]
-        context.setPositions(positions)
+        with tracing.span('setPositions', 'openmm', replica=replica_index):
+            context.setPositions(positions)
         setpositions_end_time = time.time()
         # Assign Maxwell-Boltzmann velocities.
-        context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
+        with tracing.span('setVelocitiesToTemperature', 'openmm', replica=replica_index):
+            context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
         setvelocities_end_time = time.time()
         # Run dynamics.
-        integrator.step(self.nsteps_per_iteration)
+        with tracing.span('integrator.step', 'openmm', replica=replica_index, nsteps=self.nsteps_per_iteration):
+            integrator.step(self.nsteps_per_iteration)
         integrator_end_time = time.time()
         # Store final positions
         getstate_start_time = time.time()
-        openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
+        with tracing.span('getState', 'openmm', replica=replica_index):
+            openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
         getstate_end_time = time.time()
         self.replica_positions[replica_index] = openmm_state.getPositions(asNumpy=True)
         # Store box vectors.
@@ -1297,15 +1501,20 @@ class ReplicaExchange(object):
         # replica_lookup = { self.replica_states[replica_index] : replica_index for replica_index in range(self.nstates) } # replica_lookup[state_index] is the replica index currently at state 'state_index' # requires Python 2.7 features
         replica_lookup = dict( (self.replica_states[replica_index], replica_index) for replica_index in range(self.nstates) ) # replica_lookup[state_index] is the replica index currently at state 'state_index' # Python 2.6 compatible
         replica_indices = [ replica_lookup[state_index] for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size) ] # list of replica indices for this node to propagate
+        replica_elapsed_times = []
         for replica_index in replica_indices:
             logger.debug("Node %3d/%3d propagating replica %3d state %3d..." % (self.mpicomm.rank, self.mpicomm.size, replica_index, self.replica_states[replica_index]))
-            self._propagate_replica(replica_index)
+            replica_elapsed_times.append(self._propagate_replica(replica_index))
         end_time = time.time()
         elapsed_time = end_time - start_time
-        # Collect elapsed time.
-        node_elapsed_times = self.mpicomm.gather(elapsed_time, root=0) # barrier
+        # Collect elapsed time of nodes and replicas.
+        with tracing.span('gather timings', 'mpi'):
+            node_timings = self.mpicomm.gather((elapsed_time, replica_indices, replica_elapsed_times), root=0) # barrier
+        if self.mpicomm.rank == 0:
+            for (node_elapsed_time, node_replica_indices, node_replica_times) in node_timings:
+                self.replica_propagate_times[node_replica_indices] = node_replica_times
         if self.mpicomm.rank == 0 and logger.isEnabledFor(logging.DEBUG):
-            node_elapsed_times = np.array(node_elapsed_times)
+            node_elapsed_times = np.array([node_timing[0] for node_timing in node_timings])
             end_time = time.time()
             elapsed_time = end_time - start_time
             barrier_wait_times = elapsed_time - node_elapsed_times
@@ -1315,9 +1524,10 @@ class ReplicaExchange(object):
         # Send final configurations and box vectors back to all nodes.
         logger.debug("Synchronizing trajectories...")
         start_time = time.time()
-        replica_indices_gather = self.mpicomm.allgather(replica_indices)
-        replica_positions_gather = self.mpicomm.allgather([ self.replica_positions[replica_index] for replica_index in replica_indices ])
-        replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
+        with tracing.span('allgather positions', 'mpi'):
+            replica_indices_gather = self.mpicomm.allgather(replica_indices)
+            replica_positions_gather = self.mpicomm.allgather([ self.replica_positions[replica_index] for replica_index in replica_indices ])
+            replica_box_vectors_gather = self.mpicomm.allgather([ self.replica_box_vectors[replica_index] for replica_index in replica_indices ])
         for (source, replica_indices) in enumerate(replica_indices_gather):
             for (index, replica_index) in enumerate(replica_indices):
                 self.replica_positions[replica_index] = replica_positions_gather[source][index]
@@ -1336,7 +1546,7 @@ class ReplicaExchange(object):
         # Propagate all replicas.
         logger.debug("Propagating all replicas for %.3f ps..." % (self.nsteps_per_iteration * self.timestep / unit.picoseconds))
         for replica_index in range(self.nstates):
-            self._propagate_replica(replica_index)
+            self.replica_propagate_times[replica_index] = self._propagate_replica(replica_index)
 
         return
 
@@ -1351,6 +1561,9 @@ class ReplicaExchange(object):
         """
         start_time = time.time()
 
+        # Time to propagate each replica, which is stored in the timings group.
+        self.replica_propagate_times = np.zeros([self.nstates], np.float64)
+
         if self.mpicomm:
             self._propagate_replicas_mpi()
         else:
@@ -1461,11 +1674,13 @@ class ReplicaExchange(object):
 
             # Compute energies for this node's share of states.
             for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
+                with tracing.span('compute state energies', 'openmm', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
 
             # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
+            with tracing.span('allgather energies', 'mpi'):
+                energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
             for state_index in range(self.nstates):
                 source = state_index % self.mpicomm.size # node with trajectory data
                 index = state_index // self.mpicomm.size # index within trajectory batch
@@ -1474,8 +1689,9 @@ class ReplicaExchange(object):
         else:
             # Serial version.
             for state_index in range(self.nstates):
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
+                with tracing.span('compute state energies', 'openmm', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], platform=self.platform)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -1611,7 +1827,8 @@ class ReplicaExchange(object):
             # Non-root nodes receive state information.
             logger.debug('Node {}/{}: MPI bcast - sharing replica_states'.format(
                     self.mpicomm.rank, self.mpicomm.size))
-            self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            with tracing.span('bcast replica_states', 'mpi'):
+                self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
             return
 
         logger.debug("Mixing replicas...")
@@ -1646,8 +1863,10 @@ class ReplicaExchange(object):
         logger.debug("Accepted %d / %d attempted swaps (%.1f %%)" % (nswaps_accepted, nswaps_attempted, swap_fraction_accepted * 100.0))
 
         # Estimate cumulative transition probabilities between all states.
-        Nij_accepted = self.ncfile.variables['accepted'][:,:,:].sum(0) + self.Nij_accepted
-        Nij_proposed = self.ncfile.variables['proposed'][:,:,:].sum(0) + self.Nij_proposed
+        self.Nij_accepted_cumulative += self.Nij_accepted
+        self.Nij_proposed_cumulative += self.Nij_proposed
+        Nij_accepted = self.Nij_accepted_cumulative
+        Nij_proposed = self.Nij_proposed_cumulative
         swap_Pij_accepted = np.zeros([self.nstates,self.nstates], np.float64)
         for istate in range(self.nstates):
             Ni = Nij_proposed[istate,:].sum()
@@ -1663,7 +1882,8 @@ class ReplicaExchange(object):
             # Root node will share state information with all replicas.
             logger.debug('Node {}/{}: MPI bcast - sharing replica_states'.format(
                     self.mpicomm.rank, self.mpicomm.size))
-            self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
+            with tracing.span('bcast replica_states', 'mpi'):
+                self.replica_states = self.mpicomm.bcast(self.replica_states, root=0)
 
         # Report on mixing.
         logger.debug("Mixing of replicas took %.3f s" % (end_time - start_time))
@@ -1681,16 +1901,20 @@ class ReplicaExchange(object):
 
         return self._accumulate_mixing_statistics_full()
 
+    def _get_mixing_statistics(self):
+        """Return the mixing transition matrix Tij, accumulated at most once per iteration."""
+        if getattr(self, '_Tij_iteration', None) != self.iteration:
+            self._Tij = self._accumulate_mixing_statistics()
+            self._Tij_iteration = self.iteration
+        return self._Tij
+
     def _accumulate_mixing_statistics_full(self):
         """Compute statistics of transitions iterating over all iterations of repex."""
-        states = self.ncfile.variables['states']
+        # Read all the states at once and count the transitions of all replicas together.
+        states = np.asarray(self.ncfile.variables['states'][:])
         self._Nij = np.zeros([self.nstates, self.nstates], np.float64)
-        for iteration in range(states.shape[0]-1):
-            for ireplica in range(self.nstates):
-                istate = states[iteration, ireplica]
-                jstate = states[iteration + 1, ireplica]
-                self._Nij[istate, jstate] += 0.5
-                self._Nij[jstate, istate] += 0.5
+        np.add.at(self._Nij, (states[:-1], states[1:]), 0.5)
+        np.add.at(self._Nij, (states[1:], states[:-1]), 0.5)
 
         Tij = np.zeros([self.nstates, self.nstates], np.float64)
         for istate in range(self.nstates):
@@ -1705,9 +1929,11 @@ class ReplicaExchange(object):
         if self._Nij.sum() != (states.shape[0] - 2) * self.nstates:  # n_iter - 2 = (n_iter - 1) - 1.  Meaning that you have exactly one new iteration to process.
             raise(ValueError("Inconsistent transition count matrix detected.  Perhaps you tried updating twice in a row?"))
 
+        previous_states = states[self.iteration-2]
+        current_states = states[self.iteration-1]
         for ireplica in range(self.nstates):
-            istate = states[self.iteration-2, ireplica]
-            jstate = states[self.iteration-1, ireplica]
+            istate = previous_states[ireplica]
+            jstate = current_states[ireplica]
             self._Nij[istate, jstate] += 0.5
             self._Nij[jstate, istate] += 0.5
 
@@ -1726,7 +1952,7 @@ class ReplicaExchange(object):
         if not logger.isEnabledFor(logging.DEBUG):
             return
 
-        Tij = self._accumulate_mixing_statistics()
+        Tij = self._get_mixing_statistics()
 
         # Print observed transition probabilities.
         PRINT_CUTOFF = 0.001 # Cutoff for displaying fraction of accepted swaps.
@@ -1780,41 +2006,44 @@ class ReplicaExchange(object):
         setattr(ncfile, 'Conventions', 'YANK')
         setattr(ncfile, 'ConventionVersion', '0.1')
 
-        # Create variables.
-        ncvar_positions = ncfile.createVariable('positions', 'f4', ('iteration','replica','atom','spatial'), zlib=True, chunksizes=(1,self.nreplicas,self.natoms,3))
+        # Create variables. In segmented mode, positions and box vectors go to the segment files.
+        if not self._segmented:
+            self._initialize_positions_netcdf(ncfile)
         ncvar_states    = ncfile.createVariable('states', 'i4', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas))
         ncvar_energies  = ncfile.createVariable('energies', 'f8', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
         ncvar_proposed  = ncfile.createVariable('proposed', 'i4', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
         ncvar_accepted  = ncfile.createVariable('accepted', 'i4', ('iteration','replica','replica'), zlib=False, chunksizes=(1,self.nreplicas,self.nreplicas))
-        ncvar_box_vectors = ncfile.createVariable('box_vectors', 'f4', ('iteration','replica','spatial','spatial'), zlib=False, chunksizes=(1,self.nreplicas,3,3))
         ncvar_volumes  = ncfile.createVariable('volumes', 'f8', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas))
 
         # Define units for variables.
-        setattr(ncvar_positions, 'units', 'nm')
         setattr(ncvar_states,    'units', 'none')
         setattr(ncvar_energies,  'units', 'kT')
         setattr(ncvar_proposed,  'units', 'none')
         setattr(ncvar_accepted,  'units', 'none')
-        setattr(ncvar_box_vectors, 'units', 'nm')
         setattr(ncvar_volumes, 'units', 'nm**3')
 
         # Define long (human-readable) names for variables.
-        setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
         setattr(ncvar_states,    "long_name", "states[iteration][replica] is the state index (0..nstates-1) of replica 'replica' of iteration 'iteration'.")
         setattr(ncvar_energies,  "long_name", "energies[iteration][replica][state] is the reduced (unitless) energy of replica 'replica' from iteration 'iteration' evaluated at state 'state'.")
         setattr(ncvar_proposed,  "long_name", "proposed[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
         setattr(ncvar_accepted,  "long_name", "accepted[iteration][i][j] is the number of proposed transitions between states i and j from iteration 'iteration-1'.")
-        setattr(ncvar_box_vectors, "long_name", "box_vectors[iteration][replica][i][j] is dimension j of box vector i for replica 'replica' from iteration 'iteration-1'.")
         setattr(ncvar_volumes, "long_name", "volume[iteration][replica] is the box volume for replica 'replica' from iteration 'iteration-1'.")
 
         # Create timestamp variable.
-        ncvar_timestamp = ncfile.createVariable('timestamp', str, ('iteration',), zlib=False, chunksizes=(1,))
+        ncvar_timestamp = ncfile.createVariable('timestamp', 'f8', ('iteration',), zlib=False, chunksizes=(1,))
+        setattr(ncvar_timestamp, 'units', 'seconds since 1970-01-01 00:00:00 UTC')
 
         # Create group for performance statistics.
         ncgrp_timings = ncfile.createGroup('timings')
         ncvar_iteration_time = ncgrp_timings.createVariable('iteration', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # total iteration time (seconds)
         ncvar_iteration_time = ncgrp_timings.createVariable('mixing', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time for mixing
         ncvar_iteration_time = ncgrp_timings.createVariable('propagate', 'f', ('iteration','replica'), zlib=False, chunksizes=(1,self.nreplicas)) # total time to propagate each replica
+        ncvar_iteration_time = ncgrp_timings.createVariable('energies', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time to compute all energies
+        ncvar_iteration_time = ncgrp_timings.createVariable('storage', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time to write the iteration
+        ncvar_iteration_time = ncgrp_timings.createVariable('analysis', 'f', ('iteration',), zlib=False, chunksizes=(1,)) # time for online analysis
+        setattr(ncgrp_timings, 'ns_per_iteration', self.nsteps_per_iteration * self.timestep / unit.nanoseconds) # simulated time per replica
+        if self.memory_diagnostics:
+            self._initialize_memory_netcdf(ncfile)
 
         # Store thermodynamic states.
         self._store_thermodynamic_states(ncfile)
@@ -1834,6 +2063,112 @@ class ReplicaExchange(object):
 
         return
 
+    def _initialize_positions_netcdf(self, ncfile):
+        """
+        Create the positions and box vectors variables in the main store file or in a segment file.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The NetCDF file where the variables are created.
+
+        """
+        ncvar_box_vectors = ncfile.createVariable('box_vectors', 'f4', ('iteration','replica','spatial','spatial'), zlib=False, chunksizes=(1,self.nreplicas,3,3))
+        setattr(ncvar_box_vectors, 'units', 'nm')
+        setattr(ncvar_box_vectors, "long_name", "box_vectors[iteration][replica][i][j] is dimension j of box vector i for replica 'replica' from iteration 'iteration-1'.")
+
+        # No trajectory is stored in checkpoint-only mode.
+        if self.positions_stride == 0:
+            return
+
+        # Store the indices of the atoms in the trajectory if only a subset is stored.
+        if self.positions_atom_indices is None:
+            atom_dimension, natoms = 'atom', self.natoms
+        else:
+            atom_dimension, natoms = 'trajectory_atom', len(self.positions_atom_indices)
+            ncfile.createDimension(atom_dimension, natoms)
+            ncvar_atom_indices = ncfile.createVariable('positions_atom_indices', 'i4', (atom_dimension,))
+            setattr(ncvar_atom_indices, "long_name", "positions_atom_indices[trajectory_atom] is the index in the system of the atom 'trajectory_atom' of positions.")
+            ncvar_atom_indices[:] = np.array(self.positions_atom_indices, np.int32)
+
+        # Iterations that are not a multiple of the stride are never written and take no disk space.
+        ncvar_positions = ncfile.createVariable('positions', 'f4', ('iteration','replica',atom_dimension,'spatial'), zlib=True, chunksizes=(1,self.nreplicas,natoms,3))
+        setattr(ncvar_positions, 'units', 'nm')
+        setattr(ncvar_positions, 'stride', self.positions_stride)
+        setattr(ncvar_positions, "long_name", "positions[iteration][replica][atom][spatial] is position of coordinate 'spatial' of atom 'atom' from replica 'replica' for iteration 'iteration'.")
+
+    def _open_segment(self):
+        """
+        Make sure the current segment file can receive the current iteration, starting a new one if needed.
+
+        A new segment is started when the current one holds segment_iterations iterations or its
+        size exceeds segment_max_gigabytes. The new segment is recorded in the manifest.
+
+        """
+        if self.segment_ncfile is not None:
+            niterations = self.iteration - self.segment_first_iteration
+            segment_full = bool(self.segment_iterations) and (niterations >= self.segment_iterations)
+            if self.segment_max_gigabytes and (niterations > 0) and not segment_full:
+                segment_size = os.path.getsize(self._segment_filename) / 1024.0**3
+                segment_full = segment_size >= self.segment_max_gigabytes
+            if not segment_full:
+                return
+            self.segment_ncfile.close()
+            self.segment_ncfile = None
+
+        # Create the new segment file.
+        segments = read_segment_manifest(self.store_filename)
+        segment_filename = get_segment_path(self.store_filename, len(segments))
+        logger.debug("Starting segment file '%s' at iteration %d..." % (segment_filename, self.iteration))
+        ncfile = netcdf.Dataset(segment_filename, 'w', version='NETCDF4')
+        ncfile.createDimension('iteration', 0) # unlimited number of iterations
+        ncfile.createDimension('replica', self.nreplicas) # number of replicas
+        ncfile.createDimension('atom', self.natoms) # number of atoms in system
+        ncfile.createDimension('spatial', 3) # number of spatial dimensions
+        setattr(ncfile, 'title', self.title)
+        setattr(ncfile, 'application', 'YANK')
+        setattr(ncfile, 'first_iteration', self.iteration)
+        self._initialize_positions_netcdf(ncfile)
+        ncfile.sync()
+
+        # Record the segment in the manifest only once the file exists.
+        segments.append({'file': os.path.basename(segment_filename), 'first_iteration': int(self.iteration)})
+        write_segment_manifest(self.store_filename, segments)
+
+        self.segment_ncfile = ncfile
+        self._segment_filename = segment_filename
+        self.segment_first_iteration = self.iteration
+
+    def _get_segment_filename(self, segment):
+        """Return the path of a segment file from its entry in the manifest."""
+        return os.path.join(os.path.dirname(self.store_filename), segment['file'])
+
+    def _get_resume_segments(self, last_iteration):
+        """Return the segments in the manifest that start at or before the last stored iteration."""
+        return [segment for segment in read_segment_manifest(self.store_filename)
+                if segment['first_iteration'] <= last_iteration]
+
+    def _reopen_segment(self):
+        """
+        Reopen for appending the segment file containing the last stored iteration.
+
+        Segments starting after the last iteration stored in the main file (e.g. created right
+        before a crash) are removed from the manifest and will be overwritten. If no segment
+        is left (e.g. after a crash before the first segment was recorded), a new segment is
+        started with the next iteration.
+
+        """
+        segments = self._get_resume_segments(self.iteration)
+        write_segment_manifest(self.store_filename, segments)
+        if len(segments) == 0:
+            self.segment_ncfile = None
+            return
+
+        segment = segments[-1]
+        self._segment_filename = self._get_segment_filename(segment)
+        self.segment_first_iteration = segment['first_iteration']
+        self.segment_ncfile = netcdf.Dataset(self._segment_filename, 'a')
+
     @delayed_termination
     def _write_iteration_netcdf(self):
         """
@@ -1847,11 +2182,23 @@ class ReplicaExchange(object):
 
         initial_time = time.time()
 
-        # Store replica positions.
-        for replica_index in range(self.nstates):
-            positions = self.replica_positions[replica_index]
-            x = positions / unit.nanometers
-            self.ncfile.variables['positions'][self.iteration,replica_index,:,:] = x[:,:]
+        # Determine where positions and box vectors are stored.
+        if self._segmented:
+            self._open_segment()
+            positions_ncfile = self.segment_ncfile
+            frame = self.iteration - self.segment_first_iteration
+        else:
+            positions_ncfile = self.ncfile
+            frame = self.iteration
+
+        # Store replica positions according to the storage policy.
+        if (self.positions_stride > 0) and (self.iteration % self.positions_stride == 0):
+            for replica_index in range(self.nstates):
+                positions = self.replica_positions[replica_index]
+                x = positions / unit.nanometers
+                if self.positions_atom_indices is not None:
+                    x = x[self.positions_atom_indices,:]
+                positions_ncfile.variables['positions'][frame,replica_index,:,:] = x[:,:]
 
         # Store box vectors and volume.
         for replica_index in range(self.nstates):
@@ -1859,10 +2206,14 @@ class ReplicaExchange(object):
             state = self.states[state_index]
             box_vectors = self.replica_box_vectors[replica_index]
             for i in range(3):
-                self.ncfile.variables['box_vectors'][self.iteration,replica_index,i,:] = (box_vectors[i] / unit.nanometers)
+                positions_ncfile.variables['box_vectors'][frame,replica_index,i,:] = (box_vectors[i] / unit.nanometers)
             volume = state._volume(box_vectors)
             self.ncfile.variables['volumes'][self.iteration,replica_index] = volume / (unit.nanometers**3)
 
+        # The segment is synced first so that the main file never refers to missing positions.
+        if self._segmented:
+            self.segment_ncfile.sync()
+
         # Store state information.
         self.ncfile.variables['states'][self.iteration,:] = self.replica_states[:]
 
@@ -1874,12 +2225,23 @@ class ReplicaExchange(object):
         self.ncfile.variables['proposed'][self.iteration,:,:] = self.Nij_proposed[:,:]
         self.ncfile.variables['accepted'][self.iteration,:,:] = self.Nij_accepted[:,:]
 
-        # Store timestamp this iteration was written.
-        self.ncfile.variables['timestamp'][self.iteration] = time.ctime()
+        # Store timestamp this iteration was written (as a string in stores created by older versions).
+        if self.ncfile.variables['timestamp'].dtype == str:
+            self.ncfile.variables['timestamp'][self.iteration] = time.ctime()
+        else:
+            self.ncfile.variables['timestamp'][self.iteration] = time.time()
+
+        # Mirror this iteration in the energy store.
+        if self.energy_ncfile is not None:
+            for variable_name, ncvar in self.energy_ncfile.variables.items():
+                if ncvar.dimensions[:1] == ('iteration',):
+                    ncvar[self.iteration] = self.ncfile.variables[variable_name][self.iteration]
 
         # Force sync to disk to avoid data loss.
         presync_time = time.time()
         self.ncfile.sync()
+        if (self.energy_ncfile is not None) and (self.iteration % self.energy_store_sync_interval == 0):
+            self.energy_ncfile.sync()
 
         # Print statistics.
         final_time = time.time()
@@ -1889,6 +2251,173 @@ class ReplicaExchange(object):
 
         return
 
+    def _write_timings_netcdf(self, iteration, timings):
+        """
+        Store the wall-clock timings of an iteration in the timings group.
+
+        The timings are written to the energy store as well, if used. They are
+        synced to disk together with the next iteration.
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration the timings refer to.
+        timings : dict
+            timings[name] is the time in seconds spent in the step 'name' of the
+            iteration, or the memory diagnostic 'name', where name is a variable
+            of the timings group.
+
+        """
+        if self.mpicomm and self.mpicomm.rank != 0:
+            return
+
+        for ncfile in [self.ncfile, self.energy_ncfile]:
+            if ncfile is None or 'timings' not in ncfile.groups:
+                continue
+            ncgrp_timings = ncfile.groups['timings']
+            for name, elapsed_time in timings.items():
+                if name in ncgrp_timings.variables:
+                    ncgrp_timings.variables[name][iteration] = elapsed_time
+
+    def _initialize_memory_netcdf(self, ncfile):
+        """
+        Create the memory diagnostics variables in the timings group, if they do not exist.
+
+        Parameters
+        ----------
+        ncfile : netcdf.Dataset
+            The main store file or the energy store file.
+
+        """
+        ncgrp_timings = ncfile.groups['timings']
+        for variable_name in memory.MEMORY_VARIABLES:
+            if variable_name not in ncgrp_timings.variables:
+                ncvar = ncgrp_timings.createVariable(variable_name, 'f', ('iteration',), zlib=False, chunksizes=(1,))
+                setattr(ncvar, 'units', 'MB')
+        if 'top_allocations' not in ncgrp_timings.variables:
+            ncvar = ncgrp_timings.createVariable('top_allocations', str, ('iteration',), zlib=False)
+            setattr(ncvar, 'long_name', "top_allocations[iteration] is a JSON list of [location, MB, number of blocks] of the source lines that allocated the largest amount of memory, recorded every memory_diagnostics_interval iterations.")
+
+    def _measure_memory(self, iteration):
+        """
+        Measure the memory used by the processes and held by each subsystem.
+
+        This must be called by all the nodes.
+
+        Parameters
+        ----------
+        iteration : int
+            The iteration the measure refers to.
+
+        Returns
+        -------
+        diagnostics : dict
+            diagnostics[name] is the memory in MB of the variable 'name' of the timings group,
+            the largest among the nodes. On the iterations that are a multiple of
+            memory_diagnostics_interval, diagnostics['top_allocations'] is the JSON list of the
+            top allocations of the root node, if tracemalloc is available.
+
+        """
+        # The Systems do not change during the simulation.
+        if self._systems_megabytes is None:
+            self._systems_megabytes = memory.get_systems_megabytes([state.system for state in self.states])
+
+        replica_arrays = self.replica_positions + self.replica_box_vectors + [
+            self.u_kl, self.swap_Pij_accepted, self.Nij_proposed, self.Nij_accepted,
+            self.Nij_proposed_cumulative, self.Nij_accepted_cumulative]
+        diagnostics = {'rss': memory.get_rss(),
+                       'peak_rss': memory.get_peak_rss(),
+                       'contexts': sum(self._contexts_megabytes.values()),
+                       'systems': self._systems_megabytes,
+                       'replica_buffers': memory.get_arrays_megabytes(replica_arrays),
+                       'trace_buffer': memory.get_trace_buffer_megabytes()}
+
+        # Report the node using the most memory.
+        if self.mpicomm:
+            with tracing.span('gather memory', 'mpi'):
+                node_diagnostics = self.mpicomm.gather(diagnostics, root=0)
+            if self.mpicomm.rank == 0:
+                diagnostics = {name: max(node_diagnostic[name] for node_diagnostic in node_diagnostics)
+                               for name in diagnostics}
+
+        if self.memory_diagnostics_interval and (iteration % self.memory_diagnostics_interval == 0):
+            top_allocations = memory.get_top_allocations()
+            if top_allocations is not None:
+                diagnostics['top_allocations'] = json.dumps(top_allocations)
+
+        return diagnostics
+
+    def _initialize_energy_store(self):
+        """
+        Create or reopen the energy store file next to the main NetCDF file.
+
+        The energy store duplicates the per-iteration variables listed in energy_store_variables
+        together with the state temperatures and the standard state correction, so that analysis
+        and status queries never have to open the main store file containing the positions.
+        Iterations that are in the main store but missing from the energy store (e.g. because
+        the file was deleted or not synced before a crash) are copied over.
+
+        """
+        energy_store_filename = get_companion_store_path(self.store_filename, 'energies.nc')
+
+        if os.path.exists(energy_store_filename) and (os.path.getsize(energy_store_filename) > 0):
+            logger.debug("Reopening energy store file '%s'..." % energy_store_filename)
+            ncfile = netcdf.Dataset(energy_store_filename, 'a')
+        else:
+            logger.debug("Creating energy store file '%s'..." % energy_store_filename)
+            ncfile = netcdf.Dataset(energy_store_filename, 'w', version='NETCDF4')
+
+            # Mirror dimensions and global attributes of the main store file.
+            for dimension_name, dimension in self.ncfile.dimensions.items():
+                ncfile.createDimension(dimension_name, None if dimension.isunlimited() else len(dimension))
+            for attribute_name in self.ncfile.ncattrs():
+                setattr(ncfile, attribute_name, getattr(self.ncfile, attribute_name))
+
+            # Create per-iteration variables, which are filled in below.
+            for variable_name in self.energy_store_variables:
+                if variable_name in self.ncfile.variables:
+                    _copy_netcdf_variable(self.ncfile.variables[variable_name], ncfile, copy_data=False)
+
+            # Copy the few static data needed by the analysis.
+            for group_name, variable_names in [('thermodynamic_states', ['nstates', 'temperatures', 'pressures']),
+                                               ('metadata', ['standard_state_correction']),
+                                               ('options', ['number_of_iterations'])]:
+                if group_name not in self.ncfile.groups:
+                    continue
+                ncgrp = ncfile.createGroup(group_name)
+                for variable_name in variable_names:
+                    if variable_name in self.ncfile.groups[group_name].variables:
+                        _copy_netcdf_variable(self.ncfile.groups[group_name].variables[variable_name], ncgrp)
+
+            # Mirror the timings reported by status queries.
+            if 'timings' in self.ncfile.groups:
+                ncgrp_timings = self.ncfile.groups['timings']
+                ncgrp = ncfile.createGroup('timings')
+                for attribute_name in ncgrp_timings.ncattrs():
+                    setattr(ncgrp, attribute_name, getattr(ncgrp_timings, attribute_name))
+                for ncvar in ncgrp_timings.variables.values():
+                    _copy_netcdf_variable(ncvar, ncgrp, copy_data=False)
+
+        # Backfill the iterations that are missing from the energy store.
+        niterations = self.ncfile.variables['states'].shape[0]
+        mirrored_groups = [(ncfile, self.ncfile)]
+        if 'timings' in ncfile.groups:
+            mirrored_groups.append((ncfile.groups['timings'], self.ncfile.groups['timings']))
+        for ncgrp, main_ncgrp in mirrored_groups:
+            for variable_name, ncvar in ncgrp.variables.items():
+                if ncvar.dimensions[:1] != ('iteration',):
+                    continue
+                nstored = ncvar.shape[0]
+                nmain = min(niterations, main_ncgrp.variables[variable_name].shape[0])
+                if nstored < nmain:
+                    logger.debug("Copying iterations %d-%d of '%s' to energy store..." % (nstored, nmain-1, variable_name))
+                    ncvar[nstored:nmain] = main_ncgrp.variables[variable_name][nstored:nmain]
+
+        ncfile.sync()
+        self.energy_ncfile = ncfile
+
+        return
+
     def _run_sanity_checks(self):
         """
         Run some checks on current state information to see if something has gone wrong that precludes continuation.
@@ -2214,7 +2743,7 @@ class ReplicaExchange(object):
             ncgrp = ncfile.groups['metadata']
             self.metadata = self._restore_dict_from_netcdf(ncgrp)
 
-    def _resume_from_netcdf(self, ncfile):
+    def _resume_from_netcdf(self, ncfile, positions_ncfile=None, first_iteration=0):
         """
         Resume execution by reading current positions and energies from a NetCDF file.
 
@@ -2222,29 +2751,44 @@ class ReplicaExchange(object):
         ----------
         ncfile : netcdf.Dataset
             The NetCDF file in which metadata is to be stored.
+        positions_ncfile : netcdf.Dataset, optional
+            The file storing the positions and box vectors of the last iteration, if it
+            is not ncfile (e.g. the last segment of a segmented store).
+        first_iteration : int, optional
+            The iteration stored in the first frame of positions_ncfile (default: 0).
 
         """
+        if positions_ncfile is None:
+            positions_ncfile = ncfile
 
         # TODO: Perform sanity check on file before resuming
 
         # Get current dimensions.
-        self.iteration = ncfile.variables['positions'].shape[0] - 1
-        self.nstates = ncfile.variables['positions'].shape[1]
-        self.natoms = ncfile.variables['positions'].shape[2]
+        self.iteration = ncfile.variables['states'].shape[0] - 1
+        self.nstates = ncfile.variables['states'].shape[1]
+        self.natoms = len(ncfile.dimensions['atom'])
         self.nreplicas = self.nstates
         logger.debug("iteration = %d, nstates = %d, natoms = %d" % (self.iteration, self.nstates, self.natoms))
 
+        # If the trajectory is strided, resume from the last iteration whose positions are stored.
+        last_iteration = self._get_last_stored_positions_iteration(self.iteration)
+        if last_iteration < self.iteration:
+            logger.warning("Positions are stored up to iteration %d; resuming from there." % last_iteration)
+            self.iteration = last_iteration
+        all_positions = positions_ncfile.variables['positions'][self.iteration - first_iteration,:,:,:]
+        all_box_vectors = positions_ncfile.variables['box_vectors'][self.iteration - first_iteration,:,:,:]
+
         # Restore positions.
         self.replica_positions = list()
         for replica_index in range(self.nstates):
-            x = ncfile.variables['positions'][self.iteration,replica_index,:,:].astype(np.float64).copy()
+            x = all_positions[replica_index,:,:].astype(np.float64).copy()
             positions = unit.Quantity(x, unit.nanometers)
             self.replica_positions.append(positions)
 
         # Restore box vectors.
         self.replica_box_vectors = list()
         for replica_index in range(self.nstates):
-            x = ncfile.variables['box_vectors'][self.iteration,replica_index,:,:].astype(np.float64).copy()
+            x = all_box_vectors[replica_index,:,:].astype(np.float64).copy()
             box_vectors = unit.Quantity(x, unit.nanometers)
             self.replica_box_vectors.append(box_vectors)
 
@@ -2254,6 +2798,323 @@ class ReplicaExchange(object):
         # Restore energies.
         self.u_kl = ncfile.variables['energies'][self.iteration,:,:].copy()
 
+        # Restore cumulative mixing statistics.
+        self.Nij_accepted_cumulative = ncfile.variables['accepted'][:self.iteration+1,:,:].sum(0).astype(np.int64)
+        self.Nij_proposed_cumulative = ncfile.variables['proposed'][:self.iteration+1,:,:].sum(0).astype(np.int64)
+
+    def _read_positions_policies(self, positions_ncfile):
+        """
+        Read the position storage policies, which are fixed when the store file is created.
+
+        Parameters
+        ----------
+        positions_ncfile : netcdf.Dataset
+            The main store file or, in segmented stores, a segment file.
+
+        """
+        if 'positions' in positions_ncfile.variables:
+            self.positions_stride = int(getattr(positions_ncfile.variables['positions'], 'stride', 1))
+        else:
+            self.positions_stride = 0
+        if 'positions_atom_indices' in positions_ncfile.variables:
+            self.positions_atom_indices = positions_ncfile.variables['positions_atom_indices'][:].tolist()
+        else:
+            self.positions_atom_indices = None
+
+    def _get_last_stored_positions_iteration(self, last_iteration):
+        """Return the last iteration up to last_iteration whose full positions are in the trajectory."""
+        if (self.positions_stride == 0) or (self.positions_atom_indices is not None):
+            raise Exception("The trajectory in %s does not contain the full positions; the restart "
+                            "checkpoint is needed to resume." % self.store_filename)
+        return last_iteration - last_iteration % self.positions_stride
+
+    def _resume_from_store(self):
+        """
+        Resume execution reading the state of the simulation from the store file.
+
+        In segmented stores, only the segment containing the positions of the resumed
+        iteration is opened.
+
+        """
+        logger.debug("Reading NetCDF file '%s'..." % self.store_filename)
+        ncfile = netcdf.Dataset(self.store_filename, 'r')
+        try:
+            if not self._segmented:
+                self._read_positions_policies(ncfile)
+                self._resume_from_netcdf(ncfile)
+                return
+
+            # The storage policies are the same in all the segments.
+            last_iteration = ncfile.variables['states'].shape[0] - 1
+            segments = self._get_resume_segments(last_iteration)
+            if len(segments) == 0:
+                raise Exception("No segment of %s contains positions to resume from." % self.store_filename)
+            segment_ncfile = netcdf.Dataset(self._get_segment_filename(segments[-1]), 'r')
+            self._read_positions_policies(segment_ncfile)
+            segment = segments[-1]
+            last_iteration = self._get_last_stored_positions_iteration(last_iteration)
+            if last_iteration < segment['first_iteration']:
+                segment = [segment for segment in segments if segment['first_iteration'] <= last_iteration][-1]
+                segment_ncfile.close()
+                segment_ncfile = netcdf.Dataset(self._get_segment_filename(segment), 'r')
+            try:
+                self._resume_from_netcdf(ncfile, segment_ncfile, segment['first_iteration'])
+            finally:
+                segment_ncfile.close()
+        finally:
+            ncfile.close()
+
+    def _check_restart_checkpoint_policy(self):
+        """Enable the restart checkpoint if the trajectory does not contain the full positions of every iteration."""
+        if (self.positions_stride != 1) or (self.positions_atom_indices is not None):
+            if not self.restart_checkpoint:
+                logger.warning("Enabling the restart checkpoint since the trajectory does not "
+                               "contain the full positions of every iteration.")
+            self.restart_checkpoint = True
+
+    def _get_status_file_path(self):
+        """Return the path of the JSON status file."""
+        return get_companion_store_path(self.store_filename, STATUS_FILE_SUFFIX)
+
+    def _get_status(self, timings):
+        """
+        Return the live status of the simulation after an iteration.
+
+        Parameters
+        ----------
+        timings : dict
+           The timings and memory diagnostics of the iteration just stored.
+
+        Returns
+        -------
+        status : dict
+           The JSON-serializable status written in the status file.
+
+        """
+        # Throughput over the most recent iterations, with the semantics of analyze.read_throughput().
+        self._recent_timings.append((timings['iteration'], sum(
+            timings[name] for name in ['mixing', 'energies', 'storage', 'analysis'])))
+        total_time = sum(iteration_time for iteration_time, _ in self._recent_timings)
+        overhead_time = sum(overhead for _, overhead in self._recent_timings)
+        seconds_per_iteration = total_time / len(self._recent_timings)
+        ns_per_iteration = self.nsteps_per_iteration * self.timestep / unit.nanoseconds
+        niterations_remaining = max(0, self.number_of_iterations - self.iteration)
+        status = dict(iteration=int(self.iteration), number_of_iterations=int(self.number_of_iterations),
+                      nstates=int(self.nstates), natoms=int(self.natoms),
+                      seconds_per_iteration=seconds_per_iteration,
+                      overhead_fraction=overhead_time / total_time if total_time > 0.0 else 0.0,
+                      ns_per_day=ns_per_iteration / seconds_per_iteration * 24*60*60 if seconds_per_iteration > 0.0 else None,
+                      niterations_remaining=int(niterations_remaining),
+                      eta=niterations_remaining * seconds_per_iteration)
+
+        # Fraction of the swaps accepted among all states and between neighbor states.
+        accepted = self.Nij_accepted_cumulative - np.diag(np.diag(self.Nij_accepted_cumulative))
+        proposed = self.Nij_proposed_cumulative - np.diag(np.diag(self.Nij_proposed_cumulative))
+        status['acceptance_rate'] = float(accepted.sum()) / proposed.sum() if proposed.sum() > 0 else None
+        status['neighbor_acceptance_rates'] = []
+        for state_index in range(self.nstates - 1):
+            neighbors = (slice(state_index, state_index + 2), slice(state_index, state_index + 2))
+            nproposed = proposed[neighbors].sum()
+            status['neighbor_acceptance_rates'].append(
+                float(accepted[neighbors].sum()) / nproposed if nproposed > 0 else None)
+
+        # Second largest eigenvalue of the state mixing transition matrix.
+        status['perron_eigenvalue'] = None
+        if self.iteration >= 2 and self.nstates > 1:
+            mu = np.sort(np.real(np.linalg.eigvals(self._get_mixing_statistics())))[::-1]
+            status['perron_eigenvalue'] = float(mu[1])
+
+        # Latest free energy difference between the end states estimated by the online analysis.
+        analysis = getattr(self, 'analysis', None)
+        if self.online_analysis and analysis is not None:
+            status['DeltaF'] = float(analysis['Delta_f_ij'][0, -1])
+            status['dDeltaF'] = float(analysis['dDelta_f_ij'][0, -1])
+        else:
+            status['DeltaF'] = status['dDeltaF'] = None
+
+        # Memory diagnostics, if measured.
+        if 'rss' in timings:
+            if 'top_allocations' in timings:
+                self._top_allocations = json.loads(timings['top_allocations'])
+            status['memory'] = {name: float(timings[name]) for name in memory.MEMORY_VARIABLES}
+            status['memory']['top_allocations'] = self._top_allocations
+
+        status['last_write_time'] = time.time()
+        return status
+
+    def _write_status_file(self, timings):
+        """
+        Atomically replace the JSON status file with the status after the last iteration.
+
+        Parameters
+        ----------
+        timings : dict
+           The timings and memory diagnostics of the iteration just stored.
+
+        """
+        if self.mpicomm and self.mpicomm.rank != 0:
+            return
+
+        status_path = self._get_status_file_path()
+        tmp_status_path = status_path + '.tmp'
+        try:
+            with open(tmp_status_path, 'w') as f:
+                json.dump(self._get_status(timings), f)
+            os.rename(tmp_status_path, status_path)
+        except:
+            # Do not leave a partially written status file behind.
+            if os.path.exists(tmp_status_path):
+                os.remove(tmp_status_path)
+            raise
+
+    def _get_restart_checkpoint_path(self):
+        """Return the path of the restart checkpoint file."""
+        return get_companion_store_path(self.store_filename, 'checkpoint.npz')
+
+    def _get_restart_checkpoint_data(self):
+        """
+        Return the arrays to store in the restart checkpoint.
+
+        Velocities are not included since they are redrawn from the Maxwell-Boltzmann
+        distribution at the beginning of every iteration.
+
+        Returns
+        -------
+        data : dict of numpy.ndarray
+           The arrays describing the current state of the simulation.
+
+        """
+        rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+        data = dict(iteration=np.array(self.iteration),
+                    positions=np.array([positions / unit.nanometers for positions in self.replica_positions], np.float64),
+                    box_vectors=np.array([box_vectors / unit.nanometers for box_vectors in self.replica_box_vectors], np.float64),
+                    replica_states=np.array(self.replica_states),
+                    u_kl=np.array(self.u_kl),
+                    Nij_proposed_cumulative=np.array(self.Nij_proposed_cumulative),
+                    Nij_accepted_cumulative=np.array(self.Nij_accepted_cumulative),
+                    positions_stride=np.array(self.positions_stride),
+                    rng_keys=rng_keys,
+                    rng_state=np.array([rng_pos, rng_has_gauss]),
+                    rng_cached_gaussian=np.array(rng_cached_gaussian))
+        if self.positions_atom_indices is not None:
+            data['positions_atom_indices'] = np.array(self.positions_atom_indices, np.int64)
+        return data
+
+    def _write_restart_checkpoint(self):
+        """
+        Atomically replace the restart checkpoint with the current state of the simulation.
+
+        The checkpoint is first written to a temporary file which is then renamed, so
+        that a crash never leaves a truncated checkpoint behind. It must be written after
+        the iteration has been synced to the NetCDF file; if the run is killed in between,
+        resuming from the checkpoint runs the last stored iteration again.
+
+        """
+
+        if self.mpicomm:
+            # Only the root node will write data.
+            if self.mpicomm.rank != 0: return
+
+        if not self.restart_checkpoint:
+            return
+
+        initial_time = time.time()
+        checkpoint_path = self._get_restart_checkpoint_path()
+        tmp_checkpoint_path = checkpoint_path + '.tmp'
+        with open(tmp_checkpoint_path, 'wb') as f:
+            np.savez(f, **self._get_restart_checkpoint_data())
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_checkpoint_path, checkpoint_path)
+        logger.debug("Writing restart checkpoint took %.3f s" % (time.time() - initial_time))
+
+    def _restore_restart_checkpoint(self, checkpoint):
+        """
+        Restore the state of the simulation from the arrays of the restart checkpoint.
+
+        Parameters
+        ----------
+        checkpoint : dict-like of numpy.ndarray
+           The arrays returned by _get_restart_checkpoint_data().
+
+        """
+        self.iteration = int(checkpoint['iteration'])
+        self.nstates = len(checkpoint['replica_states'])
+        self.natoms = checkpoint['positions'].shape[1]
+        self.nreplicas = self.nstates
+
+        self.replica_positions = [unit.Quantity(positions.copy(), unit.nanometers)
+                                  for positions in checkpoint['positions']]
+        self.replica_box_vectors = [unit.Quantity(box_vectors.copy(), unit.nanometers)
+                                    for box_vectors in checkpoint['box_vectors']]
+        self.replica_states = checkpoint['replica_states'].copy()
+        self.u_kl = checkpoint['u_kl'].copy()
+        self.Nij_proposed_cumulative = checkpoint['Nij_proposed_cumulative'].copy()
+        self.Nij_accepted_cumulative = checkpoint['Nij_accepted_cumulative'].copy()
+
+        # Position storage policies are fixed when the store file is created.
+        self.positions_stride = int(checkpoint['positions_stride'])
+        if 'positions_atom_indices' in checkpoint:
+            self.positions_atom_indices = checkpoint['positions_atom_indices'].tolist()
+        else:
+            self.positions_atom_indices = None
+
+        # Continue the random number sequence on the root node. Other nodes have their own seeds.
+        if (self.mpicomm is None) or (self.mpicomm.rank == 0):
+            rng_pos, rng_has_gauss = checkpoint['rng_state']
+            np.random.set_state(('MT19937', checkpoint['rng_keys'], int(rng_pos), int(rng_has_gauss),
+                                 float(checkpoint['rng_cached_gaussian'])))
+
+    def _resume_from_restart_checkpoint(self):
+        """
+        Resume execution from the restart checkpoint if it is consistent with the store file.
+
+        Only the number of iterations in the store file is read to check the checkpoint,
+        which can be at the last stored iteration or at the one before. No per-iteration
+        data is read from the store and segment files.
+
+        Returns
+        -------
+        resumed : bool
+           True if the simulation state was restored from the checkpoint, False if the
+           checkpoint is missing, unreadable or out of date.
+
+        """
+        checkpoint_path = self._get_restart_checkpoint_path()
+        if not os.path.isfile(checkpoint_path):
+            return False
+
+        try:
+            checkpoint = np.load(checkpoint_path)
+            checkpoint = {name: checkpoint[name] for name in checkpoint.files}
+        except Exception as e:
+            logger.warning("Could not read restart checkpoint %s (%s); resuming from the store file." % (checkpoint_path, str(e)))
+            return False
+
+        if 'positions_stride' not in checkpoint:
+            logger.warning("Restart checkpoint %s was written by an older version; resuming from the store file." % checkpoint_path)
+            return False
+
+        # The checkpoint is replaced after the iteration has been synced to the store
+        # file, so it lags one iteration behind if the run was killed in between. The
+        # cumulative mixing statistics come from the checkpoint, and the next iteration
+        # overwrites the last one in the store.
+        ncfile = netcdf.Dataset(self.store_filename, 'r')
+        last_iteration = ncfile.variables['states'].shape[0] - 1
+        ncfile.close()
+        checkpoint_iteration = int(checkpoint['iteration'])
+        if checkpoint_iteration == last_iteration - 1:
+            logger.warning("Restart checkpoint is at iteration %d but the store file is at iteration %d; "
+                           "iteration %d will be run again." % (checkpoint_iteration, last_iteration, last_iteration))
+        elif checkpoint_iteration != last_iteration:
+            logger.warning("Restart checkpoint is at iteration %d but the store file is at iteration %d; "
+                           "resuming from the store file." % (checkpoint_iteration, last_iteration))
+            return False
+
+        self._restore_restart_checkpoint(checkpoint)
+        logger.debug("Resumed from restart checkpoint at iteration %d" % self.iteration)
+        return True
+
     def _show_energies(self):
         """
         Show energies (in units of kT) for all replicas at all states.
@@ -2342,13 +3203,12 @@ class ReplicaExchange(object):
         # Only root node can perform analysis.
         if self.mpicomm and (self.mpicomm.rank != 0): return
 
-        # Determine how many iterations there are data available for.
-        replica_states = self.ncfile.variables['states'][:,:]
-        u_nkl_replica = self.ncfile.variables['energies'][:,:,:]
+        # Read from the lightweight energy store when available.
+        ncfile = self.energy_ncfile if self.energy_ncfile is not None else self.ncfile
 
         # Determine number of iterations completed.
-        number_of_iterations_completed = replica_states.shape[0]
-        nstates = replica_states.shape[1]
+        number_of_iterations_completed = ncfile.variables['states'].shape[0]
+        nstates = ncfile.variables['states'].shape[1]
 
         # Online analysis can only be performed after a sufficient quantity of data has been collected.
         if (number_of_iterations_completed < self.online_analysis_min_iterations):
@@ -2356,32 +3216,36 @@ class ReplicaExchange(object):
             self.analysis = None
             return
 
-        # Deconvolute replicas and compute total simulation effective self-energy timeseries.
-        u_kln = np.zeros([nstates, nstates, number_of_iterations_completed], np.float32)
-        u_n = np.zeros([number_of_iterations_completed], np.float64)
-        for iteration in range(number_of_iterations_completed):
-            state_indices = replica_states[iteration,:]
-            u_n[iteration] = 0.0
-            for replica_index in range(nstates):
-                state_index = state_indices[replica_index]
-                u_n[iteration] += u_nkl_replica[iteration,replica_index,state_index]
-                u_kln[state_index,:,iteration] = u_nkl_replica[iteration,replica_index,:]
+        # Load the analysis intermediates persisted by previous analyses.
+        from analyze import read_energies, update_u_n, read_analysis_cache, write_analysis_cache, detect_equilibration
+        if self._analysis_cache is None:
+            self._analysis_cache = read_analysis_cache(self.store_filename, ncfile)
+
+        # Compute total simulation effective self-energy timeseries, reading only the new iterations.
+        u_n = update_u_n(ncfile, self._analysis_cache.get('u_n'))
+        self._analysis_cache.update(u_n=u_n, niterations=number_of_iterations_completed)
 
         # Determine optimal equilibration time, statistical inefficiency, and effectively uncorrelated sample indices.
         from pymbar import timeseries
-        [t0, g, Neff_max] = timeseries.detectEquilibration(u_n)
+        [t0, g, Neff_max] = detect_equilibration(u_n, t0_guess=self._analysis_cache.get('t0'))
+        self._analysis_cache['t0'] = t0
         indices = t0 + timeseries.subsampleCorrelatedData(u_n[t0:], g=g)
         N_k = indices.size * np.ones([nstates], np.int32)
 
+        # Deconvolute replicas reading only the uncorrelated samples.
+        u_kln, _ = read_energies(ncfile, iterations=indices)
+
         # Next, analyze with pymbar, initializing with last estimate of free energies.
         from pymbar import MBAR
-        if hasattr(self, 'f_k'):
-            mbar = MBAR(u_kln[:,:,indices], N_k, initial_f_k=self.f_k)
+        if len(self._analysis_cache.get('f_k', [])) == nstates:
+            mbar = MBAR(u_kln, N_k, initial_f_k=self._analysis_cache['f_k'])
         else:
-            mbar = MBAR(u_kln[:,:,indices], N_k)
+            mbar = MBAR(u_kln, N_k)
 
         # Cache current free energy estimate to save time in future MBAR solutions.
         self.f_k = mbar.f_k
+        self._analysis_cache['f_k'] = mbar.f_k
+        write_analysis_cache(self.store_filename, self._analysis_cache)
 
         # Compute entropy and enthalpy.
         [Delta_f_ij, dDelta_f_ij, Delta_u_ij, dDelta_u_ij, Delta_s_ij, dDelta_s_ij] = mbar.computeEntropyAndEnthalpy()
@@ -30,6 +30,9 @@ from repex import ReplicaExchange
 from repex import MAX_SEED
 
 from alchemy import AbsoluteAlchemicalFactory, AlchemicalState
+from utils import delayed_termination
+import tracing
+import memory
 
 #=============================================================================================
 # Alchemical Modified Hamiltonian exchange class.
@@ -81,6 +84,9 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
     # Options to store.
     options_to_store = ReplicaExchange.options_to_store + ['mc_atoms', 'mc_displacement', 'mc_rotation', 'displacement_sigma', 'displacement_trials_accepted', 'rotation_trials_accepted']
 
+    # Per-iteration variables that are mirrored in the energy store file.
+    energy_store_variables = ReplicaExchange.energy_store_variables + ['fully_interacting_energies']
+
     def __init__(self, store_filename, **kwargs):
         """Constructor.
 
@@ -360,10 +366,12 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         state = self.states[0]
         self._integrator = openmm.LangevinIntegrator(state.temperature, self.collision_rate, self.timestep)
         self._integrator.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
-        if self.platform:
-            self._context = openmm.Context(state.system, self._integrator, self.platform)
-        else:
-            self._context = openmm.Context(state.system, self._integrator)
+        with tracing.span('Context', 'openmm'), memory.RSSGrowth() as context_memory:
+            if self.platform:
+                self._context = openmm.Context(state.system, self._integrator, self.platform)
+            else:
+                self._context = openmm.Context(state.system, self._integrator)
+        self._contexts_megabytes['context'] = context_memory.megabytes
         final_time = time.time()
         elapsed_time = final_time - initial_time
         logger.debug("Context creation took %.3f s." % elapsed_time)
@@ -374,10 +382,12 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             logger.debug("Creating and caching Context and Integrator for fully interacting state.")
             state = self.fully_interacting_state
             integrator = openmm.VerletIntegrator(self.timestep)
-            if self.platform:
-                self._fully_interacting_context = openmm.Context(state.system, integrator, self.platform)
-            else:
-                self._fully_interacting_context = openmm.Context(state.system, integrator)
+            with tracing.span('Context', 'openmm', fully_interacting=True), memory.RSSGrowth() as context_memory:
+                if self.platform:
+                    self._fully_interacting_context = openmm.Context(state.system, integrator, self.platform)
+                else:
+                    self._fully_interacting_context = openmm.Context(state.system, integrator)
+            self._contexts_megabytes['fully_interacting_context'] = context_memory.megabytes
             final_time = time.time()
             elapsed_time = final_time - initial_time
             logger.debug("Fully interacting ontext creation took %.3f s." % elapsed_time)
@@ -652,7 +662,8 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                 barostat.setRandomNumberSeed(int(np.random.randint(0, MAX_SEED)))
 
         # Set alchemical state.
-        AbsoluteAlchemicalFactory.perturbContext(context, state.alchemical_state)
+        with tracing.span('perturbContext', 'openmm', state=state_index):
+            AbsoluteAlchemicalFactory.perturbContext(context, state.alchemical_state)
 
         # Set box vectors.
         box_vectors = self.replica_box_vectors[replica_index]
@@ -671,42 +682,44 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
         # TODO: Can combine these displacements and/or use cached potential energies to speed up this phase.
         # TODO: Break MC displacement and rotation into member functions and write separate unit tests.
         if self.mc_displacement and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Make symmetric Gaussian trial displacement of ligand.
-            perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            # Accept or reject with Metropolis criteria.
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.displacement_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print "translation du = %f (%d)" % (du, self.displacement_trials_accepted)
-            # Print timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.displacement_trial_time += elapsed_time
+            with tracing.span('MC displacement', 'openmm', replica=replica_index):
+                initial_time = time.time()
+                # Store original positions and energy.
+                original_positions = self.replica_positions[replica_index]
+                u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+                # Make symmetric Gaussian trial displacement of ligand.
+                perturbed_positions = self.propose_displacement(self.displacement_sigma, original_positions, self.mc_atoms)
+                u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+                # Accept or reject with Metropolis criteria.
+                du = u_new - u_old
+                if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+                    self.displacement_trials_accepted += 1
+                    self.replica_positions[replica_index] = perturbed_positions
+                #print "translation du = %f (%d)" % (du, self.displacement_trials_accepted)
+                # Print timing information.
+                final_time = time.time()
+                elapsed_time = final_time - initial_time
+                self.displacement_trial_time += elapsed_time
 
         # Attempt random rotation of ligand.
         if self.mc_rotation and (self.mc_atoms is not None):
-            initial_time = time.time()
-            # Store original positions and energy.
-            original_positions = self.replica_positions[replica_index]
-            u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
-            # Compute new potential.
-            perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
-            u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
-            du = u_new - u_old
-            if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
-                self.rotation_trials_accepted += 1
-                self.replica_positions[replica_index] = perturbed_positions
-            #print "rotation du = %f (%d)" % (du, self.rotation_trials_accepted)
-            # Accumulate timing information.
-            final_time = time.time()
-            elapsed_time = final_time - initial_time
-            self.rotation_trial_time += elapsed_time
+            with tracing.span('MC rotation', 'openmm', replica=replica_index):
+                initial_time = time.time()
+                # Store original positions and energy.
+                original_positions = self.replica_positions[replica_index]
+                u_old = state.reduced_potential(original_positions, box_vectors=box_vectors, context=context)
+                # Compute new potential.
+                perturbed_positions = self.propose_rotation(original_positions, self.mc_atoms)
+                u_new = state.reduced_potential(perturbed_positions, box_vectors=box_vectors, context=context)
+                du = u_new - u_old
+                if (not np.isnan(u_new)) and ((du <= 0.0) or (np.random.rand() < np.exp(-du))):
+                    self.rotation_trials_accepted += 1
+                    self.replica_positions[replica_index] = perturbed_positions
+                #print "rotation du = %f (%d)" % (du, self.rotation_trials_accepted)
+                # Accumulate timing information.
+                final_time = time.time()
+                elapsed_time = final_time - initial_time
+                self.rotation_trial_time += elapsed_time
 
         #
         # Propagate with dynamics.
@@ -729,20 +742,24 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                     raise Exception('Initial particle positions for replica %d before propagation are NaN' % replica_index)
                 # Set positions.
                 positions = self.replica_positions[replica_index]
-                context.setPositions(positions)
+                with tracing.span('setPositions', 'openmm', replica=replica_index):
+                    context.setPositions(positions)
                 setpositions_end_time = time.time()
                 # Assign Maxwell-Boltzmann velocities.
-                context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
+                with tracing.span('setVelocitiesToTemperature', 'openmm', replica=replica_index):
+                    context.setVelocitiesToTemperature(state.temperature, int(np.random.randint(0, MAX_SEED)))
                 setvelocities_end_time = time.time()
                 # Check if initial potential energy is NaN.
                 if np.isnan(context.getState(getEnergy=True).getPotentialEnergy() / state.kT):
                     raise Exception('Potential for replica %d is NaN before dynamics' % replica_index)
                 # Run dynamics.
-                integrator.step(self.nsteps_per_iteration)
+                with tracing.span('integrator.step', 'openmm', replica=replica_index, nsteps=self.nsteps_per_iteration):
+                    integrator.step(self.nsteps_per_iteration)
                 integrator_end_time = time.time()
                 # Get final positions
                 getstate_start_time = time.time()
-                openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
+                with tracing.span('getState', 'openmm', replica=replica_index):
+                    openmm_state = context.getState(getPositions=True, enforcePeriodicBox=state.system.usesPeriodicBoundaryConditions())
                 getstate_end_time = time.time()
                 # Check if final positions are NaN.
                 positions = openmm_state.getPositions(asNumpy=True)
@@ -834,22 +851,34 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                                                   "interacting state.")
         self.ncfile.sync()
 
+    @delayed_termination
     def _write_iteration_netcdf(self):
+        # Only the root node will write data. Fully interacting energies are
+        # written first so that the parent class mirrors them in the energy
+        # store and syncs both files only once.
+        if self.mpicomm is None or self.mpicomm.rank == 0:
+            if self.fully_interacting_state is not None:
+                self.ncfile.variables['fully_interacting_energies'][self.iteration, :] = self.u_k[:]
+
         super(ModifiedHamiltonianExchange, self)._write_iteration_netcdf()
 
-        # Only the root node will write data.
-        if self.mpicomm is not None and self.mpicomm.rank != 0:
-            return
+    def _resume_from_netcdf(self, ncfile, positions_ncfile=None, first_iteration=0):
+        super(ModifiedHamiltonianExchange, self)._resume_from_netcdf(ncfile, positions_ncfile, first_iteration)
+        # Restore fully interacting energies
+        if 'fully_interacting_energies' in ncfile.variables:
+            self.u_k = ncfile.variables['fully_interacting_energies'][self.iteration, :].copy()
 
+    def _get_restart_checkpoint_data(self):
+        data = super(ModifiedHamiltonianExchange, self)._get_restart_checkpoint_data()
         if self.fully_interacting_state is not None:
-            self.ncfile.variables['fully_interacting_energies'][self.iteration, :] = self.u_k[:]
-            self.ncfile.sync()
+            data['u_k'] = np.array(self.u_k)
+        return data
 
-    def _resume_from_netcdf(self, ncfile):
-        super(ModifiedHamiltonianExchange, self)._resume_from_netcdf(ncfile)
+    def _restore_restart_checkpoint(self, checkpoint):
+        super(ModifiedHamiltonianExchange, self)._restore_restart_checkpoint(checkpoint)
         # Restore fully interacting energies
-        if 'fully_interacting_energies' in ncfile.variables:
-            self.u_k = ncfile.variables['fully_interacting_energies'][self.iteration, :].copy()
+        if 'u_k' in checkpoint:
+            self.u_k = checkpoint['u_k'].copy()
 
     def _compute_energies(self):
         """
@@ -878,12 +907,15 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             # Compute energies for this node's share of states.
             for state_index in range(self.mpicomm.rank, self.nstates, self.mpicomm.size):
                 # Set alchemical state.
-                AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
+                with tracing.span('perturbContext', 'openmm', state=state_index):
+                    AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
+                with tracing.span('compute state energies', 'openmm', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
             # Send final energies to all nodes.
-            energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
+            with tracing.span('allgather energies', 'mpi'):
+                energies_gather = self.mpicomm.allgather(self.u_kl[:,self.mpicomm.rank:self.nstates:self.mpicomm.size])
             for state_index in range(self.nstates):
                 source = state_index % self.mpicomm.size # node with trajectory data
                 index = state_index // self.mpicomm.size # index within trajectory batch
@@ -893,9 +925,11 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
             # Serial version.
             for state_index in range(self.nstates):
                 # Set alchemical state.
-                AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
-                for replica_index in range(self.nstates):
-                    self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
+                with tracing.span('perturbContext', 'openmm', state=state_index):
+                    AbsoluteAlchemicalFactory.perturbContext(context, self.states[state_index].alchemical_state)
+                with tracing.span('compute state energies', 'openmm', state=state_index):
+                    for replica_index in range(self.nstates):
+                        self.u_kl[replica_index,state_index] = self.states[state_index].reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
         end_time = time.time()
         elapsed_time = end_time - start_time
@@ -919,7 +953,8 @@ class ModifiedHamiltonianExchange(ReplicaExchange):
                     self.u_k[replica_index] = self.fully_interacting_state.reduced_potential(self.replica_positions[replica_index], box_vectors=self.replica_box_vectors[replica_index], context=context)
 
                 # Send final energies to all nodes.
-                energies_gather = self.mpicomm.allgather(self.u_k[self.mpicomm.rank:self.nstates:self.mpicomm.size])
+                with tracing.span('allgather energies', 'mpi', fully_interacting=True):
+                    energies_gather = self.mpicomm.allgather(self.u_k[self.mpicomm.rank:self.nstates:self.mpicomm.size])
                 for replica_index in range(self.nstates):
                     source = replica_index % self.mpicomm.size # node with data
                     index = replica_index // self.mpicomm.size # index within batch
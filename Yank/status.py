@@ -0,0 +1,226 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Status
+======
+
+Quick status of the simulations from the JSON status files.
+
+ReplicaExchange atomically replaces a <phase>.status.json file next to the
+store file after every iteration. The functions of this module read them
+without importing NetCDF and the analysis libraries, so that 'yank status'
+starts quickly. Only the phases without a status file, e.g. created by a
+previous version, are read from their store files.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import json
+import time
+import datetime
+
+import utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# STATUS FILES
+#=============================================================================================
+
+def find_status_files(directory):
+    """
+    Find the status files written by the phases in a directory tree.
+
+    Parameters
+    ----------
+    directory : str
+       The root of the tree, e.g. a store directory or the output directory
+       of a YAML script.
+
+    Returns
+    -------
+    status_paths : list of str
+       The paths of the status files, sorted by directory.
+
+    """
+    suffix = '.' + utils.STATUS_FILE_SUFFIX
+    status_paths = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        dir_names.sort()
+        status_paths.extend(os.path.join(dir_path, file_name) for file_name in sorted(file_names)
+                            if file_name.endswith(suffix))
+    return status_paths
+
+
+def read_status_file(status_path):
+    """
+    Read the status file written by ReplicaExchange every iteration.
+
+    The file is atomically replaced by the simulation, so it can be read
+    while the simulation is running.
+
+    Parameters
+    ----------
+    status_path : str
+       The path of the status file.
+
+    Returns
+    -------
+    status : dict or None
+       The status of the phase after its last iteration, None if the file
+       does not exist.
+
+    """
+    try:
+        with open(status_path, 'r') as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def _print_throughput(throughput):
+    """Print the throughput returned by analyze.read_throughput() or stored in a status file."""
+    logger.info("  %8.3f s/iteration (%.1f%% overhead)" % (throughput['seconds_per_iteration'],
+                                                         throughput['overhead_fraction'] * 100.0))
+    if throughput['ns_per_day'] is not None:
+        logger.info("  %8.3f ns/day per replica" % throughput['ns_per_day'])
+    if throughput['eta'] is not None:
+        logger.info("  %8d iterations remaining (ETA %s)" % (throughput['niterations_remaining'],
+                    str(datetime.timedelta(seconds=int(throughput['eta'])))))
+
+
+def _print_memory_diagnostics(diagnostics, nallocations=3):
+    """Print the memory diagnostics returned by analyze.read_memory_diagnostics() or stored in a status file."""
+    logger.info("  %8.1f MB resident (peak %.1f MB)" % (diagnostics['rss'],
+                                                      diagnostics.get('max_peak_rss', diagnostics['peak_rss'])))
+    logger.info("           contexts %.1f MB, systems %.1f MB, replica buffers %.1f MB, trace buffer %.1f MB" %
+                (diagnostics['contexts'], diagnostics['systems'], diagnostics['replica_buffers'],
+                 diagnostics['trace_buffer']))
+    for location, megabytes, nblocks in (diagnostics['top_allocations'] or [])[:nallocations]:
+        logger.info("  %8.1f MB in %d blocks allocated at %s" % (megabytes, nblocks, location))
+
+
+def _print_phase_status(phase, status):
+    """Print the status of a phase read from its status file."""
+    logger.info("%s" % phase)
+    logger.info("  %8d / %d iterations completed" % (status['iteration'], status['number_of_iterations']))
+    logger.info("  %8d alchemical states" % status['nstates'])
+    logger.info("  %8d atoms" % status['natoms'])
+    _print_throughput(status)
+
+    # Mixing statistics.
+    if status['acceptance_rate'] is not None:
+        logger.info("  %8.3f mean swap acceptance rate" % status['acceptance_rate'])
+        logger.info("           between neighbor states: %s" % ' '.join(
+            '-' if rate is None else '%.2f' % rate for rate in status['neighbor_acceptance_rates']))
+    perron_eigenvalue = status['perron_eigenvalue']
+    if perron_eigenvalue is not None:
+        if perron_eigenvalue >= 1.0:
+            logger.info("  %8.5f Perron eigenvalue (Markov chain is decomposable)" % perron_eigenvalue)
+        else:
+            logger.info("  %8.5f Perron eigenvalue (state equilibration timescale ~ %.1f iterations)" %
+                        (perron_eigenvalue, 1.0 / (1.0 - perron_eigenvalue)))
+
+    # Latest online analysis estimate.
+    if status['DeltaF'] is not None:
+        logger.info("  %8.3f +- %.3f kT free energy difference (online analysis)" % (status['DeltaF'],
+                                                                                   status['dDeltaF']))
+
+    if 'memory' in status:
+        _print_memory_diagnostics(status['memory'])
+
+    logger.info("  last update %s ago" % str(datetime.timedelta(
+        seconds=int(max(0.0, time.time() - status['last_write_time'])))))
+
+
+def print_status(store_directory):
+    """
+    Print a quick summary of simulation progress.
+
+    The phases that write a status file are found in the whole directory tree
+    and reported without opening their store files. The phases in
+    store_directory that do not have a status file, e.g. because they were
+    created by a previous version, are read from their store files.
+
+    Parameters
+    ----------
+    store_directory : string
+       The location of the NetCDF simulation output files, or of a tree of
+       experiment directories.
+
+    Returns
+    -------
+    success : bool
+       True is returned on success; False if some files could not be read.
+
+    """
+    # Print the phases with a status file.
+    status_paths = find_status_files(store_directory)
+    suffix_length = len(utils.STATUS_FILE_SUFFIX) + 1
+    for status_path in status_paths:
+        status = read_status_file(status_path)
+        if status is not None:
+            _print_phase_status(os.path.relpath(status_path, store_directory)[:-suffix_length], status)
+
+    # Get NetCDF files
+    try:
+        phases = utils.find_phases_in_store_directory(store_directory)
+    except RuntimeError:
+        if len(status_paths) > 0:
+            return True
+        raise
+
+    # Process each netcdf file.
+    for phase, fullpath in phases.items():
+
+        # Check that the file exists.
+        if not os.path.exists(fullpath):
+            # Report failure.
+            logger.info("File %s not found." % fullpath)
+            logger.info("Check to make sure the right directory was specified, and 'yank setup' has been run.")
+            return False
+
+        # Skip the phases already reported from their status file.
+        if os.path.exists(utils.get_companion_store_path(fullpath, utils.STATUS_FILE_SUFFIX)):
+            continue
+
+        # Open NetCDF file for reading. The analysis module, which imports netCDF4,
+        # is needed only by the phases without a status file.
+        import analyze
+        logger.debug("Opening NetCDF trajectory file '%(fullpath)s' for reading..." % vars())
+        ncfile = analyze.open_analysis_ncfile(fullpath)
+
+        # Read dimensions.
+        niterations = ncfile.variables['states'].shape[0]
+        nstates = ncfile.variables['states'].shape[1]
+        natoms = len(ncfile.dimensions['atom'])
+
+        # Print summary.
+        logger.info("%s" % phase)
+        logger.info("  %8d iterations completed" % niterations)
+        logger.info("  %8d alchemical states" % nstates)
+        logger.info("  %8d atoms" % natoms)
+
+        # Print average throughput and estimated completion time.
+        throughput = analyze.read_throughput(ncfile)
+        if throughput is not None:
+            _print_throughput(throughput)
+
+        # Print memory diagnostics, if recorded.
+        diagnostics = analyze.read_memory_diagnostics(ncfile)
+        if diagnostics is not None:
+            _print_memory_diagnostics(diagnostics)
+
+        # Close file.
+        ncfile.close()
+
+    return True
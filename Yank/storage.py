@@ -0,0 +1,604 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Storage
+=======
+
+Utilities to read and write the NetCDF store files produced by YANK.
+
+A phase can be stored in a single NetCDF file or, when the repex options
+'segment_iterations' or 'segment_max_gigabytes' are set, in segmented mode.
+In segmented mode, the main store file ('<phase>.nc') contains everything but
+the per-iteration variables in SEGMENTED_VARIABLES, which are written to a
+sequence of segment files ('<phase>.segment0000.nc', '<phase>.segment0001.nc',
+...) listed in the manifest '<phase>.segments.yaml'. Each segment covers a
+contiguous range of iterations starting at the 'first_iteration' recorded in
+the manifest.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import multiprocessing
+
+import yaml
+import numpy as np
+import netCDF4 as netcdf
+
+import utils
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# MODULE CONSTANTS
+#=============================================================================================
+
+# Per-iteration variables that are written to segment files in segmented mode.
+SEGMENTED_VARIABLES = ['positions', 'box_vectors']
+
+#=============================================================================================
+# Segment manifest
+#=============================================================================================
+
+def get_segment_path(store_path, segment_index):
+    """Return the path of the segment file with the given index."""
+    return utils.get_companion_store_path(store_path, 'segment{:04d}.nc'.format(segment_index))
+
+
+def get_manifest_path(store_path):
+    """Return the path of the segment manifest of a store file."""
+    return utils.get_companion_store_path(store_path, 'segments.yaml')
+
+
+def read_segment_manifest(store_path):
+    """Read the list of segments of a store file.
+
+    Parameters
+    ----------
+    store_path : str
+        The path to the main NetCDF store file.
+
+    Returns
+    -------
+    segments : list of dict
+        segments[i] has keys 'file' (the path of the segment file relative to
+        the store directory) and 'first_iteration'. The list is empty if the
+        store is not segmented.
+
+    """
+    manifest_path = get_manifest_path(store_path)
+    if not os.path.isfile(manifest_path):
+        return []
+    with open(manifest_path, 'r') as f:
+        manifest = yaml.load(f)
+    return manifest['segments']
+
+
+def write_segment_manifest(store_path, segments):
+    """Atomically write the list of segments of a store file.
+
+    The manifest is first written to a temporary file which is then renamed,
+    so that a crash never leaves a truncated manifest behind.
+
+    Parameters
+    ----------
+    store_path : str
+        The path to the main NetCDF store file.
+    segments : list of dict
+        The segments in the format returned by read_segment_manifest().
+
+    """
+    manifest_path = get_manifest_path(store_path)
+    tmp_manifest_path = manifest_path + '.tmp'
+    with open(tmp_manifest_path, 'w') as f:
+        yaml.dump({'segments': segments}, f, default_flow_style=False)
+    os.rename(tmp_manifest_path, manifest_path)
+
+
+#=============================================================================================
+# Lazy reader of segmented stores
+#=============================================================================================
+
+def _read_frames(ncvar, local_indices, other_key):
+    """Read the given frames of a NetCDF variable with as few read calls as possible."""
+    if len(local_indices) == 0:
+        return ncvar[(slice(0, 0),) + other_key]
+
+    start, stop = local_indices.min(), local_indices.max() + 1
+    steps = np.diff(local_indices)
+    if len(local_indices) == 1 or (steps[0] > 0 and np.all(steps == steps[0])):
+        step = 1 if len(local_indices) == 1 else int(steps[0])
+        return ncvar[(slice(local_indices[0], stop, step),) + other_key]
+
+    # Read the enclosing block and select the frames in memory.
+    block = ncvar[(slice(start, stop),) + other_key]
+    return block[local_indices - start]
+
+
+def _read_segment_frames(args):
+    """Open a segment file and read the given frames (used by worker processes)."""
+    segment_path, variable_name, local_indices, other_key = args
+    ncfile = netcdf.Dataset(segment_path, 'r')
+    try:
+        return np.asarray(_read_frames(ncfile.variables[variable_name], local_indices, other_key))
+    finally:
+        ncfile.close()
+
+
+class SegmentedVariable(object):
+    """Read-only lazy concatenation of a variable stored across segment files.
+
+    Indexing follows netCDF4.Variable semantics. Only the segments containing
+    the requested iterations are read and, when nprocesses > 1 and more than
+    one segment is involved, the segments are read in parallel.
+
+    """
+
+    def __init__(self, variable_name, segments, nprocesses=1):
+        """Constructor.
+
+        Parameters
+        ----------
+        variable_name : str
+            The name of the variable in the segment files.
+        segments : list of tuple
+            segments[i] is (segment_path, segment_ncfile, first_iteration).
+        nprocesses : int, optional
+            Number of processes used to read segments in parallel (default is 1).
+
+        """
+        self.name = variable_name
+        self._nprocesses = nprocesses
+
+        # Determine the iterations covered by each segment. Frames written after
+        # the start of the next segment (e.g. before a crash) are ignored.
+        self._segments = []
+        for i, (segment_path, segment_ncfile, first_iteration) in enumerate(segments):
+            niterations = segment_ncfile.variables[variable_name].shape[0]
+            if i + 1 < len(segments):
+                niterations = min(niterations, segments[i+1][2] - first_iteration)
+            self._segments.append((segment_path, segment_ncfile, first_iteration, niterations))
+
+        ncvar = segments[0][1].variables[variable_name]
+        last_path, last_ncfile, last_first, last_n = self._segments[-1]
+        self.shape = (last_first + last_n,) + ncvar.shape[1:]
+        self.dtype = ncvar.dtype
+        self.dimensions = ncvar.dimensions
+        self._attributes = {name: getattr(ncvar, name) for name in ncvar.ncattrs()}
+
+    def ncattrs(self):
+        return self._attributes.keys()
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_attributes'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        iteration_key, other_key = key[0], key[1:]
+
+        # Convert the iteration selection into an array of indices.
+        squeeze = False
+        if isinstance(iteration_key, slice):
+            indices = np.arange(*iteration_key.indices(self.shape[0]))
+        elif np.isscalar(iteration_key):
+            squeeze = True
+            iteration_key = int(iteration_key)
+            if iteration_key < 0:
+                iteration_key += self.shape[0]
+            if not 0 <= iteration_key < self.shape[0]:
+                raise IndexError('iteration index out of range')
+            indices = np.array([iteration_key])
+        else:
+            indices = np.asarray(iteration_key, dtype=np.int64)
+            indices[indices < 0] += self.shape[0]
+
+        # Find the frames to read in each segment.
+        jobs = []
+        for segment_path, segment_ncfile, first_iteration, niterations in self._segments:
+            mask = (indices >= first_iteration) & (indices < first_iteration + niterations)
+            if mask.any():
+                jobs.append((segment_path, segment_ncfile, np.where(mask)[0], indices[mask] - first_iteration))
+        if len(jobs) == 0:
+            segment_path, segment_ncfile = self._segments[0][:2]
+            jobs.append((segment_path, segment_ncfile, np.array([], np.int64), np.array([], np.int64)))
+
+        # Read the frames.
+        if self._nprocesses > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(min(self._nprocesses, len(jobs)))
+            try:
+                blocks = pool.map(_read_segment_frames, [(job[0], self.name, job[3], other_key)
+                                                         for job in jobs])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            blocks = [_read_frames(job[1].variables[self.name], job[3], other_key) for job in jobs]
+
+        # Concatenate the blocks in the requested order.
+        data = np.empty((len(indices),) + blocks[0].shape[1:], blocks[0].dtype)
+        for job, block in zip(jobs, blocks):
+            data[job[2]] = block
+        if squeeze:
+            data = data[0]
+        return data
+
+
+class SegmentedDataset(object):
+    """Read-only view of a store that looks like a netCDF4.Dataset.
+
+    The variables in SEGMENTED_VARIABLES are exposed as SegmentedVariable
+    objects, everything else is read directly from the main store file.
+
+    """
+
+    def __init__(self, store_path, nprocesses=1):
+        self._ncfile = netcdf.Dataset(store_path, 'r')
+        self._segment_ncfiles = []
+
+        self.variables = dict(self._ncfile.variables)
+        segments = []
+        store_dir = os.path.dirname(store_path)
+        for segment in read_segment_manifest(store_path):
+            segment_path = os.path.join(store_dir, segment['file'])
+            segment_ncfile = netcdf.Dataset(segment_path, 'r')
+            self._segment_ncfiles.append(segment_ncfile)
+            segments.append((segment_path, segment_ncfile, segment['first_iteration']))
+        if len(segments) == 0:
+            return
+        for variable_name, ncvar in segments[0][1].variables.items():
+            if variable_name in SEGMENTED_VARIABLES:
+                self.variables[variable_name] = SegmentedVariable(variable_name, segments, nprocesses)
+            elif 'iteration' not in ncvar.dimensions:
+                # Static variables (e.g. positions_atom_indices) are identical in all segments.
+                self.variables[variable_name] = ncvar
+
+    @property
+    def dimensions(self):
+        return self._ncfile.dimensions
+
+    @property
+    def groups(self):
+        return self._ncfile.groups
+
+    def ncattrs(self):
+        return self._ncfile.ncattrs()
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['_ncfile'], name)
+
+    def close(self):
+        for segment_ncfile in self._segment_ncfiles:
+            segment_ncfile.close()
+        self._segment_ncfiles = []
+        self._ncfile.close()
+
+
+def open_store(store_path, nprocesses=1):
+    """Open a store file for reading, transparently handling segmented stores.
+
+    Parameters
+    ----------
+    store_path : str
+        The path to the main NetCDF store file of the phase.
+    nprocesses : int, optional
+        Number of processes used to read segments in parallel (default is 1).
+
+    Returns
+    -------
+    ncfile : netCDF4.Dataset or SegmentedDataset
+        The store opened in read mode.
+
+    """
+    if os.path.isfile(get_manifest_path(store_path)):
+        return SegmentedDataset(store_path, nprocesses)
+    return netcdf.Dataset(store_path, 'r')
+
+
+#=============================================================================================
+# Store compaction
+#=============================================================================================
+
+# Approximate amount of position data read in memory at once during compaction.
+_COMPACTION_BLOCK_BYTES = 64 * 1024**2
+
+# Serialized Systems that duplicate (or can be rebuilt from) the reference System
+# in the metadata group and the alchemical states. They are dropped by default
+# from compacted stores that have metadata/reference_system.
+_REDUNDANT_SYSTEM_VARIABLES = {'thermodynamic_states': ['systems', 'reference_system'],
+                               'fully_interacting_state': ['system']}
+
+
+def _get_store_files(store_path):
+    """Return the paths of all the files that make up a store (main file, segments and manifest)."""
+    store_dir = os.path.dirname(store_path)
+    paths = [store_path]
+    segments = read_segment_manifest(store_path)
+    if len(segments) > 0:
+        paths += [os.path.join(store_dir, segment['file']) for segment in segments]
+        paths.append(get_manifest_path(store_path))
+    return paths
+
+
+def is_store_finished(ncfile):
+    """Return True if the store contains all the iterations requested for its simulation.
+
+    Parameters
+    ----------
+    ncfile : netCDF4.Dataset or SegmentedDataset
+        The store opened for reading.
+
+    Returns
+    -------
+    finished : bool
+        False if the simulation can still be extended or resumed to reach the
+        number of iterations of its last run, or if that number is unknown.
+
+    """
+    if 'options' not in ncfile.groups or 'number_of_iterations' not in ncfile.groups['options'].variables:
+        return False
+    number_of_iterations = int(ncfile.groups['options'].variables['number_of_iterations'].getValue())
+    # Iteration 0 is the initial state written before the first iteration is run.
+    return ncfile.variables['states'].shape[0] - 1 >= number_of_iterations
+
+
+def _create_compact_variable(ncvar, ncgrp, dimensions, chunksizes, complevel):
+    """Create a compressed copy of the definition and attributes of ncvar."""
+    if ncvar.dtype == str:
+        # Variable-length strings cannot be compressed.
+        new_ncvar = ncgrp.createVariable(ncvar.name, ncvar.dtype, dimensions)
+    else:
+        new_ncvar = ncgrp.createVariable(ncvar.name, ncvar.dtype, dimensions, zlib=True,
+                                         complevel=complevel, shuffle=True, chunksizes=chunksizes)
+    for attribute_name in ncvar.ncattrs():
+        if attribute_name != '_FillValue':
+            setattr(new_ncvar, attribute_name, getattr(ncvar, attribute_name))
+    return new_ncvar
+
+
+def _copy_compact_group(in_grp, out_grp, complevel, block_size, drop_systems,
+                        skip_variables=(), skip_dimensions=()):
+    """Recursively copy a group, streaming per-iteration variables in blocks of iterations."""
+    for attribute_name in in_grp.ncattrs():
+        setattr(out_grp, attribute_name, getattr(in_grp, attribute_name))
+    for dimension_name, dimension in in_grp.dimensions.items():
+        if dimension_name not in out_grp.dimensions and dimension_name not in skip_dimensions:
+            out_grp.createDimension(dimension_name, None if dimension.isunlimited() else len(dimension))
+
+    group_name = getattr(in_grp, 'name', '/')
+    for variable_name, ncvar in in_grp.variables.items():
+        if variable_name in skip_variables:
+            continue
+        if drop_systems and variable_name in _REDUNDANT_SYSTEM_VARIABLES.get(group_name, []):
+            logger.debug("Dropping serialized System {}/{}".format(group_name, variable_name))
+            continue
+        if hasattr(ncvar, 'set_auto_maskandscale'):
+            ncvar.set_auto_maskandscale(False)  # copy raw values bit-for-bit
+
+        # Scalar variables.
+        if ncvar.shape == ():
+            new_ncvar = out_grp.createVariable(variable_name, ncvar.dtype)
+            for attribute_name in ncvar.ncattrs():
+                setattr(new_ncvar, attribute_name, getattr(ncvar, attribute_name))
+            new_ncvar.assignValue(ncvar.getValue())
+            continue
+
+        # Static variables are copied at once, per-iteration variables in blocks.
+        if ncvar.dimensions[:1] == ('iteration',):
+            chunksizes = (max(1, min(block_size, 1024)),) + ncvar.shape[1:]
+        else:
+            chunksizes = None
+        new_ncvar = _create_compact_variable(ncvar, out_grp, ncvar.dimensions, chunksizes, complevel)
+        if 0 in ncvar.shape:
+            continue
+        if chunksizes is None:
+            new_ncvar[:] = ncvar[:]
+        else:
+            for start in range(0, ncvar.shape[0], block_size):
+                stop = min(start + block_size, ncvar.shape[0])
+                new_ncvar[start:stop] = ncvar[start:stop]
+
+    for child_name, child_grp in in_grp.groups.items():
+        _copy_compact_group(child_grp, out_grp.createGroup(child_name), complevel,
+                            block_size, drop_systems)
+
+
+def compact_store(store_path, output_path=None, positions_stride=1, keep_solvent=True,
+                  keep_systems=False, complevel=9, force=False):
+    """Rewrite a finished store file in a compact form for archival.
+
+    Positions can be strided or dropped and solvent atoms stripped, while all
+    the other data (states, energies, mixing statistics, ...) is copied
+    bit-for-bit. Everything is recompressed with the strongest zlib level and
+    byte shuffling. Data is streamed in blocks of iterations so that memory
+    usage does not depend on the size of the store. Segmented stores are merged
+    into a single file.
+
+    Parameters
+    ----------
+    store_path : str
+        The path to the main NetCDF store file of the phase.
+    output_path : str, optional
+        Where to write the compacted store. If None, the store is replaced in
+        place and its segment files are removed (default is None).
+    positions_stride : int, optional
+        Keep the positions of one iteration every positions_stride among those
+        stored, so that the stride of a store already strided by 2 becomes
+        2 * positions_stride. If 0, positions are dropped (default is 1).
+    keep_solvent : bool, optional
+        If False, the positions of solvent atoms are dropped (default is True).
+    keep_systems : bool, optional
+        If False and the store has a serialized reference System in its
+        metadata, the redundant serialized Systems are dropped. The compacted
+        store cannot be resumed in this case (default is False).
+    complevel : int, optional
+        The zlib compression level (default is 9).
+    force : bool, optional
+        If True, stores whose simulation has not finished are compacted as
+        well. When the store is replaced in place, its restart checkpoint is
+        removed, so that a forced compaction of a running simulation cannot be
+        resumed from positions that are no longer stored (default is False).
+
+    Returns
+    -------
+    input_bytes : int
+        Total size of the files making up the original store.
+    output_bytes : int
+        Size of the compacted store.
+
+    """
+    input_paths = _get_store_files(store_path)
+    input_bytes = sum(os.path.getsize(path) for path in input_paths)
+    in_place = output_path is None
+    if in_place:
+        output_path = store_path + '.compact.tmp'
+
+    in_ncfile = open_store(store_path)
+    if not (force or is_store_finished(in_ncfile)):
+        in_ncfile.close()
+        raise RuntimeError('The simulation of {} has not finished. Use force to compact '
+                           'it anyway.'.format(store_path))
+    out_ncfile = netcdf.Dataset(output_path, 'w', version='NETCDF4')
+    compacted = False
+    try:
+        in_positions = in_ncfile.variables.get('positions', None)
+        drop_systems = (not keep_systems and 'metadata' in in_ncfile.groups and
+                        'reference_system' in in_ncfile.groups['metadata'].variables)
+        _copy_compact_group(in_ncfile, out_ncfile, complevel, block_size=1024,
+                            drop_systems=drop_systems,
+                            skip_variables=('positions', 'positions_atom_indices'),
+                            skip_dimensions=('trajectory_atom',))
+        # Box vectors of segmented stores have been merged above. Positions are
+        # strided and subset while streaming blocks of iterations.
+        if in_positions is not None and positions_stride > 0:
+            niterations, nreplicas, natoms, _ = in_positions.shape
+
+            # Determine which of the stored atoms to keep.
+            if 'positions_atom_indices' in in_ncfile.variables:
+                atom_indices = np.array(in_ncfile.variables['positions_atom_indices'][:])
+            else:
+                atom_indices = np.arange(natoms)
+            if not keep_solvent:
+                from pipeline import _SOLVENT_RESNAMES
+                topology = utils.deserialize_topology(in_ncfile.groups['metadata'].variables['topology'][0])
+                is_solvent = np.array([topology.atom(int(index)).residue.name in _SOLVENT_RESNAMES
+                                       for index in atom_indices])
+                keep = np.where(~is_solvent)[0]
+            else:
+                keep = np.arange(len(atom_indices))
+
+            # Store atom indices if they are not all the system atoms.
+            if len(keep) == len(out_ncfile.dimensions['atom']):
+                atom_dimension = 'atom'
+            else:
+                atom_dimension = 'trajectory_atom'
+                out_ncfile.createDimension(atom_dimension, len(keep))
+                ncvar_atom_indices = out_ncfile.createVariable('positions_atom_indices', 'i4', (atom_dimension,))
+                setattr(ncvar_atom_indices, "long_name", "positions_atom_indices[trajectory_atom] is the index in the system of the atom 'trajectory_atom' of positions.")
+                ncvar_atom_indices[:] = atom_indices[keep].astype(np.int32)
+
+            # Keep one every positions_stride of the iterations stored in the original file.
+            input_stride = int(getattr(in_positions, 'stride', 1))
+            stride = input_stride * positions_stride
+            out_positions = _create_compact_variable(in_positions, out_ncfile,
+                                                     ('iteration', 'replica', atom_dimension, 'spatial'),
+                                                     (1, nreplicas, len(keep), 3), complevel)
+            setattr(out_positions, 'stride', stride)
+
+            # Stream blocks of strided frames.
+            frame_bytes = nreplicas * natoms * 3 * 4
+            block_size = stride * max(1, _COMPACTION_BLOCK_BYTES // frame_bytes)
+            for start in range(0, niterations, block_size):
+                stop = min(start + block_size, niterations)
+                block = in_positions[start:stop:stride]
+                if len(keep) != natoms:
+                    block = block[:, :, keep, :]
+                out_positions[start:stop:stride] = block
+
+        setattr(out_ncfile, 'compacted', 1)
+        compacted = True
+    finally:
+        in_ncfile.close()
+        out_ncfile.close()
+        # Do not leave behind a partial copy, which can be as large as the store.
+        if in_place and not compacted:
+            os.remove(output_path)
+
+    # Replace the original store. The restart checkpoint would refer to data
+    # that may no longer be in the store.
+    if in_place:
+        os.rename(output_path, store_path)
+        for path in input_paths[1:]:
+            os.remove(path)
+        checkpoint_path = utils.get_companion_store_path(store_path, 'checkpoint.npz')
+        if os.path.isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+        output_path = store_path
+    output_bytes = os.path.getsize(output_path)
+
+    logger.debug("Compacted {}: {} -> {} bytes".format(store_path, input_bytes, output_bytes))
+    return input_bytes, output_bytes
+
+
+def _compact_store_job(args):
+    """Compact a single store in a worker process, reporting errors instead of raising."""
+    store_path, kwargs = args
+    try:
+        input_bytes, output_bytes = compact_store(store_path, **kwargs)
+    except Exception as e:
+        return store_path, None, None, '{}: {}'.format(type(e).__name__, e)
+    return store_path, input_bytes, output_bytes, None
+
+
+def compact_directory(directory, nprocesses=1, **kwargs):
+    """Compact in place all the stores found in a directory tree.
+
+    Parameters
+    ----------
+    directory : str
+        The root of the directory tree to search for NetCDF store files.
+    nprocesses : int, optional
+        Number of stores compacted in parallel (default is 1).
+    **kwargs
+        Other keyword arguments to pass to compact_store().
+
+    Returns
+    -------
+    results : list of tuple
+        results[i] is (store_path, input_bytes, output_bytes, error), where
+        error is None on success and the sizes are None on failure.
+
+    """
+    store_paths = []
+    for dir_path, dir_names, file_names in os.walk(directory):
+        try:
+            phases = utils.find_phases_in_store_directory(dir_path)
+        except RuntimeError:
+            continue  # no store in this directory
+        store_paths.extend(sorted(phases.values()))
+
+    jobs = [(store_path, kwargs) for store_path in store_paths]
+    if nprocesses > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(nprocesses, len(jobs)))
+        try:
+            results = pool.map(_compact_store_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_compact_store_job(job) for job in jobs]
+    return results
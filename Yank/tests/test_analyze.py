@@ -0,0 +1,435 @@
+#!/usr/local/bin/env python
+
+"""
+Test analysis functions in analyze.py.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import csv
+import shutil
+import tempfile
+
+import numpy as np
+import mdtraj
+import netCDF4 as netcdf
+from nose import tools
+from pymbar import timeseries
+
+from yank import analyze, catalog, utils
+
+#=============================================================================================
+# UTILITY FUNCTIONS
+#=============================================================================================
+
+def create_energies_ncfile(file_path, niterations=20, nstates=4, seed=0, metadata=False):
+    """Create a NetCDF file with random permutations of states and random energies.
+
+    If metadata is True, the standard state correction and the temperatures
+    read by analyze_phase() are stored as well.
+
+    """
+    random_state = np.random.RandomState(seed)
+    ncfile = netcdf.Dataset(file_path, 'w', version='NETCDF4')
+    ncfile.createDimension('iteration', 0)
+    ncfile.createDimension('replica', nstates)
+    ncfile.createDimension('state', nstates)
+    ncvar_states = ncfile.createVariable('states', 'i4', ('iteration', 'replica'))
+    ncvar_energies = ncfile.createVariable('energies', 'f8', ('iteration', 'replica', 'state'))
+    for iteration in range(niterations):
+        ncvar_states[iteration, :] = random_state.permutation(nstates)
+        ncvar_energies[iteration, :, :] = random_state.normal(size=(nstates, nstates))
+    if metadata:
+        ncgrp_metadata = ncfile.createGroup('metadata')
+        ncgrp_metadata.createDimension('scalar', 1)
+        ncgrp_metadata.createVariable('standard_state_correction', 'f8', ('scalar',))[0] = -1.0
+        ncgrp_states = ncfile.createGroup('thermodynamic_states')
+        ncgrp_states.createVariable('temperatures', 'f8', ('replica',))[:] = 300.0
+    return ncfile
+
+
+def create_trajectory_ncfile(file_path, niterations=10, nstates=3, seed=0):
+    """Create a store with random positions of a solute followed by two water molecules."""
+    topology = mdtraj.Topology()
+    chain = topology.add_chain()
+    for residue_name, natoms in [('MOL', 4), ('HOH', 3), ('HOH', 3)]:
+        residue = topology.add_residue(residue_name, chain)
+        for i in range(natoms):
+            topology.add_atom('C{}'.format(i), mdtraj.element.carbon, residue)
+
+    ncfile = create_energies_ncfile(file_path, niterations=niterations, nstates=nstates, seed=seed)
+    ncfile.createDimension('atom', topology.n_atoms)
+    ncfile.createDimension('spatial', 3)
+    ncvar_positions = ncfile.createVariable('positions', 'f4', ('iteration', 'replica', 'atom', 'spatial'))
+    ncvar_positions[:] = np.random.RandomState(seed).uniform(size=(niterations, nstates, topology.n_atoms, 3))
+    ncgrp_metadata = ncfile.createGroup('metadata')
+    ncgrp_metadata.createDimension('scalar', 1)
+    ncgrp_metadata.createVariable('topology', str, ('scalar',))[0] = utils.serialize_topology(topology)
+    return ncfile
+
+
+def generate_correlated_timeseries(n_samples=2000, n_transient=200, tau=10.0, seed=0):
+    """Generate an AR(1) timeseries with an initial exponentially decaying transient."""
+    random_state = np.random.RandomState(seed)
+    phi = np.exp(-1.0 / tau)
+    A_t = np.zeros(n_samples)
+    for t in range(1, n_samples):
+        A_t[t] = phi * A_t[t-1] + random_state.normal()
+    A_t[:n_transient] += 20.0 * np.exp(-np.arange(n_transient) / (n_transient / 5.0))
+    return A_t
+
+#=============================================================================================
+# TESTING FUNCTIONS
+#=============================================================================================
+
+def test_read_energies():
+    """Test vectorized deconvolution of energies against the per-iteration algorithm."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ncfile = create_energies_ncfile(os.path.join(tmp_dir, 'phase.nc'))
+        states = ncfile.variables['states'][:]
+        energies = ncfile.variables['energies'][:]
+        niterations, nstates = states.shape
+
+        expected_u_kln = np.zeros([nstates, nstates, niterations], np.float64)
+        for iteration in range(niterations):
+            expected_u_kln[states[iteration], :, iteration] = energies[iteration]
+        expected_u_n = np.array([np.sum(np.diagonal(expected_u_kln[:, :, n])) for n in range(niterations)])
+
+        u_kln, u_n = analyze.read_energies(ncfile)
+        assert np.allclose(u_kln, expected_u_kln)
+        assert np.allclose(u_n, expected_u_n)
+
+        # Analysis functions share the cached energies and do not modify them.
+        assert analyze.read_energies(ncfile)[0] is u_kln
+        analyze.estimate_enthalpies(ncfile, g=1)
+        assert np.allclose(analyze.extract_u_n(ncfile), expected_u_n)
+        assert np.allclose(u_kln, expected_u_kln)
+
+        # Only the energies of the last file read are cached.
+        other_ncfile = create_energies_ncfile(os.path.join(tmp_dir, 'other.nc'), seed=1)
+        analyze.read_energies(other_ncfile)
+        assert len(analyze._energies_cache) == 1
+        assert analyze.read_energies(ncfile)[0] is not u_kln
+        other_ncfile.close()
+        ncfile.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_stream_energies():
+    """Test energies read in blocks match the energies read in bulk."""
+    tmp_dir = tempfile.mkdtemp()
+    block_bytes = analyze.ENERGIES_BLOCK_BYTES
+    try:
+        ncfile = create_energies_ncfile(os.path.join(tmp_dir, 'phase.nc'), niterations=23)
+        expected_u_kln, expected_u_n = analyze.read_energies(ncfile)
+        analyze._energies_cache.clear()
+
+        # Blocks of 3 iterations.
+        analyze.ENERGIES_BLOCK_BYTES = 3 * 8 * 4 * 4
+        assert np.allclose(analyze.extract_u_n(ncfile), expected_u_n)
+        assert np.allclose(analyze.update_u_n(ncfile, expected_u_n[:5]), expected_u_n)
+        iterations = np.array([0, 2, 3, 7, 8, 9, 15, 22])
+        u_kln, u_n = analyze.read_energies(ncfile, iterations)
+        assert np.allclose(u_kln, expected_u_kln[:,:,iterations])
+        assert np.allclose(u_n, expected_u_n[iterations])
+
+        # Streaming does not populate the cache of the whole file.
+        assert len(analyze._energies_cache) == 0
+        ncfile.close()
+    finally:
+        analyze.ENERGIES_BLOCK_BYTES = block_bytes
+        shutil.rmtree(tmp_dir)
+
+
+def test_analysis_cache():
+    """Test incremental update of u_n and persistence of the analysis state."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_path = os.path.join(tmp_dir, 'phase.nc')
+        ncfile = create_energies_ncfile(store_path, niterations=20)
+        expected_u_n = analyze.extract_u_n(ncfile)
+
+        # u_n is extended reading only the new iterations.
+        u_n = analyze.update_u_n(ncfile, expected_u_n[:12])
+        assert np.allclose(u_n, expected_u_n)
+        assert analyze.update_u_n(ncfile, u_n) is u_n
+
+        # Round trip.
+        assert analyze.read_analysis_cache(store_path) == {}
+        analyze.write_analysis_cache(store_path, {'u_n': u_n, 'niterations': 20, 'f_k': np.zeros(4)})
+        analysis_cache = analyze.read_analysis_cache(store_path, ncfile)
+        assert analysis_cache['niterations'] == 20
+        assert np.all(analysis_cache['u_n'] == u_n)
+        ncfile.close()
+
+        # The cache is discarded if the store has been recreated.
+        ncfile = create_energies_ncfile(store_path, niterations=20, seed=1)
+        assert analyze.read_analysis_cache(store_path, ncfile) == {}
+        ncfile.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_statistical_inefficiency():
+    """Test the FFT statistical inefficiency matches pymbar."""
+    A_t = generate_correlated_timeseries(n_transient=0)
+    for A_n in [A_t, A_t[:50], A_t[::7]]:
+        g = analyze.statistical_inefficiency(A_n)
+        assert np.isclose(g, timeseries.statisticalInefficiency(A_n), rtol=1.0e-4)
+
+
+def test_detect_equilibration():
+    """Test the grid-refined equilibration detection matches pymbar."""
+    A_t = generate_correlated_timeseries()
+    t0, g, Neff_max = analyze.detect_equilibration(A_t, ngrid=20)
+    t0_pymbar, g_pymbar, Neff_max_pymbar = timeseries.detectEquilibration(A_t)
+    assert abs(t0 - t0_pymbar) <= 0.1 * len(A_t)
+    assert np.isclose(Neff_max, Neff_max_pymbar, rtol=0.05)
+
+    # Short series are searched exhaustively.
+    t0, g, Neff_max = analyze.detect_equilibration(A_t[:80])
+    t0_pymbar, g_pymbar, Neff_max_pymbar = timeseries.detectEquilibration(A_t[:80])
+    assert t0 == t0_pymbar
+    assert np.isclose(g, g_pymbar, rtol=1.0e-4)
+
+    # A previous estimate is reused as a candidate when the series grows.
+    t0_guess = analyze.detect_equilibration(A_t[:1500])[0]
+    assert abs(analyze.detect_equilibration(A_t, t0_guess=t0_guess)[0] - t0_pymbar) <= 0.1 * len(A_t)
+
+
+def test_bootstrap_free_energies():
+    """Test bootstrap uncertainties are consistent with the MBAR asymptotic estimate."""
+    from pymbar import MBAR
+    random_state = np.random.RandomState(0)
+
+    # Harmonic oscillators with different spring constants sampled independently.
+    K_k = np.array([1.0, 2.0, 4.0])
+    nstates, nsamples = len(K_k), 200
+    N_k = nsamples * np.ones(nstates, np.int32)
+    x_kn = np.array([random_state.normal(0.0, 1.0 / np.sqrt(K), nsamples) for K in K_k])
+    u_kln = 0.5 * K_k[np.newaxis,:,np.newaxis] * x_kn[:,np.newaxis,:]**2
+    mbar = MBAR(u_kln, N_k)
+    try:
+        Deltaf_ij, dDeltaf_ij = mbar.getFreeEnergyDifferences()
+    except ValueError:
+        Deltaf_ij, dDeltaf_ij, theta_ij = mbar.getFreeEnergyDifferences()
+
+    for nprocesses in [1, 2]:
+        dDeltaf_ij_boot, nreplicates = analyze.bootstrap_free_energies(u_kln, N_k, mbar.f_k, nbootstraps=50,
+                                                                      nprocesses=nprocesses, seed=0)
+        assert nreplicates == 50
+        assert np.allclose(np.diag(dDeltaf_ij_boot), 0.0)
+        assert np.allclose(dDeltaf_ij_boot, dDeltaf_ij, rtol=0.5, atol=0.01)
+
+    # The time limit stops after the first two replicates.
+    dDeltaf_ij_boot, nreplicates = analyze.bootstrap_free_energies(u_kln, N_k, mbar.f_k, nbootstraps=50,
+                                                                  time_limit=0.0, seed=0)
+    assert nreplicates == 2
+
+    # A single replicate cannot estimate a standard error.
+    tools.assert_raises(ValueError, analyze.bootstrap_free_energies, u_kln, N_k, mbar.f_k, nbootstraps=1)
+
+
+def test_estimate_convergence():
+    """Test forward and reverse time series do not depend on the distribution of slices."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        ncfile = create_energies_ncfile(os.path.join(tmp_dir, 'phase.nc'), niterations=60)
+        u_kln, u_n = analyze.read_energies(ncfile)
+        ncfile.close()
+
+        convergence = analyze.estimate_convergence(u_kln, u_n, nequil=1, nslices=5)
+        assert np.allclose(convergence['fractions'], [0.2, 0.4, 0.6, 0.8, 1.0])
+        assert convergence['forward_DeltaF'][-1] == convergence['reverse_DeltaF'][-1]
+        assert np.all(convergence['forward_dDeltaF'] > 0.0)
+
+        # Warm-started runs of slices solved in parallel converge to the same estimates.
+        parallel_convergence = analyze.estimate_convergence(u_kln, u_n, nequil=1, nslices=5, nprocesses=4)
+        for name, values in convergence.items():
+            assert np.allclose(parallel_convergence[name], values, atol=1.0e-5), name
+
+        # Only the energies of the uncorrelated iterations of the slices are needed.
+        iterations = analyze.get_convergence_iterations(u_n, nequil=1, nslices=5)
+        compact_convergence = analyze.estimate_convergence(u_kln[:,:,iterations], u_n, nequil=1, nslices=5,
+                                                           iterations=iterations)
+        for name, values in convergence.items():
+            assert np.allclose(compact_convergence[name], values), name
+        tools.assert_raises(ValueError, analyze.estimate_convergence, u_kln[:,:,iterations[1:]], u_n,
+                            nequil=1, nslices=5, iterations=iterations[1:])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_analyze_convergence():
+    """Test the convergence time series are saved next to the stores and combined."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        phases = [['complex', 1], ['solvent', -1]]
+        with open(os.path.join(tmp_dir, 'analysis.yaml'), 'w') as f:
+            f.write(str(phases))
+        for seed, (phase, sign) in enumerate(phases):
+            ncfile = create_energies_ncfile(os.path.join(tmp_dir, phase + '.nc'), niterations=60,
+                                            seed=seed, metadata=True)
+            ncfile.close()
+
+        combined = analyze.analyze_convergence(tmp_dir, nslices=3)
+        assert sorted(name for name in os.listdir(tmp_dir) if name.endswith('.npz')) == [
+            'complex.convergence.npz', 'convergence.npz', 'solvent.convergence.npz']
+
+        # The combined estimate includes the standard state correction of both phases.
+        forward_DeltaF = {phase: np.load(analyze.get_convergence_path(tmp_dir, phase))['forward_DeltaF']
+                          for phase, sign in phases}
+        expected = -(forward_DeltaF['complex'] - 1.0) + (forward_DeltaF['solvent'] - 1.0)
+        assert np.allclose(combined['forward_DeltaF'], expected)
+        assert np.allclose(np.load(analyze.get_convergence_path(tmp_dir))['forward_DeltaF'], expected)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_analyze_directory():
+    """Test batch analysis of an experiments tree isolates failed experiments."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        experiments_dir = os.path.join(tmp_dir, 'experiments')
+        phases = [['complex', 1], ['solvent', -1]]
+        for experiment_name in ['good', 'missing', 'corrupted']:
+            experiment_dir = os.path.join(experiments_dir, experiment_name)
+            os.makedirs(experiment_dir)
+            with open(os.path.join(experiment_dir, 'analysis.yaml'), 'w') as f:
+                f.write(str(phases))
+            for seed, (phase, sign) in enumerate(phases):
+                if experiment_name == 'missing' and phase == 'solvent':
+                    continue
+                ncfile = create_energies_ncfile(os.path.join(experiment_dir, phase + '.nc'), niterations=30,
+                                                seed=seed, metadata=(experiment_name != 'corrupted'))
+                ncfile.close()
+
+        output_path = os.path.join(tmp_dir, 'results.csv')
+        results = analyze.analyze_directory(tmp_dir, output_path=output_path, nprocesses=2)
+        results = {result['experiment']: result for result in results}
+        assert set(results) == {os.path.join('experiments', name) for name in ['good', 'missing', 'corrupted']}
+
+        good = results[os.path.join('experiments', 'good')]
+        assert good['error'] is None
+        data = {phase: analyze.analyze_phase(os.path.join(experiments_dir, 'good', phase + '.nc'))
+                for phase, sign in phases}
+        assert np.allclose(analyze.combine_phases(phases, data),
+                           [good['DeltaF'], good['dDeltaF'], good['DeltaH'], good['dDeltaH']])
+        assert 'solvent' in results[os.path.join('experiments', 'missing')]['error']
+        # The errors of all the failed phases are reported.
+        corrupted_error = results[os.path.join('experiments', 'corrupted')]['error']
+        assert 'complex' in corrupted_error and 'solvent' in corrupted_error
+
+        with open(output_path, 'r') as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 3
+        assert [row['error'] == '' for row in rows].count(True) == 1
+
+        # The results catalog is created in the analyzed directory.
+        with catalog.ResultsCatalog(os.path.join(tmp_dir, catalog.CATALOG_FILE_NAME)) as results_catalog:
+            experiments = results_catalog.query()
+            assert [experiment['experiment'] for experiment in experiments][0] == os.path.join('experiments', 'good')
+            assert experiments[0]['DeltaF'] == good['DeltaF']
+            assert experiments[0]['niterations'] == 30
+            assert len(experiments[0]['stores']) == 2
+            assert len(results_catalog.query(include_failed=False)) == 1
+            assert results_catalog.get_modified_stores() == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_results_catalog():
+    """Test experiments are updated incrementally in the results catalog."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        catalog_path = os.path.join(tmp_dir, catalog.CATALOG_FILE_NAME)
+        experiment_dir = os.path.join(tmp_dir, 'experiments', 'exp0')
+        os.makedirs(experiment_dir)
+        with catalog.ResultsCatalog(catalog_path) as results_catalog:
+            results_catalog.record_experiment(experiment_dir, 'system0', 'protocol0')
+            results_catalog.record_experiment(os.path.join(tmp_dir, 'experiments', 'exp1'), 'system1', 'protocol0')
+        assert catalog.find_catalog(experiment_dir) == catalog_path
+
+        # Results are recorded without losing the experiment IDs.
+        store_path = os.path.join(experiment_dir, 'complex.nc')
+        open(store_path, 'w').close()
+        with catalog.ResultsCatalog(catalog_path) as results_catalog:
+            results_catalog.record_results(experiment_dir, DeltaF=-5.0, dDeltaF=0.1, kT=0.6,
+                                           stores=[('complex', store_path, 100)])
+            experiments = results_catalog.query()
+            assert [experiment['experiment'] for experiment in experiments] == [os.path.join('experiments', 'exp0'),
+                                                                                os.path.join('experiments', 'exp1')]
+            assert experiments[0]['system_id'] == 'system0'
+            assert experiments[0]['niterations'] == 100
+            assert experiments[1]['DeltaF'] is None
+            assert len(results_catalog.query(limit=1)) == 1
+
+            # Modified stores are detected without opening them.
+            os.utime(store_path, (0, 0))
+            assert results_catalog.get_modified_stores() == [os.path.join('experiments', 'exp0', 'complex.nc')]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_extract_trajectory():
+    """Test streamed extraction of atom subsets matches the stored positions."""
+    tmp_dir = tempfile.mkdtemp()
+    block_bytes = analyze.POSITIONS_BLOCK_BYTES
+    try:
+        nc_path = os.path.join(tmp_dir, 'phase.nc')
+        ncfile = create_trajectory_ncfile(nc_path)
+        states = ncfile.variables['states'][:]
+        positions = ncfile.variables['positions'][:]
+        ncfile.close()
+
+        # Blocks of 2 frames of all replicas.
+        analyze.POSITIONS_BLOCK_BYTES = 2 * 4 * 3 * 3 * 10
+        for extension in ['h5', 'dcd', 'gro']:
+            output_path = os.path.join(tmp_dir, 'state.' + extension)
+            analyze.extract_trajectory(output_path, nc_path, state_index=1, skip_frame=2)
+            trajectory = mdtraj.load(output_path, top=os.path.join(tmp_dir, 'state.h5'))
+            frames = range(1, 10, 2)
+            replicas = [list(states[frame]).index(1) for frame in frames]
+            assert np.allclose(trajectory.xyz, positions[frames, replicas], atol=1.0e-3)
+
+        # Solvent atoms are not read.
+        output_path = os.path.join(tmp_dir, 'replica.h5')
+        analyze.extract_trajectory(output_path, nc_path, replica_index=2, keep_solvent=False)
+        trajectory = mdtraj.load(output_path)
+        assert trajectory.n_atoms == 4
+        assert np.allclose(trajectory.xyz, positions[1:, 2, :4], atol=1.0e-5)
+    finally:
+        analyze.POSITIONS_BLOCK_BYTES = block_bytes
+        shutil.rmtree(tmp_dir)
+
+
+def test_extract_trajectories():
+    """Test single-pass extraction of all states matches single-state extraction."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        nc_path = os.path.join(tmp_dir, 'phase.nc')
+        create_trajectory_ncfile(nc_path).close()
+
+        # More trajectories than open files are extracted in groups.
+        output_paths = analyze.extract_trajectories(os.path.join(tmp_dir, 'state{}.h5'), nc_path,
+                                                    state_indices='all', max_open_files=2)
+        assert list(output_paths.keys()) == [0, 1, 2]
+        for state_index, output_path in output_paths.items():
+            expected_path = os.path.join(tmp_dir, 'expected.h5')
+            analyze.extract_trajectory(expected_path, nc_path, state_index=state_index)
+            assert np.all(mdtraj.load(output_path).xyz == mdtraj.load(expected_path).xyz)
+            os.remove(expected_path)
+
+        # The index is appended to the file name.
+        output_paths = analyze.extract_trajectories(os.path.join(tmp_dir, 'replica.h5'), nc_path,
+                                                    replica_indices=[2], keep_solvent=False)
+        assert output_paths[2] == os.path.join(tmp_dir, 'replica2.h5')
+        assert mdtraj.load(output_paths[2]).n_atoms == 4
+    finally:
+        shutil.rmtree(tmp_dir)
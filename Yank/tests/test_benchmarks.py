@@ -0,0 +1,210 @@
+#!/usr/local/bin/env python
+
+"""
+Test the YANK benchmarks.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import netCDF4 as netcdf
+from nose import tools
+
+from yank import storage, utils
+from yank.benchmarks import simulation, synthetic, analysis, scaling, setup_pipeline
+
+#=============================================================================================
+# TESTING FUNCTIONS
+#=============================================================================================
+
+def test_alchemical_protocol():
+    """Test the benchmark protocols turn off electrostatics before sterics."""
+    for nstates in [3, 10, 11]:
+        alchemical_states = simulation.create_alchemical_protocol(nstates)
+        assert len(alchemical_states) == nstates
+        assert alchemical_states[0]['lambda_electrostatics'] == 1.0
+        assert alchemical_states[0]['lambda_sterics'] == 1.0
+        assert alchemical_states[-1]['lambda_electrostatics'] == 0.0
+        assert alchemical_states[-1]['lambda_sterics'] == 0.0
+        for alchemical_state in alchemical_states:
+            if alchemical_state['lambda_sterics'] < 1.0:
+                assert alchemical_state['lambda_electrostatics'] == 0.0
+
+
+def test_simulation_benchmark():
+    """Test the simulation benchmark reports the split of the iteration time."""
+    result = simulation.run_simulation_benchmark('alanine-implicit', 3, niterations=2,
+                                                 nsteps_per_iteration=10, platform_name='Reference')
+    assert result['natoms'] == 22
+    assert result['seconds_per_iteration'] > 0.0
+    for name in simulation.TIMING_NAMES:
+        assert 0.0 <= result[name] <= result['seconds_per_iteration']
+    assert result['peak_memory_mb'] > 0.0
+
+
+def test_compare_benchmarks():
+    """Test only the metrics that increased more than the tolerance are flagged."""
+    baseline = {'results': [{'system': 'alanine-implicit', 'nstates': 10, 'seconds_per_iteration': 1.0,
+                             'peak_memory_mb': 100.0},
+                            {'system': 'src-implicit', 'nstates': 10, 'seconds_per_iteration': 5.0}]}
+    report = {'results': [{'system': 'alanine-implicit', 'nstates': 10, 'seconds_per_iteration': 1.05,
+                           'peak_memory_mb': 200.0},
+                          {'system': 'alanine-implicit', 'nstates': 100, 'seconds_per_iteration': 9.0},
+                          {'system': 'src-implicit', 'nstates': 10, 'error': 'failed'}]}
+    regressions = simulation.compare_benchmarks(report, baseline, tolerance=0.1)
+    assert regressions == [('alanine-implicit', 10, 'peak_memory_mb', 100.0, 200.0)]
+    assert len(simulation.compare_benchmarks(report, baseline, tolerance=1.5)) == 0
+
+
+@tools.raises(ValueError)
+def test_unknown_benchmark_system():
+    """Test an unknown benchmark system is rejected before running anything."""
+    simulation.run_benchmarks(system_names=['unknown'])
+
+
+def test_synthetic_store():
+    """Test synthetic stores have the layout of the stores written by ReplicaExchange."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        niterations, nstates, natoms = 25, 4, 40
+        for layout in synthetic.LAYOUTS:
+            store_path = os.path.join(tmp_dir, layout + '.nc')
+            store_files = synthetic.create_synthetic_store(store_path, niterations=niterations, nstates=nstates,
+                                                           natoms=natoms, layout=layout, codec='none',
+                                                           energy_store=True, segment_iterations=10)
+            assert all(os.path.isfile(path) for path in store_files)
+
+            ncfile = storage.open_store(store_path)
+            try:
+                states = ncfile.variables['states'][:]
+                assert states.shape == (niterations, nstates)
+                assert all(sorted(row) == range(nstates) for row in states)
+                assert ncfile.variables['energies'].shape == (niterations, nstates, nstates)
+                assert ncfile.groups['thermodynamic_states'].variables['temperatures'].shape == (nstates,)
+                topology = utils.deserialize_topology(ncfile.groups['metadata'].variables['topology'][0])
+                assert topology.n_atoms == natoms
+                if layout == 'no-positions':
+                    assert 'positions' not in ncfile.variables
+                else:
+                    assert ncfile.variables['positions'].shape == (niterations, nstates, natoms, 3)
+            finally:
+                ncfile.close()
+
+            # The energy store mirrors states and energies.
+            energy_ncfile = netcdf.Dataset(utils.get_companion_store_path(store_path, 'energies.nc'), 'r')
+            try:
+                assert np.all(energy_ncfile.variables['states'][:] == states)
+            finally:
+                energy_ncfile.close()
+
+            segments = storage.read_segment_manifest(store_path)
+            if layout == 'segmented':
+                assert [segment['first_iteration'] for segment in segments] == [0, 10, 20]
+            else:
+                assert len(segments) == 0
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_analysis_benchmark():
+    """Test the analysis benchmark times all entry points and recovers the exact free energy."""
+    result = analysis.run_analysis_benchmark(niterations=200, nstates=5, natoms=40, layout='segmented')
+    assert 'error' not in result, result.get('error')
+    for name in analysis.ENTRY_POINTS:
+        assert result[name] >= 0.0
+    assert abs(result['DeltaF_error']) < 0.5
+    assert result['store_mb'] > 0.0
+
+
+class SerialCommunicator(object):
+    """Communicator of a single process with the interface of mpi4py."""
+    rank = 0
+    size = 1
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def gather(self, sendobj, root=0):
+        return [sendobj]
+
+    def allgather(self, sendobj):
+        return [sendobj]
+
+    def barrier(self):
+        pass
+
+
+def test_counting_communicator():
+    """Test the counting communicator forwards the collectives and counts their pickled bytes."""
+    mpicomm = scaling.CountingCommunicator(SerialCommunicator())
+    assert mpicomm.rank == 0 and mpicomm.size == 1
+    positions = np.zeros((10, 3))
+    assert mpicomm.allgather(positions)[0] is positions
+    assert mpicomm.bcast(None) is None
+    mpicomm.allgather(positions)
+    mpicomm.barrier()
+
+    statistics = mpicomm.statistics
+    assert statistics['allgather']['calls'] == 2
+    assert statistics['allgather']['bytes'] > 2 * positions.nbytes
+    assert statistics['bcast']['calls'] == 1
+    assert statistics['barrier']['calls'] == 1 and statistics['barrier']['bytes'] == 0
+    assert statistics['gather']['calls'] == 0
+
+    mpicomm.reset()
+    assert all(s['calls'] == 0 and s['bytes'] == 0 for s in mpicomm.statistics.values())
+
+
+def test_scaling_efficiency():
+    """Test the parallel efficiency of strong and weak scaling curves."""
+    results = [{'nprocesses': 1, 'seconds_per_iteration': 8.0},
+               {'nprocesses': 2, 'error': 'failed'},
+               {'nprocesses': 4, 'seconds_per_iteration': 4.0}]
+    scaling.compute_scaling_efficiency(results, 'strong')
+    assert results[0]['efficiency'] == 1.0
+    assert results[2]['speedup'] == 2.0 and results[2]['efficiency'] == 0.5
+    assert 'efficiency' not in results[1]
+
+    scaling.compute_scaling_efficiency(results, 'weak')
+    assert results[2]['speedup'] == 8.0 and results[2]['efficiency'] == 2.0
+
+
+def test_scaling_case():
+    """Test a scaling case runs serially without mpirun."""
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        result = scaling.run_scaling_case(tmp_dir, 'alanine-implicit', 3, niterations=2,
+                                          nsteps_per_iteration=10, platform_name='Reference')
+    finally:
+        shutil.rmtree(tmp_dir)
+    assert result['nprocesses'] == 1
+    assert result['seconds_per_iteration'] > 0.0
+    for name in scaling.PHASE_NAMES:
+        assert name in result
+    assert result['wait'] == 0.0 and result['mb_per_iteration'] == 0.0
+
+
+def test_synthetic_script():
+    """Test synthetic YAML scripts expand to the requested number of experiments."""
+    from yank.yamlbuild import YamlBuilder
+    for ncombinations in [1, 10, 200]:
+        script = setup_pipeline.create_synthetic_script(ncombinations, output_dir=tempfile.gettempdir())
+        yaml_builder = YamlBuilder(script)
+        assert len(list(yaml_builder._expand_experiments())) == ncombinations
+
+
+def test_setup_benchmark():
+    """Test all setup pipeline utilities can be timed."""
+    for function_name in setup_pipeline.GEOMETRY_FUNCTIONS:
+        timings = setup_pipeline.time_setup_function(function_name, 1000, nrepeats=1)
+        assert timings['seconds'] >= 0.0 and timings['memory_mb'] >= 0.0
+    for function_name in setup_pipeline.SCRIPT_FUNCTIONS:
+        timings = setup_pipeline.time_setup_function(function_name, 20, nrepeats=1)
+        assert timings['seconds'] >= 0.0
@@ -14,13 +14,30 @@ Test command-line interface.
 #=============================================================================================
 
 import os
+import sys
+import json
+import time
 import textwrap
 import commands
+import subprocess
 
 import openmoltools as omt
 
 from yank import utils
 
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+# Maximum seconds taken by importing the command line interface and printing the help,
+# not counting the startup of the interpreter. The fastest of HELP_TIME_REPEATS runs is
+# compared, so that a busy machine does not make the test fail.
+HELP_TIME_BUDGET = 1.0
+HELP_TIME_REPEATS = 3
+
+# Dependencies that commands not running or analyzing simulations must not import.
+HEAVY_MODULES = ['simtk.openmm', 'mdtraj', 'netCDF4', 'pandas', 'parmed', 'pymbar', 'scipy', 'openmoltools']
+
 #=============================================================================================
 # UNIT TESTS
 #=============================================================================================
@@ -106,3 +123,52 @@ def test_script_yaml():
         with open(yaml_file_path, 'w') as f:
             f.write(textwrap.dedent(yaml_content))
         run_cli('script --yaml={}'.format(yaml_file_path))
+
+def import_and_dispatch(arguments):
+    """Run the command line interface in a new interpreter and return its run time and imported modules."""
+    script = textwrap.dedent("""
+        import os
+        import sys
+        import time
+        start_time = time.time()
+        from yank import cli
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            cli.main(argv={!r})
+        except SystemExit:  # docopt exits after printing the help
+            pass
+        sys.stdout = stdout
+        print time.time() - start_time
+        print ' '.join(sys.modules)
+        """.format(arguments.split()))
+    output = subprocess.check_output([sys.executable, '-c', script])
+    elapsed_time, modules = output.splitlines()[-2:]
+    return float(elapsed_time), set(modules.split())
+
+def test_help_import_time():
+    """Check that yank --help imports no heavy dependency and runs within the time budget."""
+    elapsed_times = []
+    for _ in range(HELP_TIME_REPEATS):
+        elapsed_time, modules = import_and_dispatch('--help')
+        assert modules.isdisjoint(HEAVY_MODULES), modules.intersection(HEAVY_MODULES)
+        elapsed_times.append(elapsed_time)
+    assert min(elapsed_times) < HELP_TIME_BUDGET, elapsed_times
+
+def test_status_imports():
+    """Check that yank status and yank cleanup do not import OpenMM and the analysis libraries."""
+    from yank.benchmarks import synthetic
+    with omt.utils.temporary_directory() as store_dir:
+        synthetic.create_synthetic_store(os.path.join(store_dir, 'complex.nc'), niterations=10,
+                                         nstates=3, natoms=10)
+        status = dict(iteration=10, number_of_iterations=10, nstates=3, natoms=10,
+                      seconds_per_iteration=1.0, overhead_fraction=0.1, ns_per_day=1.0,
+                      niterations_remaining=0, eta=0.0, acceptance_rate=None,
+                      neighbor_acceptance_rates=[], perron_eigenvalue=None,
+                      DeltaF=None, dDeltaF=None, last_write_time=time.time())
+        with open(os.path.join(store_dir, 'complex.status.json'), 'w') as f:
+            json.dump(status, f)
+
+        # Phases with a status file are reported without opening their store file.
+        for command in ['status', 'cleanup']:
+            _, modules = import_and_dispatch('{} --store={}'.format(command, store_dir))
+            assert modules.isdisjoint(HEAVY_MODULES), modules.intersection(HEAVY_MODULES)
@@ -399,6 +399,497 @@ def test_unknown_parameters():
     """Test ReplicaExchange raises exception on wrong initialization."""
     ReplicaExchange(store_filename='test', wrong_parameter=False)
 
+def run_harmonic_oscillators(store_filename, number_of_iterations, **kwargs):
+    """Create or resume a short replica exchange simulation of harmonic oscillators."""
+    import os
+    if os.path.exists(store_filename):
+        simulation = ReplicaExchange(store_filename)
+        simulation.resume(options=kwargs)
+    else:
+        testsystem = testsystems.HarmonicOscillator()
+        temperatures = [300.0, 350.0, 400.0] * units.kelvin
+        states = [ThermodynamicState(system=testsystem.system, temperature=temperature)
+                  for temperature in temperatures]
+        simulation = ReplicaExchange(store_filename, **kwargs)
+        simulation.create(states, [testsystem.positions])
+    simulation.platform_name = 'Reference'
+    simulation.minimize = False
+    simulation.number_of_iterations = number_of_iterations
+    simulation.nsteps_per_iteration = 10
+    simulation.run()
+    del simulation
+
+def test_energy_store():
+    """Test the energy store file mirrors the per-iteration data of the main store."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        energy_store_filename = os.path.join(tmp_dir, 'phase.energies.nc')
+
+        run_harmonic_oscillators(store_filename, 5, energy_store=True)
+        assert os.path.isfile(energy_store_filename)
+
+        # Remove the energy store and check that it is backfilled on resume.
+        os.remove(energy_store_filename)
+        run_harmonic_oscillators(store_filename, 7)
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        energy_ncfile = netcdf.Dataset(energy_store_filename, 'r')
+        try:
+            assert 'positions' not in energy_ncfile.variables
+            assert energy_ncfile.variables['states'].shape[0] == 7
+            for variable_name in ['states', 'energies', 'proposed', 'accepted']:
+                assert numpy.all(ncfile.variables[variable_name][:] ==
+                                 energy_ncfile.variables[variable_name][:])
+        finally:
+            ncfile.close()
+            energy_ncfile.close()
+
+        # The energy store is not a phase.
+        assert utils.find_phases_in_store_directory(tmp_dir).keys() == ['phase']
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_timings():
+    """Test per-iteration timings and timestamps are stored and reported."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+    from yank import analyze
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 5, energy_store=True)
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        energy_ncfile = netcdf.Dataset(os.path.join(tmp_dir, 'phase.energies.nc'), 'r')
+        try:
+            timestamps = ncfile.variables['timestamp'][:]
+            assert numpy.all(numpy.diff(timestamps) >= 0.0)
+            ncgrp_timings = ncfile.groups['timings']
+            for name in ['iteration', 'mixing', 'energies', 'storage', 'analysis', 'propagate']:
+                timings = numpy.ma.asarray(ncgrp_timings.variables[name][:])
+                assert numpy.ma.getmaskarray(timings[0]).all()  # the initial iteration is not timed
+                assert numpy.all(timings[1:] >= 0.0)
+                assert numpy.all(energy_ncfile.groups['timings'].variables[name][1:] == timings[1:])
+            assert numpy.all(ncgrp_timings.variables['iteration'][1:] >= ncgrp_timings.variables['storage'][1:])
+
+            throughput = analyze.read_throughput(energy_ncfile)
+            assert throughput['seconds_per_iteration'] > 0.0
+            assert 0.0 <= throughput['overhead_fraction'] <= 1.0
+            assert throughput['ns_per_day'] > 0.0
+            assert throughput['niterations_remaining'] >= 0
+        finally:
+            ncfile.close()
+            energy_ncfile.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_status_file():
+    """Test the status file is replaced after every iteration and read by status queries."""
+    import os
+    import time
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+    from yank import analyze
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        experiment_dir = os.path.join(tmp_dir, 'experiment')
+        os.makedirs(experiment_dir)
+        run_harmonic_oscillators(os.path.join(experiment_dir, 'phase.nc'), 5)
+
+        status_path = os.path.join(experiment_dir, 'phase.status.json')
+        assert not os.path.exists(status_path + '.tmp')
+        status = analyze.read_status_file(status_path)
+        assert status['iteration'] == status['number_of_iterations'] == 5
+        assert status['niterations_remaining'] == 0
+        assert status['nstates'] == 3 and status['natoms'] == 1
+        assert status['seconds_per_iteration'] > 0.0 and status['ns_per_day'] > 0.0
+        assert 0.0 <= status['acceptance_rate'] <= 1.0
+
+        # The overhead has the same semantics of the one computed from the stored timings.
+        ncfile = netcdf.Dataset(os.path.join(experiment_dir, 'phase.nc'), 'r')
+        try:
+            throughput = analyze.read_throughput(ncfile)
+        finally:
+            ncfile.close()
+        assert 0.0 < status['overhead_fraction'] < 1.0
+        assert numpy.isclose(status['overhead_fraction'], throughput['overhead_fraction'], rtol=1.0e-3, atol=1.0e-5)
+        assert len(status['neighbor_acceptance_rates']) == 2
+        assert status['perron_eigenvalue'] <= 1.0 + 1.0e-6
+        assert status['DeltaF'] is None  # no online analysis
+        assert 'memory' not in status
+        assert status['last_write_time'] <= time.time()
+
+        # Status queries find the status files in the whole tree.
+        assert analyze.find_status_files(tmp_dir) == [status_path]
+        assert analyze.print_status(tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_tracing():
+    """Test hot-path spans are recorded only when enabled and exported as Chrome trace events."""
+    import os
+    import json
+    import shutil
+    import tempfile
+    from yank import tracing
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Nothing is recorded when tracing is disabled.
+        run_harmonic_oscillators(os.path.join(tmp_dir, 'untraced.nc'), 2)
+        assert len(tracing.get_events()) == 0
+
+        tracing.enable()
+        try:
+            run_harmonic_oscillators(os.path.join(tmp_dir, 'traced.nc'), 3)
+        finally:
+            tracing.disable()
+        trace_path = os.path.join(tmp_dir, 'trace.json')
+        tracing.write_trace(trace_path)
+
+        with open(trace_path, 'r') as f:
+            events = json.load(f)['traceEvents']
+        span_events = [event for event in events if event['ph'] == 'X']
+        names = set(event['name'] for event in span_events)
+        for name in ['Context', 'setPositions', 'integrator.step', 'getState',
+                     'compute energies', 'write iteration']:
+            assert name in names, name
+        assert all(event['dur'] >= 0.0 and event['pid'] == 0 for event in span_events)
+        assert not os.path.exists(tracing.get_rank_trace_path(trace_path, 0))
+
+        # Full buffers are flushed to the rank file when the trace path is known.
+        max_buffered_events = tracing.MAX_BUFFERED_EVENTS
+        tracing.MAX_BUFFERED_EVENTS = 10
+        tracing.enable(file_path=trace_path)
+        try:
+            run_harmonic_oscillators(os.path.join(tmp_dir, 'flushed.nc'), 3)
+        finally:
+            tracing.disable()
+            tracing.MAX_BUFFERED_EVENTS = max_buffered_events
+        assert len(tracing.get_events()) < 10
+        tracing.write_trace(trace_path)
+        with open(trace_path, 'r') as f:
+            assert len(json.load(f)['traceEvents']) > 10
+    finally:
+        tracing.disable()
+        tracing.get_events().clear()
+        shutil.rmtree(tmp_dir)
+
+def test_profiling():
+    """Test only the iterations in the profiled window are profiled and reported."""
+    import os
+    import shutil
+    import pstats
+    import tempfile
+    from yank import profiling
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Iteration 0 is written by create(), so iterations 1 to 4 are run.
+        profiling.enable(first_iteration=2, last_iteration=4)
+        try:
+            run_harmonic_oscillators(os.path.join(tmp_dir, 'profiled.nc'), 5)
+        finally:
+            profiling.disable()
+        report_path = profiling.write_profile(tmp_dir)
+        assert not profiling.is_enabled()
+
+        profile_path = os.path.join(tmp_dir, profiling.RANK_PROFILE_FILE_NAME.format(0))
+        stats = pstats.Stats(profile_path).stats
+        propagate_calls = [nc for (_, _, name), (_, nc, _, _, _) in stats.items()
+                           if name == '_propagate_replicas']
+        assert propagate_calls == [2]
+
+        with open(report_path, 'r') as f:
+            report = f.read()
+        assert '_propagate_replicas' in report
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_memory_diagnostics():
+    """Test memory diagnostics enabled on resume are stored from then on and read by status queries."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+    from yank import analyze, memory
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 3)
+        run_harmonic_oscillators(store_filename, 6, energy_store=True, memory_diagnostics=True,
+                                 memory_diagnostics_interval=2)
+
+        energy_ncfile = netcdf.Dataset(os.path.join(tmp_dir, 'phase.energies.nc'), 'r')
+        try:
+            ncgrp_timings = energy_ncfile.groups['timings']
+            for name in memory.MEMORY_VARIABLES:
+                measured = ~numpy.ma.getmaskarray(numpy.ma.asarray(ncgrp_timings.variables[name][:]))
+                assert measured.tolist() == [False, False, False, True, True, True], name
+
+            diagnostics = analyze.read_memory_diagnostics(energy_ncfile)
+            assert 0.0 < diagnostics['rss'] <= diagnostics['max_peak_rss']
+            assert diagnostics['systems'] > 0.0
+            assert diagnostics['replica_buffers'] > 0.0
+            assert diagnostics['contexts'] == 0.0  # ReplicaExchange does not cache Contexts
+            if memory.tracemalloc is not None:
+                assert len(diagnostics['top_allocations']) > 0
+        finally:
+            energy_ncfile.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_positions_storage_policies():
+    """Test positions stride, atom subset and checkpoint-only storage policies."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Store positions of a subset of atoms every 2 iterations.
+        store_filename = os.path.join(tmp_dir, 'stride.nc')
+        run_harmonic_oscillators(store_filename, 4, positions_stride=2, positions_atom_indices=[0])
+        run_harmonic_oscillators(store_filename, 6, restart_checkpoint=False)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        try:
+            positions = ncfile.variables['positions']
+            assert positions.dimensions[2] == 'trajectory_atom'
+            assert positions.stride == 2
+            assert list(ncfile.variables['positions_atom_indices'][:]) == [0]
+            assert not numpy.ma.is_masked(positions[4])
+            assert numpy.ma.is_masked(positions[5])
+            assert 'checkpoint' not in ncfile.groups
+        finally:
+            ncfile.close()
+
+        # The full positions of the last iteration are kept only in the restart checkpoint.
+        checkpoint = numpy.load(os.path.join(tmp_dir, 'stride.checkpoint.npz'))
+        assert int(checkpoint['iteration']) == 5
+        assert int(checkpoint['positions_stride']) == 2
+        assert list(checkpoint['positions_atom_indices']) == [0]
+        assert checkpoint['positions'].shape == (3, 1, 3)
+
+        # Store no trajectory at all.
+        store_filename = os.path.join(tmp_dir, 'checkpoint.nc')
+        run_harmonic_oscillators(store_filename, 3, positions_stride=0)
+        run_harmonic_oscillators(store_filename, 5)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        try:
+            assert 'positions' not in ncfile.variables
+            assert ncfile.variables['states'].shape[0] == 5
+        finally:
+            ncfile.close()
+
+        # Without its restart checkpoint, a store with no trajectory cannot be resumed.
+        os.remove(os.path.join(tmp_dir, 'checkpoint.checkpoint.npz'))
+        tools.assert_raises(Exception, run_harmonic_oscillators, store_filename, 6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_segmented_store():
+    """Test positions are split in segment files and read back transparently."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+    from yank import storage
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 5, segment_iterations=2)
+        run_harmonic_oscillators(store_filename, 7)
+
+        # Iterations 0-6 are split in segments [0, 1], [2, 3], [4, 5] and [6].
+        segments = storage.read_segment_manifest(store_filename)
+        assert [segment['first_iteration'] for segment in segments] == [0, 2, 4, 6]
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert 'positions' not in ncfile.variables
+        assert ncfile.variables['states'].shape[0] == 7
+        ncfile.close()
+
+        # Compare the lazy concatenation with the content of the single segments.
+        expected_positions = []
+        for segment in segments:
+            segment_ncfile = netcdf.Dataset(os.path.join(tmp_dir, segment['file']), 'r')
+            expected_positions.append(segment_ncfile.variables['positions'][:])
+            segment_ncfile.close()
+        expected_positions = numpy.concatenate(expected_positions)
+
+        for nprocesses in [1, 2]:
+            ncfile = storage.open_store(store_filename, nprocesses=nprocesses)
+            try:
+                positions = ncfile.variables['positions']
+                assert positions.shape == expected_positions.shape
+                assert numpy.all(positions[:] == expected_positions)
+                assert numpy.all(positions[-1, 1] == expected_positions[-1, 1])
+                assert numpy.all(positions[1:6:2, :, 0] == expected_positions[1:6:2, :, 0])
+                assert numpy.all(positions[[5, 0, 3]] == expected_positions[[5, 0, 3]])
+            finally:
+                ncfile.close()
+
+        # Segment files are not phases.
+        assert utils.find_phases_in_store_directory(tmp_dir).keys() == ['phase']
+
+        # A manifest left without segments by a crash starts a new segment on resume.
+        storage.write_segment_manifest(store_filename, [])
+        run_harmonic_oscillators(store_filename, 8)
+        segments = storage.read_segment_manifest(store_filename)
+        assert [segment['first_iteration'] for segment in segments] == [7]
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_restart_checkpoint():
+    """Test resuming from the restart checkpoint and falling back to the store file."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        checkpoint_filename = os.path.join(tmp_dir, 'phase.checkpoint.npz')
+        run_harmonic_oscillators(store_filename, 4)
+
+        checkpoint = numpy.load(checkpoint_filename)
+        checkpoint = {name: checkpoint[name] for name in checkpoint.files}
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        assert int(checkpoint['iteration']) == ncfile.variables['states'].shape[0] - 1
+        assert numpy.all(checkpoint['replica_states'] == ncfile.variables['states'][-1])
+        assert numpy.all(checkpoint['Nij_accepted_cumulative'] == ncfile.variables['accepted'][:].sum(0))
+        stored_positions = ncfile.variables['positions'][-1]
+        ncfile.close()
+        assert numpy.allclose(checkpoint['positions'], stored_positions, atol=1.0e-6)
+
+        def resume():
+            simulation = ReplicaExchange(store_filename)
+            simulation.resume()
+            simulation.platform_name = 'Reference'
+            simulation._initialize_resume()
+            positions = numpy.array([x / units.nanometers for x in simulation.replica_positions])
+            del simulation
+            return positions
+
+        # Full precision positions are restored from the checkpoint.
+        assert numpy.all(resume() == checkpoint['positions'])
+
+        # An out of date checkpoint is ignored.
+        checkpoint['iteration'] = numpy.array(1)
+        with open(checkpoint_filename, 'wb') as f:
+            numpy.savez(f, **checkpoint)
+        assert numpy.all(resume() == stored_positions)
+
+        # A checkpoint one iteration behind the store (killed between the two writes)
+        # is used even if the trajectory does not contain the full positions.
+        store_filename = os.path.join(tmp_dir, 'solute.nc')
+        checkpoint_filename = os.path.join(tmp_dir, 'solute.checkpoint.npz')
+        run_harmonic_oscillators(store_filename, 3, positions_atom_indices=[0])
+        shutil.copy(checkpoint_filename, checkpoint_filename + '.previous')
+        run_harmonic_oscillators(store_filename, 4)
+        os.rename(checkpoint_filename + '.previous', checkpoint_filename)
+        previous_positions = numpy.load(checkpoint_filename)['positions']
+        assert numpy.all(resume() == previous_positions)
+
+        # The iteration stored after the checkpoint is run again.
+        run_harmonic_oscillators(store_filename, 6)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        try:
+            assert ncfile.variables['states'].shape[0] == 7
+            accepted = ncfile.variables['accepted'][:].sum(0)
+        finally:
+            ncfile.close()
+        checkpoint = numpy.load(checkpoint_filename)
+        assert int(checkpoint['iteration']) == 6
+        assert numpy.all(checkpoint['Nij_accepted_cumulative'] == accepted)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_compact_store():
+    """Test compaction keeps mixing data bit-for-bit and strides positions."""
+    import os
+    import shutil
+    import tempfile
+    import netCDF4 as netcdf
+    from yank import storage
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        store_filename = os.path.join(tmp_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 7, segment_iterations=3)
+        ncfile = storage.open_store(store_filename)
+        expected = {name: ncfile.variables[name][:] for name in ['states', 'energies', 'accepted', 'positions']}
+        ncfile.close()
+
+        # Compaction merges segments and removes them.
+        results = storage.compact_directory(tmp_dir, positions_stride=2)
+        assert len(results) == 1
+        store_path, input_bytes, output_bytes, error = results[0]
+        assert error is None
+        assert storage.read_segment_manifest(store_filename) == []
+        assert sorted(os.listdir(tmp_dir)) == ['phase.nc', 'phase.status.json']
+
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        try:
+            for name in ['states', 'energies', 'accepted']:
+                assert numpy.all(ncfile.variables[name][:] == expected[name])
+            positions = ncfile.variables['positions']
+            assert positions.stride == 2
+            assert numpy.all(positions[0:7:2] == expected['positions'][0:7:2])
+            # Without metadata/reference_system, the Systems are the only copy.
+            assert 'systems' in ncfile.groups['thermodynamic_states'].variables
+        finally:
+            ncfile.close()
+
+        # Stores of unfinished simulations are compacted only if forced.
+        unfinished_dir = os.path.join(tmp_dir, 'unfinished')
+        os.makedirs(unfinished_dir)
+        store_filename = os.path.join(unfinished_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 3)
+        ncfile = netcdf.Dataset(store_filename, 'a')
+        ncfile.groups['options'].variables['number_of_iterations'].assignValue(10)
+        ncfile.close()
+        tools.assert_raises(RuntimeError, storage.compact_store, store_filename)
+        storage.compact_store(store_filename, force=True)
+        assert not os.path.exists(os.path.join(unfinished_dir, 'phase.checkpoint.npz'))
+
+        # The stride multiplies the one of stores written with a positions stride.
+        strided_dir = os.path.join(tmp_dir, 'strided')
+        os.makedirs(strided_dir)
+        store_filename = os.path.join(strided_dir, 'phase.nc')
+        run_harmonic_oscillators(store_filename, 9, positions_stride=2)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        expected_positions = ncfile.variables['positions'][0:9:4]
+        ncfile.close()
+        storage.compact_store(store_filename, positions_stride=2)
+        ncfile = netcdf.Dataset(store_filename, 'r')
+        try:
+            positions = ncfile.variables['positions']
+            assert positions.stride == 4
+            assert numpy.all(positions[0:9:4] == expected_positions)
+        finally:
+            ncfile.close()
+
+        # A failed in-place compaction removes its partial output.
+        tools.assert_raises(Exception, storage.compact_store, store_filename, keep_solvent=False)
+        assert sorted(os.listdir(strided_dir)) == ['phase.nc', 'phase.status.json']
+    finally:
+        shutil.rmtree(tmp_dir)
+
 #=============================================================================================
 # MAIN AND TESTS
 #=============================================================================================
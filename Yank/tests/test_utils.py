@@ -11,6 +11,7 @@ Test various utility functions.
 
 import textwrap
 
+import mdtraj
 import openmoltools as omt
 from schema import Schema
 from openmmtools import testsystems
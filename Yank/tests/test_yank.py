@@ -55,6 +55,15 @@ def test_unknown_parameters():
     """Test whether Yank raises exception on wrong initialization."""
     Yank(store_directory='test', wrong_parameter=False)
 
+def test_deprecated_package_attribute():
+    """Test that yank.Yank is still available with a DeprecationWarning."""
+    import warnings
+    import yank
+    with warnings.catch_warnings(record=True) as caught_warnings:
+        warnings.simplefilter('always')
+        assert yank.Yank is Yank
+    assert any(issubclass(warning.category, DeprecationWarning) for warning in caught_warnings)
+
 
 @tools.raises(ValueError)
 def test_no_alchemical_atoms():
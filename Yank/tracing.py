@@ -0,0 +1,245 @@
+#!/usr/local/bin/env python
+
+#=============================================================================================
+# MODULE DOCSTRING
+#=============================================================================================
+
+"""
+Tracing
+=======
+
+Lightweight tracing of the simulation hot path.
+
+Code regions are wrapped in spans
+
+>>> with span('integrator.step', nsteps=500):
+...     pass
+
+which record nothing unless tracing has been enabled with enable(). When
+enabled, every span records a Chrome trace event ('X' phase, timestamps in
+microseconds) tagged with the MPI rank as process ID. At most
+MAX_BUFFERED_EVENTS events are buffered in memory: when the path of the
+trace is given to enable(), full buffers are flushed to a file per rank,
+otherwise the oldest events are dropped. write_trace() merges the files of
+all ranks on the root node in a JSON file that can be opened with
+chrome://tracing or https://ui.perfetto.dev.
+
+"""
+
+#=============================================================================================
+# GLOBAL IMPORTS
+#=============================================================================================
+
+import os
+import json
+import time
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+#=============================================================================================
+# CONSTANTS
+#=============================================================================================
+
+# Maximum number of events buffered in memory on each node.
+MAX_BUFFERED_EVENTS = 100000
+
+#=============================================================================================
+# CLOCK
+#=============================================================================================
+
+# Use the nanosecond monotonic clock when available (Python >= 3.7).
+try:
+    _clock_ns = time.perf_counter_ns
+except AttributeError:
+    def _clock_ns():
+        return int(time.time() * 1e9)
+
+#=============================================================================================
+# TRACING STATE
+#=============================================================================================
+
+_enabled = False
+_rank = 0
+_events = collections.deque(maxlen=MAX_BUFFERED_EVENTS)
+_file_path = None  # Path of the trace whose rank file receives the flushed events.
+_clock_offset_ns = 0  # Converts _clock_ns() readings to nanoseconds since the epoch.
+
+
+def get_rank_trace_path(file_path, rank):
+    """Return the path of the file collecting the events of a rank for the trace in file_path."""
+    return '{}.rank{}.jsonl'.format(os.path.splitext(file_path)[0], rank)
+
+
+def enable(rank=0, file_path=None):
+    """
+    Start recording spans for the given MPI rank, discarding any recorded event.
+
+    Parameters
+    ----------
+    rank : int, optional, default=0
+       The MPI rank of this node.
+    file_path : str, optional
+       The path of the trace that will be written by write_trace(). If
+       specified, full buffers of events are appended to the file of this
+       rank instead of dropping the oldest events.
+
+    """
+    global _enabled, _rank, _events, _file_path, _clock_offset_ns
+    _rank = rank
+    _events = collections.deque(maxlen=MAX_BUFFERED_EVENTS)
+    _file_path = file_path
+    if file_path is not None and os.path.exists(get_rank_trace_path(file_path, rank)):
+        os.remove(get_rank_trace_path(file_path, rank))
+    # Timestamps are referred to the wall clock so that events from different ranks line up.
+    _clock_offset_ns = int(time.time() * 1e9) - _clock_ns()
+    _enabled = True
+
+
+def disable():
+    """Stop recording spans. The events already recorded are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    """Return True if spans are being recorded."""
+    return _enabled
+
+
+def get_events():
+    """Return the Chrome trace events recorded on this node and still buffered in memory."""
+    return _events
+
+
+def _append_events(rank_path):
+    """Append the buffered events to a rank file, one JSON event per line, and clear the buffer."""
+    with open(rank_path, 'a') as f:
+        for event in _events:
+            f.write(json.dumps(event) + '\n')
+    _events.clear()
+
+
+def flush():
+    """
+    Append the buffered events to the file of this rank.
+
+    This does not communicate with the other nodes, so it is safe to call
+    when a node fails. It does nothing if no trace path was given to enable().
+
+    """
+    if _file_path is not None:
+        _append_events(get_rank_trace_path(_file_path, _rank))
+
+#=============================================================================================
+# SPANS
+#=============================================================================================
+
+class _NullSpan(object):
+    """Span returned when tracing is disabled; it does nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    """Record a complete ('X') Chrome trace event spanning the with block."""
+
+    __slots__ = ['name', 'category', 'args', 'start_ns']
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.start_ns = _clock_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end_ns = _clock_ns()
+        event = {'name': self.name, 'cat': self.category, 'ph': 'X', 'pid': _rank, 'tid': 0,
+                 'ts': (self.start_ns + _clock_offset_ns) / 1000.0,
+                 'dur': (end_ns - self.start_ns) / 1000.0}
+        if self.args:
+            event['args'] = self.args
+        _events.append(event)
+        if _file_path is not None and len(_events) == _events.maxlen:
+            flush()
+        return False
+
+
+def span(name, category='yank', **args):
+    """
+    Return a context manager tracing the enclosed code.
+
+    Parameters
+    ----------
+    name : str
+       The name of the span (e.g. 'integrator.step').
+    category : str, optional, default='yank'
+       The category of the event ('openmm', 'mpi', 'storage', ...).
+    args
+       Additional JSON-serializable values stored with the event.
+
+    """
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name, category, args)
+
+#=============================================================================================
+# EXPORT
+#=============================================================================================
+
+def write_trace(file_path, mpicomm=None):
+    """
+    Write the events recorded on all nodes in the Chrome trace-event JSON format.
+
+    This must be called by all the nodes in mpicomm. Every node appends its
+    buffered events to its rank file, and the root node merges the rank
+    files, streaming their events, and removes them.
+
+    Parameters
+    ----------
+    file_path : str
+       The path of the JSON file, in a directory shared by all nodes.
+    mpicomm : mpi4py communicator, optional
+       If specified, the events of all nodes are merged on the root node.
+
+    """
+    global _file_path
+    rank_path = get_rank_trace_path(file_path, _rank)
+    if _file_path is None and os.path.exists(rank_path):
+        os.remove(rank_path)  # No event has been flushed, this is from a previous trace.
+    _append_events(rank_path)
+    _file_path = None
+
+    # Gathering the paths also waits for all the ranks to write their events.
+    if mpicomm is not None:
+        rank_paths = mpicomm.gather((_rank, rank_path), root=0)
+        if mpicomm.rank != 0:
+            return
+    else:
+        rank_paths = [(_rank, rank_path)]
+
+    nevents = 0
+    with open(file_path, 'w') as f:
+        # Name processes after the MPI ranks.
+        f.write('{"traceEvents": [')
+        f.write(', '.join(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': rank, 'tid': 0,
+                                      'args': {'name': 'rank {}'.format(rank)}}) for rank, _ in rank_paths))
+        for _, node_rank_path in rank_paths:
+            with open(node_rank_path, 'r') as rank_file:
+                for line in rank_file:
+                    f.write(', ' + line.rstrip('\n'))
+                    nevents += 1
+        f.write('], "displayTimeUnit": "ms"}')
+    for _, node_rank_path in rank_paths:
+        os.remove(node_rank_path)
+    logger.info('Wrote {} trace events to {}'.format(nevents, file_path))
@@ -6,7 +6,6 @@ import glob
 import json
 import shutil
 import signal
-import pandas
 import inspect
 import logging
 import itertools
@@ -14,15 +13,13 @@ import subprocess
 import collections
 from contextlib import contextmanager
 
-from pkg_resources import resource_filename
-
-import mdtraj
-import parmed
 import numpy as np
 from simtk import unit
 from schema import Optional, Use
 
-from openmoltools.utils import wraps_py2, unwrap_py2  # Shortcuts for other modules
+# mdtraj, parmed, pandas, openmoltools and pkg_resources take a long time to
+# import, so they are imported only by the functions that use them to keep
+# the command line interface fast to start.
 
 #========================================================================================
 # Logging functions
@@ -220,6 +217,7 @@ def delay_termination():
 
 def delayed_termination(func):
     """Decorator to delay handling of termination signals during function execution."""
+    from openmoltools.utils import wraps_py2
     @wraps_py2(func)
     def _delayed_termination(*args, **kwargs):
         with delay_termination():
@@ -632,6 +630,7 @@ def get_data_filename(relative_path):
         ~/anaconda/lib/python2.7/site-packages/yank-*.egg/examples/
     """
 
+    from pkg_resources import resource_filename
     fn = resource_filename('yank', relative_path)
 
     if not os.path.exists(fn):
@@ -640,6 +639,33 @@ def get_data_filename(relative_path):
     return fn
 
 
+# Regular expression matching the basename (without extension) of the auxiliary
+# NetCDF files that are written next to a phase store file.
+_COMPANION_STORE_REGEX = re.compile(r'\.(energies|segment\d+)$')
+
+# Suffix of the JSON file with the live status of a phase written next to its store.
+STATUS_FILE_SUFFIX = 'status.json'
+
+
+def get_companion_store_path(store_path, suffix):
+    """Return the path of an auxiliary file written next to a phase store file.
+
+    Parameters
+    ----------
+    store_path : str
+        The path to the NetCDF store file of the phase (e.g. 'output/complex.nc').
+    suffix : str
+        The suffix identifying the auxiliary file (e.g. 'energies.nc').
+
+    Returns
+    -------
+    companion_path : str
+        The path of the auxiliary file (e.g. 'output/complex.energies.nc').
+
+    """
+    return os.path.splitext(store_path)[0] + '.' + suffix
+
+
 def find_phases_in_store_directory(store_directory):
     """Build a list of phases in the store directory.
 
@@ -661,6 +687,8 @@ def find_phases_in_store_directory(store_directory):
     for full_path in full_paths:
         file_name = os.path.basename(full_path)
         short_name, _ = os.path.splitext(file_name)
+        if _COMPANION_STORE_REGEX.search(short_name):
+            continue  # Auxiliary files are not phases
         phases[short_name] = full_path
 
     if len(phases) == 0:
@@ -700,6 +728,8 @@ def serialize_topology(topology):
         mdtraj Topology object.
 
     """
+    import mdtraj
+
     # Check if we need to convert the topology to mdtraj
     if isinstance(topology, mdtraj.Topology):
         mdtraj_top = topology
@@ -728,6 +758,8 @@ def deserialize_topology(serialized_topology):
         The deserialized topology object.
 
     """
+    import pandas
+    import mdtraj
     topology_dict = json.loads(serialized_topology)
     atoms = pandas.read_json(topology_dict['atoms'], orient='records')
     bonds = np.array(topology_dict['bonds'])
@@ -945,6 +977,7 @@ def generate_signature_schema(func, update_keys=None, exclude_keys=frozenset()):
     if update_keys is None:
         update_keys = {}
 
+    from openmoltools.utils import unwrap_py2
     func_schema = {}
     args, _, _, defaults = inspect.getargspec(unwrap_py2(func))
 
@@ -1133,22 +1166,26 @@ class Mol2File(object):
 
     @property
     def resname(self):
+        import parmed
         residue = parmed.load_file(self._file_path)
         return residue.name
 
     @resname.setter
     def resname(self, value):
+        import parmed
         residue = parmed.load_file(self._file_path)
         residue.name = value
         parmed.formats.Mol2File.write(residue, self._file_path)
 
     @property
     def net_charge(self):
+        import parmed
         residue = parmed.load_file(self._file_path)
         return sum(a.charge for a in residue.atoms)
 
     @net_charge.setter
     def net_charge(self, value):
+        import parmed
         residue = parmed.load_file(self._file_path)
         residue.fix_charges(to=value, precision=6)
         parmed.formats.Mol2File.write(residue, self._file_path)
@@ -1375,6 +1412,7 @@ class TLeap:
                        for local, path in self._file_paths.items()}
         script = self._script.format(**local_files) + 'quit\n'
 
+        import mdtraj
         with mdtraj.utils.enter_temp_directory():
             # Copy input files
             for local_file, file_path in input_files.items():
@@ -31,7 +31,9 @@ from alchemy import AlchemicalState, AbsoluteAlchemicalFactory
 from schema import Schema, And, Or, Use, Optional, SchemaError
 
 import utils
+import catalog
 import pipeline
+import profiling
 from yank import Yank
 from repex import ReplicaExchange, ThermodynamicState
 from sampling import ModifiedHamiltonianExchange
@@ -2162,6 +2164,11 @@ class YamlBuilder:
                 os.makedirs(results_dir)
             else:
                 resume = self._check_resume_experiment(results_dir, protocol_id)
+
+            # Register the experiment in the results catalog of the output directory
+            catalog_path = os.path.join(exp_opts['output_dir'], catalog.CATALOG_FILE_NAME)
+            with catalog.ResultsCatalog(catalog_path) as results_catalog:
+                results_catalog.record_experiment(results_dir, experiment['system'], protocol_id)
         if self._mpicomm:  # process 0 send result to other processes
             resume = self._mpicomm.bcast(resume, root=0)
 
@@ -2255,6 +2262,10 @@ class YamlBuilder:
                     yank.resume()  # resume from netcdf file created by root node
         yank.run()
 
+        # Write the profile of this experiment next to its log
+        if profiling.is_enabled():
+            profiling.write_profile(results_dir, mpicomm=self._mpicomm)
+
 
 if __name__ == "__main__":
     import doctest
@@ -132,7 +132,8 @@ class Yank(object):
         'randomize_ligand': False,
         'randomize_ligand_sigma_multiplier': 2.0,
         'randomize_ligand_close_cutoff': 1.5 * unit.angstrom,
-        'mc_displacement_sigma': 10.0 * unit.angstroms
+        'mc_displacement_sigma': 10.0 * unit.angstroms,
+        'positions_storage': 'all'
     }
 
     def __init__(self, store_directory, mpicomm=None, **kwargs):
@@ -159,6 +160,11 @@ class Yank(object):
         mc_displacement_sigma : simtk.unit.Quantity (units: length), optional
            Maximum displacement for Monte Carlo moves that augment Langevin dynamics
            (default: 10.0*unit.angstrom).
+        positions_storage : str, optional
+           Which atoms are stored in the trajectory. If 'all', positions of all
+           atoms are stored. If 'solute', only receptor and ligand atoms are
+           stored and the full positions are kept in the restart checkpoint for
+           resuming (default: 'all').
 
         Other Parameters
         ----------------
@@ -469,6 +475,12 @@ class Yank(object):
         if self._randomize_ligand and is_complex_explicit:
             logger.warning("Ligand randomization requested, but will not be performed for explicit solvent simulations.")
 
+        # Store only receptor and ligand positions if requested.
+        if self._positions_storage == 'solute':
+            repex_parameters['positions_atom_indices'] = sorted(atom_indices['complex'])
+        elif self._positions_storage != 'all':
+            raise Exception("positions_storage of '%s' is not supported." % self._positions_storage)
+
         # Identify whether any atoms will be displaced via MC, unless option is turned off.
         mc_atoms = None
         if self._mc_displacement_sigma: